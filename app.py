@@ -1,41 +1,355 @@
-from flask import Flask, request, jsonify
-import requests
+import contextvars
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, g, request, jsonify
 from flask_cors import CORS
 from query_factory import (get_tune_given_name, get_pattern_search_query,
                            advanced_search, get_most_common_patterns_for_a_tune,
-                           get_neighbour_patterns_by_tune, get_neighbour_tunes_by_pattern,
                            get_tune_data, get_tune_family_members,
-                           get_patterns_in_common_between_two_tunes,
-                           get_neighbour_tunes_by_common_patterns,
-                           get_corpus_list, get_keys_list, get_time_sig_list,
-                           get_tune_type_list, get_kg_version)
-
+                           get_patterns_in_common_between_two_tunes, get_kg_version,
+                           get_ranked_neighbour_patterns_by_tune,
+                           get_ranked_neighbour_tunes_by_pattern,
+                           get_ranked_neighbour_tunes_by_common_patterns)
+
+from batch_lookups import BatchRequestError, batch_queries, parse_batch_request, split_results
+from cache_warmup import AccessStats, CacheWarmer
+from facet_index import AdvancedSearchPrefilter
+from facets import FacetRegistry
 from fuzzy_search import FuzzySearch
+from http_caching import HTTPCaching
+from incidence_index import IncidenceEngine
+from json_codecs import CodecJSONProvider, make_codec
+from kg_version import KGVersionMonitor
+from metrics import current_query, current_route, registry as metrics
+from ranked_lists import PageCursorError, RankedListCache, page_offset, page_results, paged_results
+from resilience import CircuitBreaker, UpstreamGuard, UpstreamUnavailableError
+from response_cache import BackgroundRefresher, LRUCache, ResponseCache
+from search_pages import SearchPageError, SearchPager, results_page, search_page_params
+from results_stream import primed, reshaped_results
+from sparql_client import SparqlClient, SparqlQueryError
+from tune_similarity import TuneSimilarityStore
 
 app = Flask(__name__)
 CORS(app)
 
-BLAZEGRAPH_URL = 'https://polifonia.disi.unibo.it/harmory/sparql'
+BLAZEGRAPH_URL = os.environ.get('BLAZEGRAPH_URL', 'https://polifonia.disi.unibo.it/harmory/sparql')
+# Number of keep-alive connections kept open to the SPARQL endpoint.
+SPARQL_POOL_SIZE = 10
+# Seconds to wait for the endpoint to accept a connection and to answer a query.
+SPARQL_CONNECT_TIMEOUT = 5
+SPARQL_READ_TIMEOUT = 60
+# Concurrent requests sending the same query share one upstream request and its results.
+SPARQL_COALESCE = True
+# Seconds within which the SPARQL queries of a request must be answered, per route (the others
+# get UPSTREAM_DEFAULT_BUDGET, None for no limit): each query's timeout is cut to what is left and
+# none is sent once it is spent, the request failing with 503.
+UPSTREAM_BUDGETS = {
+    '/api/kg_version': 5,
+    '/api/tune_by_id': 10,
+    '/api/tuneFamilyMembers': 10,
+    '/api/composition_page': 20,
+    '/api/batch': 30,
+    '/api/search': 30,
+    '/api/tunes_by_pattern': 60,
+}
+UPSTREAM_DEFAULT_BUDGET = 20
+# Once a query_factory function has UPSTREAM_MIN_SAMPLES answered queries, its queries still
+# unanswered after the UPSTREAM_HEDGE_QUANTILE of their latencies (or failed for want of an answer)
+# are sent once more, the first answer winning, and time out after UPSTREAM_TIMEOUT_FACTOR times
+# their p99 (no less than UPSTREAM_MIN_TIMEOUT seconds). None turns hedging or adaptive timeouts off.
+UPSTREAM_HEDGE_QUANTILE = 0.95
+UPSTREAM_TIMEOUT_FACTOR = 5
+UPSTREAM_MIN_TIMEOUT = 5
+UPSTREAM_MIN_SAMPLES = 20
+# After UPSTREAM_FAILURE_THRESHOLD consecutive queries failed (no answer or a 5xx status), no query is
+# sent for UPSTREAM_OPEN_SECONDS: requests are answered from the response cache, stale entries
+# included (see RESPONSE_CACHE_STALE_TTL), or fail fast with 503. A single query then tries the endpoint.
+UPSTREAM_FAILURE_THRESHOLD = 5
+UPSTREAM_OPEN_SECONDS = 30
+# JSON codec decoding SPARQL results and encoding responses ('json' or the faster 'orjson').
+JSON_CODEC = 'orjson'
+# Results returned unchanged are forwarded as the endpoint's bytes, without decoding and re-encoding them.
+RAW_PASSTHROUGH = True
+# Fuzzy title search: scoring backend ('fuzzywuzzy' or the batch 'rapidfuzz' scorer, which gives
+# identical scores), its worker threads, and the number of n-gram candidates scored per query
+# (None scores every title, giving the results of the linear scan; a number gives approximate ones).
+TITLE_SCORER = 'rapidfuzz'
+TITLE_SCORER_WORKERS = 1
+TITLE_MAX_CANDIDATES = None
+# Memory-mapped snapshot of the title index, tagged with the KG release. Workers start from it
+# without querying the endpoint, and it is rebuilt in the background when the release changes.
+TITLE_SNAPSHOT_PATH = os.environ.get('TITLE_SNAPSHOT_PATH',
+                                     os.path.join(os.path.dirname(os.path.abspath(__file__)), 'title_index.snapshot'))
+# Seconds between checks of the knowledge graph release; a new release empties the response cache,
+# reloads the advanced search facet lists and rebuilds the title index snapshot.
+KG_VERSION_CHECK_INTERVAL = 60
+# Limits of the in-process cache of serialized API responses.
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+# Cached responses are kept this much longer after they expire. Such a stale response is served at once
+# while it is fetched again in the background (by RESPONSE_CACHE_REFRESH_WORKERS threads, up to
+# RESPONSE_CACHE_MAX_PENDING_REFRESHES waiting, further ones being dropped), and when the endpoint fails.
+RESPONSE_CACHE_STALE_TTL = 7 * 24 * 60 * 60
+RESPONSE_CACHE_REFRESH_WORKERS = 2
+RESPONSE_CACHE_MAX_PENDING_REFRESHES = 100
+# The tune ids requested from ACCESS_STATS_ROUTES are counted, and the counts saved to ACCESS_STATS_PATH every
+# ACCESS_STATS_SAVE_INTERVAL seconds. At startup and when the release changes, CACHE_WARMUP_PATHS are requested
+# for the CACHE_WARMUP_TUNES most requested tunes, so that their responses are cached before users ask (0 for none).
+ACCESS_STATS_PATH = os.environ.get('ACCESS_STATS_PATH',
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'access_stats.json'))
+ACCESS_STATS_SAVE_INTERVAL = 300
+ACCESS_STATS_ROUTES = {'/api/tune_by_id', '/api/composition_page', '/api/patterns', '/api/neighbour_patterns',
+                       '/api/neighbour_tunes_by_common_patterns'}
+CACHE_WARMUP_TUNES = 200
+CACHE_WARMUP_PATHS = ['/api/composition_page?id={id}&excludeTrivialPatterns=false', '/api/tune_by_id?id={id}']
+# Streamed responses (see STREAMING_RESULTS) are cached only up to this size, so that the memory
+# held per request stays bounded.
+RESPONSE_CACHE_MAX_STREAMED_BYTES = 1024 * 1024
+# Cache-Control of the GET routes answered with a strong ETag, derived from the request and the KG release,
+# and the time the release was first seen as Last-Modified: a request with a current If-None-Match (or
+# If-Modified-Since) is answered 304 without running the view. Response bodies of HTTP_COMPRESS_MIN_BYTES or
+# more (and all streamed ones) are compressed, with brotli when the brotli package is installed and the client
+# accepts it, else gzip. The compressed variants of the routes below are kept, up to the limits, until the
+# release changes.
+HTTP_CACHE_CONTROL = {
+    '/api/search': 'public, max-age=60',
+    '/api/suggest': 'public, max-age=300',
+    '/api/facets': 'public, max-age=3600',
+    '/api/corpus_list': 'public, max-age=3600',
+    '/api/keys_list': 'public, max-age=3600',
+    '/api/time_sig_list': 'public, max-age=3600',
+    '/api/tune_type_list': 'public, max-age=3600',
+    '/api/patterns': 'public, max-age=60',
+    '/api/common_patterns': 'public, max-age=60',
+    '/api/neighbour_patterns': 'public, max-age=60',
+    '/api/neighbour_tunes': 'public, max-age=60',
+    '/api/neighbour_tunes_by_common_patterns': 'public, max-age=60',
+    '/api/tune_by_id': 'public, max-age=60',
+    '/api/composition_page': 'public, max-age=60',
+    '/api/tuneFamilyMembers': 'public, max-age=60',
+    '/api/tunes_by_pattern': 'public, max-age=60',
+    # Clients poll it to notice new releases: always revalidated.
+    '/api/kg_version': 'no-cache',
+}
+HTTP_COMPRESS_MIN_BYTES = 1024
+HTTP_GZIP_LEVEL = 6
+HTTP_BROTLI_QUALITY = 5
+HTTP_COMPRESSED_CACHE_MAX_ENTRIES = 10000
+HTTP_COMPRESSED_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# The results of pattern searches and /api/tunes_by_pattern, thousands of rows for common patterns,
+# are streamed to the client as they arrive from the endpoint: 'reshape' re-serializes them binding
+# by binding into the same bytes as a whole response, 'passthrough' forwards the endpoint's JSON as
+# it is, and None decodes and re-encodes the whole body.
+STREAMING_RESULTS = 'reshape'
+# /api/search pages (`limit` and `cursor` parameters) hold at most SEARCH_MAX_LIMIT results, and the
+# result counts of up to SEARCH_MAX_COUNTS searches are kept until the KG release changes.
+SEARCH_MAX_LIMIT = 1000
+SEARCH_MAX_COUNTS = 10000
+# Advanced searches are answered from an in-memory faceted index of the tune metadata, loaded in the
+# background on every KG release; the SPARQL endpoint is only asked which tunes contain the searched
+# pattern, and those tunes are kept for up to ADVANCED_SEARCH_MAX_PATTERNS patterns per release.
+ADVANCED_SEARCH_PREFILTER = True
+ADVANCED_SEARCH_MAX_PATTERNS = 1000
+# /api/suggest typeahead: the number of suggestions by default and at most, and the fuzzy fallback
+# for prefixes with a typo: the edits allowed (0 turns it off), for queries of at least
+# SUGGEST_FUZZY_MIN_LENGTH characters, after their first SUGGEST_FUZZY_EXACT_LENGTH characters.
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+SUGGEST_FUZZY_MAX_EDITS = 1
+SUGGEST_FUZZY_MIN_LENGTH = 3
+SUGGEST_FUZZY_EXACT_LENGTH = 1
+# Complete ranked neighbour lists kept for paging through the network views: the number of lists,
+# their memory budget, and the longest list fetched at once.
+RANKED_LIST_CACHE_MAX_ENTRIES = 2000
+RANKED_LIST_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RANKED_LIST_MAX_LENGTH = 1000
+# Endpoints answered from an in-memory tune-pattern incidence index instead of the SPARQL endpoint
+# ('patterns', 'neighbour_patterns', 'neighbour_tunes' and 'tunes_by_pattern'). The index is bulk
+# loaded in the background on every KG release; until it is ready the endpoint keeps serving them.
+INCIDENCE_INDEX_ENDPOINTS = set()
+# Precomputed tune-tune similarity file serving /api/neighbour_tunes_by_common_patterns: the best
+# TUNE_SIMILARITY_TOP_K neighbours of every tune, updated incrementally on every KG release.
+TUNE_SIMILARITY_PATH = os.environ.get('TUNE_SIMILARITY_PATH',
+                                      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tune_similarity.snapshot'))
+TUNE_SIMILARITY_TOP_K = 250
+# Threads running the sub-queries of /api/composition_page (four per page) and /api/batch (one per
+# endpoint) concurrently.
+SUB_QUERY_WORKERS = 32
+# Per route and query_factory function timings of each phase of a request, upstream status codes and
+# cache lookups, served in the Prometheus text format on /metrics. SPARQL queries taking
+# SLOW_QUERY_SECONDS or longer are logged with their text (None logs none).
+METRICS_ENABLED = True
+SLOW_QUERY_SECONDS = 1.0
 
 EMPTY_SEARCH_RESPONSE = {"head":{"vars":["tune_name", "genre", "artist", "id"]},"results":{"bindings":[]}}
-fuzzy_search = FuzzySearch(BLAZEGRAPH_URL)
+metrics.configure(enabled=METRICS_ENABLED, slow_query_seconds=SLOW_QUERY_SECONDS)
+json_codec = make_codec(JSON_CODEC)
+app.json = CodecJSONProvider(app, json_codec, metrics=metrics)
+upstream_guard = UpstreamGuard(budgets=UPSTREAM_BUDGETS, default_budget=UPSTREAM_DEFAULT_BUDGET,
+                               hedge_quantile=UPSTREAM_HEDGE_QUANTILE,
+                               timeout_factor=UPSTREAM_TIMEOUT_FACTOR,
+                               min_timeout=UPSTREAM_MIN_TIMEOUT,
+                               min_samples=UPSTREAM_MIN_SAMPLES,
+                               breaker=CircuitBreaker(failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+                                                      open_seconds=UPSTREAM_OPEN_SECONDS),
+                               metrics=metrics)
+sparql_client = SparqlClient(BLAZEGRAPH_URL, pool_size=SPARQL_POOL_SIZE,
+                             connect_timeout=SPARQL_CONNECT_TIMEOUT,
+                             read_timeout=SPARQL_READ_TIMEOUT,
+                             coalesce=SPARQL_COALESCE,
+                             json_loads=json_codec.loads,
+                             metrics=metrics,
+                             guard=upstream_guard)
+fuzzy_search = FuzzySearch(sparql_client, snapshot_path=TITLE_SNAPSHOT_PATH, scorer=TITLE_SCORER,
+                           workers=TITLE_SCORER_WORKERS, max_candidates=TITLE_MAX_CANDIDATES)
+kg_version_monitor = KGVersionMonitor(sparql_client, check_interval=KG_VERSION_CHECK_INTERVAL)
+response_cache = ResponseCache(kg_version_monitor.current,
+                               max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                               max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                               ttl=RESPONSE_CACHE_TTL,
+                               stale_ttl=RESPONSE_CACHE_STALE_TTL,
+                               max_streamed_bytes=RESPONSE_CACHE_MAX_STREAMED_BYTES,
+                               refresher=BackgroundRefresher(workers=RESPONSE_CACHE_REFRESH_WORKERS,
+                                                             max_pending=RESPONSE_CACHE_MAX_PENDING_REFRESHES))
+http_caching = HTTPCaching(response_cache.make_key, kg_version_monitor.last_changed, HTTP_CACHE_CONTROL,
+                           min_compress_bytes=HTTP_COMPRESS_MIN_BYTES,
+                           gzip_level=HTTP_GZIP_LEVEL,
+                           brotli_quality=HTTP_BROTLI_QUALITY,
+                           variants=LRUCache(max_entries=HTTP_COMPRESSED_CACHE_MAX_ENTRIES,
+                                             max_bytes=HTTP_COMPRESSED_CACHE_MAX_BYTES, ttl=None))
+access_stats = AccessStats(ACCESS_STATS_PATH, save_interval=ACCESS_STATS_SAVE_INTERVAL).start()
+cache_warmer = CacheWarmer(app, access_stats, CACHE_WARMUP_PATHS, count=CACHE_WARMUP_TUNES)
+ranked_lists = RankedListCache(sparql_client, kg_version_monitor.current,
+                               max_length=RANKED_LIST_MAX_LENGTH,
+                               max_entries=RANKED_LIST_CACHE_MAX_ENTRIES,
+                               max_bytes=RANKED_LIST_CACHE_MAX_BYTES)
+search_pager = SearchPager(sparql_client, kg_version_monitor.current, max_counts=SEARCH_MAX_COUNTS)
+facet_registry = FacetRegistry(sparql_client)
+advanced_search_prefilter = AdvancedSearchPrefilter(sparql_client, kg_version_monitor.current,
+                                                    enabled=ADVANCED_SEARCH_PREFILTER,
+                                                    max_patterns=ADVANCED_SEARCH_MAX_PATTERNS)
+incidence_engine = IncidenceEngine(sparql_client, routes=INCIDENCE_INDEX_ENDPOINTS)
+tune_similarity = TuneSimilarityStore(sparql_client, TUNE_SIMILARITY_PATH, top_k=TUNE_SIMILARITY_TOP_K)
+kg_version_monitor.on_change(response_cache.invalidate)
+kg_version_monitor.on_change(http_caching.invalidate)
+kg_version_monitor.on_change(ranked_lists.invalidate)
+kg_version_monitor.on_change(search_pager.invalidate)
+kg_version_monitor.on_change(fuzzy_search.refresh_in_background)
+# The first version check loads the facet lists in the background.
+kg_version_monitor.on_change(facet_registry.refresh_in_background)
+kg_version_monitor.on_change(advanced_search_prefilter.refresh_in_background)
+kg_version_monitor.on_change(incidence_engine.refresh_in_background)
+kg_version_monitor.on_change(tune_similarity.refresh_in_background)
+kg_version_monitor.on_change(cache_warmer.warm_in_background)
+metrics.register_cache('response', response_cache)
+metrics.register_cache('compressed_responses', http_caching.variants)
+metrics.register_collector(upstream_guard.collect_metrics)
+metrics.register_collector(response_cache.refresher.collect_metrics)
+metrics.register_collector(cache_warmer.collect_metrics)
+metrics.register_cache('ranked_lists', ranked_lists)
+metrics.register_cache('search_counts', search_pager.counts)
+metrics.register_cache('advanced_search_patterns', advanced_search_prefilter.pattern_ids)
+sub_query_executor = ThreadPoolExecutor(max_workers=SUB_QUERY_WORKERS, thread_name_prefix='sub-query')
+
+
+def _new_sub_query_executor():
+    # The threads of an executor used before a fork (by the warm-up in a prefork master) do not
+    # exist in the child, but the executor would still count them as idle and never start any.
+    global sub_query_executor
+    sub_query_executor = ThreadPoolExecutor(max_workers=SUB_QUERY_WORKERS, thread_name_prefix='sub-query')
+
+
+os.register_at_fork(after_in_child=_new_sub_query_executor)
+
+
+def submit_sub_query(function, *args):
+    # In a copy of the request's context, so that the sub-query is timed under its route.
+    return sub_query_executor.submit(contextvars.copy_context().run, function, *args)
+
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    current_route.set(request.url_rule.rule if request.url_rule is not None else 'unmatched')
+    current_query.set('')
+    upstream_guard.start_request(current_route.get())
+    record_access(current_route.get(), request.args)
+
+
+def record_access(route, args):
+    if route in ACCESS_STATS_ROUTES and args.get('id'):
+        access_stats.record(args['id'])
+
+
+@app.before_request
+def answer_not_modified():
+    return http_caching.check_not_modified(current_route.get())
+
+
+@app.after_request
+def record_timing(response):
+    if 'request_start' in g:
+        metrics.observe_request(current_route.get(), time.perf_counter() - g.request_start, response.status_code)
+    return response
+
+
+# Registered after record_timing so that it runs before it: the compression is timed.
+@app.after_request
+def finish_response(response):
+    return http_caching.finish_response(response, current_route.get())
+
+
+@app.errorhandler(SparqlQueryError)
+def handleSparqlQueryError(error):
+    # The client has already logged the failing query and the server response.
+    return jsonify({'error': 'Failed to execute SPARQL query'}), 500
+
+
+@app.errorhandler(PageCursorError)
+def handlePageCursorError(error):
+    return jsonify({'error': str(error)}), 400
+
+
+@app.errorhandler(UpstreamUnavailableError)
+def handleUpstreamUnavailableError(error):
+    headers = {'Retry-After': str(math.ceil(error.retry_after))} if error.retry_after else {}
+    return jsonify({'error': str(error)}), 503, headers
+
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    if not metrics.enabled:
+        return jsonify({'error': 'Metrics are disabled.'}), 404
+    return app.response_class(metrics.render(), status=200, mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/api/search', methods=['GET'])
+@response_cache.cached_view
 def search():
     #print(request)
     # Get the query parameters from the GET request
     query_params = request.args.to_dict(flat=False)
+    # An optional page of `limit` results from `cursor`, with the `count` of all of them
+    try:
+        limit, offset = search_page_params(request.args.get('limit'), request.args.get('cursor'),
+                                           max_limit=SEARCH_MAX_LIMIT)
+    except SearchPageError as e:
+        return jsonify({'error': str(e)}), 400
+    with_count = request.args.get('count') == 'true'
     # Composition title based search
     search_type = query_params['searchType'][0]
     #print(query_params)
     sparql_query = ""
     if search_type == "title":
         search_term = query_params['searchTerm'][0]
-        fuzzy_title_matches = fuzzy_search.get_title_best_match(search_term)
+        fuzzy_title_matches = title_matches(search_term)
         if not fuzzy_title_matches:
             # If there are no matched titles, return an empty response.
-            return jsonify(EMPTY_SEARCH_RESPONSE), 200
+            return jsonify(empty_search_response(limit, offset, with_count)), 200
         else:
             # Generate the SPARQL query
             sparql_query = get_tune_given_name(fuzzy_title_matches)
@@ -43,165 +357,137 @@ def search():
     elif search_type == "pattern":
         search_term = query_params['searchTerm'][0]
         sparql_query = get_pattern_search_query(search_term)
+        if STREAMING_RESULTS and limit is None:
+            return streamed_results(sparql_query)
     # Advanced search
     elif search_type == "advanced":
         matched_tuples = []
         if query_params['title'][0]:
             search_term = query_params['title'][0]
-            matched_tuples = fuzzy_search.get_title_best_match(search_term)
+            matched_tuples = title_matches(search_term)
         if query_params['title'][0] and not matched_tuples:
             # If a title is searched for and there are no matched titles, return an empty response.
-            return jsonify(EMPTY_SEARCH_RESPONSE), 200
-        else:
-            sparql_query = advanced_search(query_params, matched_tuples)
+            return jsonify(empty_search_response(limit, offset, with_count)), 200
+        results = advanced_search_prefilter.search(query_params, matched_tuples)
+        if results is not None:
+            return jsonify(results if limit is None else results_page(results, limit, offset, with_count)), 200
+        sparql_query = advanced_search(query_params, matched_tuples)
     else:
         # Error message.
         return jsonify({'error': 'Invalid search type.'}), 501
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        print(f"Error executing Sparql Query = {sparql_query}")
-        print(response.text)
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+    if limit is not None:
+        # Execute the SPARQL query for the page only and return the JSON data
+        return jsonify(search_pager.page(sparql_query, limit, offset, with_count)), 200
+    # Execute the SPARQL query and return the JSON data
+    return query_results(sparql_query)
+
+
+def title_matches(search_term):
+    with metrics.timed('fuzzy_match'):
+        return fuzzy_search.get_title_best_match(search_term)
+
+
+def empty_search_response(limit, offset, with_count):
+    if limit is None:
+        return EMPTY_SEARCH_RESPONSE
+    page = paged_results(EMPTY_SEARCH_RESPONSE['head'], [], offset, False, page_size=limit)
+    if with_count:
+        page['count'] = 0
+    return page
+
+
+def query_results(sparql_query):
+    if RAW_PASSTHROUGH:
+        return app.response_class(sparql_client.query_raw(sparql_query), status=200, mimetype='application/json')
+    return jsonify(sparql_client.query(sparql_query)), 200
+
+
+def streamed_results(sparql_query):
+    # Forward the results while they arrive, without holding the whole body in memory. An
+    # upstream error raised before the first chunk still gives an error response.
+    chunks = primed(sparql_client.stream(sparql_query))
+    if STREAMING_RESULTS == 'reshape':
+        chunks = reshaped_results(chunks, codec=json_codec)
+    return app.response_class(chunks, status=200, mimetype='application/json')
+
+
+@app.route('/api/suggest', methods=['GET'])
+def suggest():
+    # Typeahead titles for the prefix typed so far, from the local prefix index only.
+    try:
+        limit, _ = search_page_params(request.args.get('limit', SUGGEST_LIMIT), None, max_limit=SUGGEST_MAX_LIMIT)
+    except SearchPageError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(title_suggestions(request.args.get('searchTerm', ''), limit,
+                                     request.args.get('fuzzy') != 'false')), 200
+
+
+def title_suggestions(search_term, limit, fuzzy):
+    suggestions = fuzzy_search.suggest(search_term, limit=limit,
+                                       max_edits=SUGGEST_FUZZY_MAX_EDITS if fuzzy else 0,
+                                       fuzzy_min_length=SUGGEST_FUZZY_MIN_LENGTH,
+                                       fuzzy_exact_length=SUGGEST_FUZZY_EXACT_LENGTH)
+    bindings = [{'title': {'type': 'literal', 'value': title}, 'id': {'type': 'literal', 'value': tune_id}}
+                for title, tune_id in suggestions]
+    return {"head": {"vars": ["title", "id"]}, "results": {"bindings": bindings}}
+
+
+@app.route('/api/facets', methods=['GET'])
+def getFacets():
+    # Return every advanced search drop-down list in one response.
+    return jsonify(facet_registry.get_all()), 200
 
 
 @app.route('/api/corpus_list', methods=['GET'])
 def getCorpusList():
-    # Generate the SPARQL query
-    sparql_query = get_corpus_list()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    corpusJSON = response.json()
-    corpus_list = [item['corpus']['value'] for item in
-                 corpusJSON['results']['bindings']]
-    #print(corpus_list)
-    # Return the JSON data
-    return jsonify(corpus_list), 200
+    # The list is loaded at startup and refreshed when the KG version changes.
+    return jsonify(facet_registry.get('corpus')), 200
 
 
 @app.route('/api/keys_list', methods=['GET'])
 def getKeysList():
-    # Generate the SPARQL query
-    sparql_query = get_keys_list()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    keysJSON = response.json()
-    keys_list = [item['key']['value'] for item in
-                 keysJSON['results']['bindings']]
-    #print(keys_list)
-    # Return the JSON data
-    return jsonify(keys_list), 200
+    # The list is loaded at startup and refreshed when the KG version changes.
+    return jsonify(facet_registry.get('key')), 200
 
 
 @app.route('/api/time_sig_list', methods=['GET'])
 def getTimeSignatureList():
-    # Generate the SPARQL query
-    sparql_query = get_time_sig_list()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    timeSigJSON = response.json()
-    time_sig_list = [item['signature']['value'] for item in
-                 timeSigJSON['results']['bindings']]
-    #print(time_sig_list)
-    # Return the JSON data
-    return jsonify(time_sig_list), 200
+    # The list is loaded at startup and refreshed when the KG version changes.
+    return jsonify(facet_registry.get('timeSignature')), 200
 
 
 @app.route('/api/tune_type_list', methods=['GET'])
 def getTuneTypeList():
-    # Generate the SPARQL query
-    sparql_query = get_tune_type_list()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    tuneTypeJSON = response.json()
-    tune_type_list = [item['genre']['value'] for item in
-                 tuneTypeJSON['results']['bindings']]
-    #print(tune_type_list)
-    # Return the JSON data
-    return jsonify(tune_type_list), 200
+    # The list is loaded at startup and refreshed when the KG version changes.
+    return jsonify(facet_registry.get('tuneType')), 200
 
 
 @app.route('/api/patterns', methods=['GET'])
+@response_cache.cached_view
 def getPatterns():
     # Get the query parameters from the GET request
     query_params = request.args.to_dict()
+    if incidence_engine.serves('patterns') is None:
+        # Execute the SPARQL query and return the JSON data
+        return query_results(get_most_common_patterns_for_a_tune(query_params['id'],
+                                                                 query_params['excludeTrivialPatterns']))
+    results = most_common_patterns(query_params['id'], query_params['excludeTrivialPatterns'])
+    # Return the JSON data
+    return jsonify(results), 200
+
+
+def most_common_patterns(tune_id, exclude_trivial_patterns):
+    incidence_index = incidence_engine.serves('patterns')
+    if incidence_index is not None:
+        return incidence_index.most_common_patterns(tune_id)
     # Generate the SPARQL query
-    sparql_query = get_most_common_patterns_for_a_tune(query_params['id'],
-                                                       query_params['excludeTrivialPatterns'])
+    sparql_query = get_most_common_patterns_for_a_tune(tune_id, exclude_trivial_patterns)
     # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+    return sparql_client.query(sparql_query)
 
 
 @app.route('/api/common_patterns', methods=['GET'])
+@response_cache.cached_view
 def getCommonPatterns():
     # Get the query parameters from the GET request
     query_params = request.args.to_dict()
@@ -209,189 +495,163 @@ def getCommonPatterns():
     sparql_query = get_patterns_in_common_between_two_tunes(query_params['id'],
                                                             query_params['prev'],
                                                             query_params['excludeTrivialPatterns'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+    # Execute the SPARQL query and return the JSON data
+    return query_results(sparql_query)
 
 
 @app.route('/api/neighbour_patterns', methods=['GET'])
+@response_cache.cached_view
 def getNeighbourPatterns():
     # Get the query parameters from the GET request
     query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_neighbour_patterns_by_tune(query_params['id'],
-                                                  query_params['click_num'],
-                                                  query_params['excludeTrivialPatterns'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
+    results = neighbour_patterns_page(query_params['id'], query_params['excludeTrivialPatterns'],
+                                      page_offset(query_params))
     # Return the JSON data
-    return jsonify(response.json()), 200
+    return jsonify(results), 200
+
+
+def neighbour_patterns_page(tune_id, exclude_trivial_patterns, offset):
+    incidence_index = incidence_engine.serves('neighbour_patterns')
+    if incidence_index is not None:
+        return page_results(incidence_index.ranked_neighbour_patterns(tune_id), offset)
+    # Serve the page from the ranked list of all the tune's patterns, fetched once
+    return ranked_lists.page(get_ranked_neighbour_patterns_by_tune, (tune_id, exclude_trivial_patterns), offset)
 
 
 @app.route('/api/neighbour_tunes', methods=['GET'])
+@response_cache.cached_view
 def getNeighbourTunes():
     # Get the query parameters from the GET request
     query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_neighbour_tunes_by_pattern(query_params['id'],
-                                                  query_params['click_num'],)
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
+    pattern = query_params['id']
+    incidence_index = incidence_engine.serves('neighbour_tunes')
+    if incidence_index is not None:
+        return jsonify(page_results(incidence_index.ranked_neighbour_tunes(pattern),
+                                    page_offset(query_params))), 200
+    # Serve the page from the ranked list of all the tunes containing the pattern, fetched once
+    results = ranked_lists.page(get_ranked_neighbour_tunes_by_pattern, (pattern,), page_offset(query_params))
     # Return the JSON data
-    return jsonify(response.json()), 200
+    return jsonify(results), 200
 
 
 @app.route('/api/neighbour_tunes_by_common_patterns', methods=['GET'])
+@response_cache.cached_view
 def getNeighbourTunesByCommonPatterns():
     # Get the query parameters from the GET request
     query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_neighbour_tunes_by_common_patterns(query_params['id'],
-                                                  query_params['click_num'],)
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
+    results = neighbour_tunes_by_common_patterns_page(query_params['id'], page_offset(query_params))
     # Return the JSON data
-    return jsonify(response.json()), 200
+    return jsonify(results), 200
+
+
+def neighbour_tunes_by_common_patterns_page(tune_id, offset):
+    # Serve the page from the precomputed neighbour lists, or else from the ranked list of all
+    # the tune's neighbours, fetched once
+    results = tune_similarity.page(tune_id, offset)
+    if results is None:
+        results = ranked_lists.page(get_ranked_neighbour_tunes_by_common_patterns, (tune_id,), offset)
+    return results
 
 
 @app.route('/api/tune_by_id', methods=['GET'])
+@response_cache.cached_view
 def getTuneData():
     # Get the query parameters from the GET request
     query_params = request.args.to_dict()
     # Generate the SPARQL query
     #print(query_params)
     sparql_query = get_tune_data(query_params['id'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+    # Execute the SPARQL query and return the JSON data
+    return query_results(sparql_query)
+
+
+@app.route('/api/composition_page', methods=['GET'])
+@response_cache.cached_view
+def getCompositionPage():
+    # Get the query parameters from the GET request
+    query_params = request.args.to_dict()
+    tune_id = query_params['id']
+    exclude_trivial_patterns = query_params.get('excludeTrivialPatterns', 'false')
+    # Everything the composition page loads, fetched concurrently: the page waits for the
+    # slowest part rather than for all of them in turn
+    parts = {
+        'tune_by_id': submit_sub_query(sparql_client.query, get_tune_data(tune_id)),
+        'patterns': submit_sub_query(most_common_patterns, tune_id, exclude_trivial_patterns),
+        'neighbour_patterns': submit_sub_query(neighbour_patterns_page, tune_id,
+                                               exclude_trivial_patterns, 0),
+        'neighbour_tunes_by_common_patterns': submit_sub_query(
+            neighbour_tunes_by_common_patterns_page, tune_id, 0),
+    }
+    # Return the JSON data, or the first error
+    return jsonify({name: part.result() for name, part in parts.items()}), 200
+
+
+@app.route('/api/batch', methods=['POST'])
+def getBatch():
+    # Look up several ids at once, e.g. {"tune_by_id": [id, ...], "patterns": [id, ...],
+    # "tunes_by_pattern": [pattern, ...]}
+    try:
+        lookups = parse_batch_request(request.get_json(silent=True))
+    except BatchRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    # One query per endpoint, run concurrently
+    parts = {endpoint: submit_sub_query(batch_lookup, endpoint, ids) for endpoint, ids in lookups.items()}
+    # Return {endpoint: {id: results}}, each results as the endpoint returns them for that id
+    return jsonify({endpoint: part.result() for endpoint, part in parts.items()}), 200
+
+
+def batch_lookup(endpoint, ids):
+    incidence_index = incidence_engine.serves(endpoint)
+    if incidence_index is not None:
+        lookup = incidence_index.most_common_patterns if endpoint == 'patterns' else incidence_index.tunes_by_pattern
+        return {key: lookup(key) for key in ids}
+    results = {}
+    for sparql_query, chunk in batch_queries(endpoint, ids):
+        results.update(split_results(endpoint, sparql_client.query(sparql_query), chunk))
+    return results
 
 
 @app.route('/api/tuneFamilyMembers', methods=['GET'])
+@response_cache.cached_view
 def getTuneFamilyMembers():
     # Get the query parameters from the GET request
     query_params = request.args.to_dict()
     # Generate the SPARQL query
     #print(query_params)
     sparql_query = get_tune_family_members(query_params['family'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+    # Execute the SPARQL query and return the JSON data
+    return query_results(sparql_query)
 
 
 @app.route('/api/tunes_by_pattern', methods=['GET'])
+@response_cache.cached_view
 def getTunesContainingPattern():
     # Get the query parameters from the GET request
     query_params = request.args.to_dict()
+    incidence_index = incidence_engine.serves('tunes_by_pattern')
+    if incidence_index is not None:
+        return jsonify(incidence_index.tunes_by_pattern(query_params['pattern'])), 200
     # Generate the SPARQL query
     #print(query_params)
     sparql_query = get_pattern_search_query(query_params['pattern'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+    if STREAMING_RESULTS:
+        return streamed_results(sparql_query)
+    # Execute the SPARQL query and return the JSON data
+    return query_results(sparql_query)
 
 
 @app.route('/api/kg_version', methods=['GET'])
+@response_cache.cached_view
 def getKGVersion():
     # Generate the SPARQL query
     sparql_query = get_kg_version()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+    # Execute the SPARQL query and return the JSON data
+    return query_results(sparql_query)
+
+
+# Started once every route is registered: the first version check, made in the background so that
+# the import does not wait on the endpoint, warms the response cache through the app.
+kg_version_monitor.start()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,510 @@
+# The asyncio (ASGI) serving mode: the /api/* routes of app.py, with the same response bodies,
+# served by coroutines that wait on the SPARQL endpoint without holding a thread.
+#
+# Run with an ASGI server, e.g.:
+#     uvicorn asgi_app:app
+#
+# The caches, indexes and background refreshes are those of app.py. Work that is CPU bound
+# (fuzzy title matching) or goes through their blocking client (ranked list and similarity
+# misses, index loads) runs in a thread pool.
+
+import asyncio
+import contextlib
+import functools
+import math
+import time
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.datastructures import Headers, MutableHeaders, QueryParams
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MultiDict
+
+import app as wsgi
+from async_sparql_client import AsyncSparqlClient
+from metrics import current_query, current_route
+from batch_lookups import BatchRequestError, batch_queries, parse_batch_request, split_results
+from query_factory import (get_tune_given_name, get_pattern_search_query,
+                           advanced_search, get_most_common_patterns_for_a_tune,
+                           get_tune_data, get_tune_family_members,
+                           get_patterns_in_common_between_two_tunes, get_kg_version,
+                           get_ranked_neighbour_patterns_by_tune,
+                           get_ranked_neighbour_tunes_by_pattern,
+                           get_ranked_neighbour_tunes_by_common_patterns)
+from ranked_lists import PageCursorError, page_offset, page_results
+from resilience import UpstreamUnavailableError
+from results_stream import ResultsReshaper
+from search_pages import SearchPageError, results_page, search_page_params
+from sparql_client import SparqlQueryError
+
+# Queries sent to the SPARQL endpoint at once; further ones wait for a free slot.
+SPARQL_MAX_CONCURRENCY = 50
+
+sparql_client = AsyncSparqlClient(wsgi.BLAZEGRAPH_URL, max_concurrency=SPARQL_MAX_CONCURRENCY,
+                                  connect_timeout=wsgi.SPARQL_CONNECT_TIMEOUT,
+                                  read_timeout=wsgi.SPARQL_READ_TIMEOUT,
+                                  coalesce=wsgi.SPARQL_COALESCE,
+                                  json_loads=wsgi.json_codec.loads,
+                                  metrics=wsgi.metrics,
+                                  guard=wsgi.upstream_guard)
+response_cache = wsgi.response_cache
+http_caching = wsgi.http_caching
+metrics = wsgi.metrics
+
+
+# Serialize like Flask's jsonify, so that both serving modes return the same bytes.
+def jsonify(data, status_code=200):
+    start = time.perf_counter()
+    body = wsgi.json_codec.dumps(data) + b"\n"
+    metrics.observe_phase('encode', time.perf_counter() - start)
+    return Response(body, status_code=status_code, media_type='application/json')
+
+
+async def query_results(sparql_query):
+    if wsgi.RAW_PASSTHROUGH:
+        return Response(await sparql_client.query_raw(sparql_query), media_type='application/json')
+    return jsonify(await sparql_client.query(sparql_query))
+
+
+def cached_view(view):
+    """ResponseCache.cached_view for the coroutine views. Views get the query parameters as a MultiDict."""
+    @functools.wraps(view)
+    async def wrapper(request):
+        args = MultiDict(request.query_params.multi_items())
+        wsgi.record_access(request.url.path, args)
+        key = response_cache.make_key(request.url.path, args)
+        if key[2] is None:
+            return await view(args)
+        body = response_cache.get(key)
+        if body is None and response_cache.refresher is not None:
+            body = response_cache.get_stale(key)
+            if body is not None:
+                loop = asyncio.get_running_loop()
+                response_cache.refresher.submit(
+                    key, lambda: asyncio.run_coroutine_threadsafe(refresh(key, view, request.url.path, args), loop).result())
+        if body is not None:
+            return Response(body, status_code=200, media_type='application/json')
+        try:
+            response = await view(args)
+        except SparqlQueryError:
+            body = response_cache.get_stale(key)
+            if body is None:
+                raise
+            return Response(body, status_code=200, media_type='application/json')
+        if response.status_code == 200:
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = caching_stream(key, response.body_iterator)
+            else:
+                response_cache.put(key, response.body)
+        return response
+    return wrapper
+
+
+async def refresh(key, view, path, args):
+    """ResponseCache.refresh_function for the coroutine views: run on the event loop by a refresh thread."""
+    if response_cache.make_key(path, args) != key:
+        return
+    response = await view(args)
+    if response.status_code != 200:
+        return
+    if isinstance(response, StreamingResponse):
+        async for _ in caching_stream(key, response.body_iterator):
+            pass
+    else:
+        response_cache.put(key, response.body)
+
+
+async def caching_stream(key, chunks):
+    """ResponseCache.caching_stream for the bodies of StreamingResponse."""
+    body = []
+    size = 0
+    try:
+        async for chunk in chunks:
+            yield chunk
+            if body is not None:
+                chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                size += len(chunk)
+                if size > response_cache.max_streamed_bytes:
+                    body = None
+                else:
+                    body.append(chunk)
+        if body is not None:
+            response_cache.put(key, b''.join(body))
+    finally:
+        await chunks.aclose()
+
+
+async def streamed_results(sparql_query):
+    # Start the query here, so that an upstream error gives an error response.
+    chunks = sparql_client.stream(sparql_query)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = b''
+    return StreamingResponse(resumed(first, chunks), media_type='application/json')
+
+
+async def resumed(first, chunks):
+    reshaper = ResultsReshaper(codec=wsgi.json_codec) if wsgi.STREAMING_RESULTS == 'reshape' else None
+    try:
+        piece = first
+        while True:
+            if reshaper is not None:
+                piece = reshaper.feed(piece)
+            if piece:
+                yield piece
+            try:
+                piece = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+        if reshaper is not None:
+            yield reshaper.close()
+    finally:
+        await chunks.aclose()
+
+
+class MetricsMiddleware:
+    """Times every request until its response starts, under its route, and gives it the upstream
+    latency budget of its route, as app.py does."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        route = scope['path'] if scope['path'] in ROUTE_PATHS else 'unmatched'
+        current_route.set(route)
+        current_query.set('')
+        wsgi.upstream_guard.start_request(route)
+        start = time.perf_counter()
+
+        async def timed_send(message):
+            if message['type'] == 'http.response.start':
+                metrics.observe_request(route, time.perf_counter() - start, message['status'])
+            await send(message)
+
+        await self.app(scope, receive, timed_send)
+
+
+class HTTPCachingMiddleware:
+    """Answers 304 to requests whose copy of the response is current, and adds the caching headers
+    to successful responses and compresses them, as app.py does with HTTPCaching."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        route = current_route.get()
+        if scope['type'] != 'http' or not http_caching.compressible(route):
+            return await self.app(scope, receive, send)
+        request_headers = Headers(scope=scope)
+        cache_control = http_caching.policy(scope['method'], route)
+        etag = None
+        if cache_control is not None:
+            args = MultiDict(QueryParams(scope['query_string']).multi_items())
+            etag = http_caching.etag(scope['path'], args)
+            matched = http_caching.not_modified(etag, request_headers.get('if-none-match'),
+                                                request_headers.get('if-modified-since'))
+            if matched is not None:
+                headers = http_caching.headers(cache_control, etag)
+                headers['ETag'] = matched
+                return await Response(status_code=304, headers=headers)(scope, receive, send)
+        accept_encoding = request_headers.get('accept-encoding')
+        start = None
+        compressor = None
+
+        async def finishing_send(message):
+            nonlocal start, compressor
+            if message['type'] == 'http.response.start':
+                if message['status'] != 200:
+                    return await send(message)
+                # Held until the first body message tells whether the body is streamed.
+                start = message
+                return
+            if start is None or message['type'] != 'http.response.body':
+                return await send(message)
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if start is not False:
+                headers = MutableHeaders(scope=start)
+                headers.add_vary_header('Accept-Encoding')
+                if more_body:
+                    encoding = http_caching.encoding(accept_encoding)
+                    if encoding is not None:
+                        compressor = http_caching.compressor(encoding)
+                        del headers['Content-Length']
+                else:
+                    encoding = http_caching.encoding(accept_encoding, len(body))
+                    if encoding is not None:
+                        body = http_caching.compressed(body, encoding, etag)
+                        headers['Content-Length'] = str(len(body))
+                if encoding is not None:
+                    headers['Content-Encoding'] = encoding
+                if cache_control is not None:
+                    headers.update(http_caching.headers(cache_control, etag, encoding))
+                await send(start)
+                start = False
+            if compressor is not None:
+                body = compressor.compress(body)
+                if not more_body:
+                    body += compressor.finish()
+            await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+        await self.app(scope, receive, finishing_send)
+
+
+async def handleSparqlQueryError(request, error):
+    # The client has already logged the failing query and the server response.
+    return jsonify({'error': 'Failed to execute SPARQL query'}, 500)
+
+
+async def handlePageCursorError(request, error):
+    return jsonify({'error': str(error)}, 400)
+
+
+async def handleUpstreamUnavailableError(request, error):
+    response = jsonify({'error': str(error)}, 503)
+    if error.retry_after:
+        response.headers['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+
+async def getMetrics(request):
+    if not metrics.enabled:
+        return jsonify({'error': 'Metrics are disabled.'}, 404)
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@cached_view
+async def search(args):
+    query_params = args.to_dict(flat=False)
+    try:
+        limit, offset = search_page_params(args.get('limit'), args.get('cursor'), max_limit=wsgi.SEARCH_MAX_LIMIT)
+    except SearchPageError as e:
+        return jsonify({'error': str(e)}, 400)
+    with_count = args.get('count') == 'true'
+    search_type = query_params['searchType'][0]
+    sparql_query = ""
+    if search_type == "title":
+        fuzzy_title_matches = await run_in_threadpool(wsgi.title_matches, query_params['searchTerm'][0])
+        if not fuzzy_title_matches:
+            # If there are no matched titles, return an empty response.
+            return jsonify(wsgi.empty_search_response(limit, offset, with_count))
+        sparql_query = get_tune_given_name(fuzzy_title_matches)
+    elif search_type == "pattern":
+        sparql_query = get_pattern_search_query(query_params['searchTerm'][0])
+        if wsgi.STREAMING_RESULTS and limit is None:
+            return await streamed_results(sparql_query)
+    elif search_type == "advanced":
+        matched_tuples = []
+        if query_params['title'][0]:
+            matched_tuples = await run_in_threadpool(wsgi.title_matches, query_params['title'][0])
+        if query_params['title'][0] and not matched_tuples:
+            # If a title is searched for and there are no matched titles, return an empty response.
+            return jsonify(wsgi.empty_search_response(limit, offset, with_count))
+        results = await run_in_threadpool(wsgi.advanced_search_prefilter.search, query_params, matched_tuples)
+        if results is not None:
+            return jsonify(results if limit is None else results_page(results, limit, offset, with_count))
+        sparql_query = advanced_search(query_params, matched_tuples)
+    else:
+        return jsonify({'error': 'Invalid search type.'}, 501)
+    if limit is not None:
+        return jsonify(await run_in_threadpool(wsgi.search_pager.page, sparql_query, limit, offset, with_count))
+    return await query_results(sparql_query)
+
+
+async def suggest(request):
+    args = request.query_params
+    try:
+        limit, _ = search_page_params(args.get('limit', wsgi.SUGGEST_LIMIT), None, max_limit=wsgi.SUGGEST_MAX_LIMIT)
+    except SearchPageError as e:
+        return jsonify({'error': str(e)}, 400)
+    return jsonify(await run_in_threadpool(wsgi.title_suggestions, args.get('searchTerm', ''), limit,
+                                           args.get('fuzzy') != 'false'))
+
+
+async def getFacets(request):
+    return jsonify(await run_in_threadpool(wsgi.facet_registry.get_all))
+
+
+def facet_view(name):
+    async def view(request):
+        # The list is loaded at startup and refreshed when the KG version changes.
+        return jsonify(await run_in_threadpool(wsgi.facet_registry.get, name))
+    return view
+
+
+@cached_view
+async def getPatterns(args):
+    query_params = args.to_dict()
+    if wsgi.incidence_engine.serves('patterns') is None:
+        return await query_results(get_most_common_patterns_for_a_tune(query_params['id'],
+                                                                       query_params['excludeTrivialPatterns']))
+    return jsonify(await most_common_patterns(query_params['id'], query_params['excludeTrivialPatterns']))
+
+
+async def most_common_patterns(tune_id, exclude_trivial_patterns):
+    incidence_index = wsgi.incidence_engine.serves('patterns')
+    if incidence_index is not None:
+        return incidence_index.most_common_patterns(tune_id)
+    return await sparql_client.query(get_most_common_patterns_for_a_tune(tune_id, exclude_trivial_patterns))
+
+
+@cached_view
+async def getCommonPatterns(args):
+    query_params = args.to_dict()
+    return await query_results(
+        get_patterns_in_common_between_two_tunes(query_params['id'], query_params['prev'],
+                                                 query_params['excludeTrivialPatterns']))
+
+
+@cached_view
+async def getNeighbourPatterns(args):
+    query_params = args.to_dict()
+    return jsonify(await neighbour_patterns_page(query_params['id'], query_params['excludeTrivialPatterns'],
+                                                 page_offset(query_params)))
+
+
+async def neighbour_patterns_page(tune_id, exclude_trivial_patterns, offset):
+    incidence_index = wsgi.incidence_engine.serves('neighbour_patterns')
+    if incidence_index is not None:
+        return page_results(incidence_index.ranked_neighbour_patterns(tune_id), offset)
+    return await run_in_threadpool(
+        wsgi.ranked_lists.page, get_ranked_neighbour_patterns_by_tune, (tune_id, exclude_trivial_patterns), offset)
+
+
+@cached_view
+async def getNeighbourTunes(args):
+    query_params = args.to_dict()
+    pattern = query_params['id']
+    incidence_index = wsgi.incidence_engine.serves('neighbour_tunes')
+    if incidence_index is not None:
+        return jsonify(page_results(incidence_index.ranked_neighbour_tunes(pattern), page_offset(query_params)))
+    return jsonify(await run_in_threadpool(
+        wsgi.ranked_lists.page, get_ranked_neighbour_tunes_by_pattern, (pattern,), page_offset(query_params)))
+
+
+@cached_view
+async def getNeighbourTunesByCommonPatterns(args):
+    query_params = args.to_dict()
+    return jsonify(await neighbour_tunes_by_common_patterns_page(query_params['id'], page_offset(query_params)))
+
+
+async def neighbour_tunes_by_common_patterns_page(tune_id, offset):
+    results = wsgi.tune_similarity.page(tune_id, offset)
+    if results is None:
+        results = await run_in_threadpool(
+            wsgi.ranked_lists.page, get_ranked_neighbour_tunes_by_common_patterns, (tune_id,), offset)
+    return results
+
+
+@cached_view
+async def getTuneData(args):
+    return await query_results(get_tune_data(args.to_dict()['id']))
+
+
+@cached_view
+async def getCompositionPage(args):
+    query_params = args.to_dict()
+    tune_id = query_params['id']
+    exclude_trivial_patterns = query_params.get('excludeTrivialPatterns', 'false')
+    names = ('tune_by_id', 'patterns', 'neighbour_patterns', 'neighbour_tunes_by_common_patterns')
+    parts = await asyncio.gather(
+        sparql_client.query(get_tune_data(tune_id)),
+        most_common_patterns(tune_id, exclude_trivial_patterns),
+        neighbour_patterns_page(tune_id, exclude_trivial_patterns, 0),
+        neighbour_tunes_by_common_patterns_page(tune_id, 0))
+    return jsonify(dict(zip(names, parts)))
+
+
+async def getBatch(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    try:
+        lookups = parse_batch_request(body)
+    except BatchRequestError as e:
+        return jsonify({'error': str(e)}, 400)
+    parts = await asyncio.gather(*(batch_lookup(endpoint, ids) for endpoint, ids in lookups.items()))
+    return jsonify(dict(zip(lookups, parts)))
+
+
+async def batch_lookup(endpoint, ids):
+    incidence_index = wsgi.incidence_engine.serves(endpoint)
+    if incidence_index is not None:
+        lookup = incidence_index.most_common_patterns if endpoint == 'patterns' else incidence_index.tunes_by_pattern
+        return {key: lookup(key) for key in ids}
+    queries = list(batch_queries(endpoint, ids))
+    parts = await asyncio.gather(*(sparql_client.query(sparql_query) for sparql_query, _ in queries))
+    results = {}
+    for (_, chunk), part in zip(queries, parts):
+        results.update(split_results(endpoint, part, chunk))
+    return results
+
+
+@cached_view
+async def getTuneFamilyMembers(args):
+    return await query_results(get_tune_family_members(args.to_dict()['family']))
+
+
+@cached_view
+async def getTunesContainingPattern(args):
+    query_params = args.to_dict()
+    incidence_index = wsgi.incidence_engine.serves('tunes_by_pattern')
+    if incidence_index is not None:
+        return jsonify(incidence_index.tunes_by_pattern(query_params['pattern']))
+    sparql_query = get_pattern_search_query(query_params['pattern'])
+    if wsgi.STREAMING_RESULTS:
+        return await streamed_results(sparql_query)
+    return await query_results(sparql_query)
+
+
+@cached_view
+async def getKGVersion(args):
+    return await query_results(get_kg_version())
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await sparql_client.aclose()
+
+
+routes = [
+    Route('/metrics', getMetrics),
+    Route('/api/search', search),
+    Route('/api/suggest', suggest),
+    Route('/api/facets', getFacets),
+    Route('/api/corpus_list', facet_view('corpus')),
+    Route('/api/keys_list', facet_view('key')),
+    Route('/api/time_sig_list', facet_view('timeSignature')),
+    Route('/api/tune_type_list', facet_view('tuneType')),
+    Route('/api/patterns', getPatterns),
+    Route('/api/common_patterns', getCommonPatterns),
+    Route('/api/neighbour_patterns', getNeighbourPatterns),
+    Route('/api/neighbour_tunes', getNeighbourTunes),
+    Route('/api/neighbour_tunes_by_common_patterns', getNeighbourTunesByCommonPatterns),
+    Route('/api/tune_by_id', getTuneData),
+    Route('/api/composition_page', getCompositionPage),
+    Route('/api/batch', getBatch, methods=['POST']),
+    Route('/api/tuneFamilyMembers', getTuneFamilyMembers),
+    Route('/api/tunes_by_pattern', getTunesContainingPattern),
+    Route('/api/kg_version', getKGVersion),
+]
+# Every route is a plain path, so the path of a request is its route label.
+ROUTE_PATHS = {route.path for route in routes}
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(MetricsMiddleware), Middleware(CORSMiddleware, allow_origins=['*']),
+                Middleware(HTTPCachingMiddleware)],
+    exception_handlers={SparqlQueryError: handleSparqlQueryError,
+                        PageCursorError: handlePageCursorError,
+                        UpstreamUnavailableError: handleUpstreamUnavailableError},
+    lifespan=lifespan,
+)
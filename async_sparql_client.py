@@ -0,0 +1,263 @@
+import asyncio
+import json
+import logging
+import time
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from metrics import current_query
+from sparql_client import (ACCEPT_ENCODING, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT,
+                           SparqlQueryError, check_json_content_type)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 50
+# httpcore scans every connection of a pool for every request, so the cost per request grows with the pool
+# size; beyond a few dozen connections the client is CPU bound. Connections are split into pools this small.
+CONNECTIONS_PER_POOL = 10
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines: one task per key, awaited by every caller arriving while it runs
+    (for at most `timeout` seconds, then asyncio.TimeoutError is raised)."""
+
+    def __init__(self, metrics=None):
+        self._in_flight = {}
+        self.metrics = metrics
+        self.calls = 0
+        self.coalesced = 0
+
+    @property
+    def coalescing_ratio(self):
+        return self.coalesced / self.calls if self.calls else 0.0
+
+    async def do(self, key, coroutine_function, timeout=None):
+        self.calls += 1
+        task = self._in_flight.get(key)
+        coalesced = task is not None
+        if coalesced:
+            self.coalesced += 1
+        else:
+            task = self._in_flight[key] = asyncio.ensure_future(coroutine_function())
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        if self.metrics is not None:
+            self.metrics.observe_coalescing(coalesced)
+        # A caller going away, or giving up, must not cancel the query for the others.
+        if coalesced:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        return await asyncio.shield(task)
+
+
+class AsyncSparqlClient:
+    """A non-blocking SparqlClient for the asyncio serving mode.
+
+    At most `max_concurrency` queries are sent to the endpoint at once, over as many
+    keep-alive connections split into small pools; the others wait for a free slot.
+    Failures raise SparqlQueryError like the blocking client, and identical in-flight
+    queries are coalesced with `coalesce`. Results are decoded with `json_loads`, and
+    recorded in `metrics` like SparqlClient does. With `guard`, queries are admitted and
+    hedged like SparqlClient does, the hedge running as a task of its own (holding a slot).
+    """
+
+    def __init__(self, endpoint_url, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 coalesce=True, json_loads=json.loads, metrics=None, guard=None):
+        if httpx is None:
+            raise ValueError("The asynchronous SPARQL client needs the httpx package")
+        self.endpoint_url = endpoint_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.json_loads = json_loads
+        self.metrics = metrics
+        self.guard = guard
+        self.clients = []
+        # One entry per connection: taking an entry bounds the queries in flight, both overall and per pool.
+        self._slots = asyncio.Queue()
+        for start in range(0, max_concurrency, CONNECTIONS_PER_POOL):
+            size = min(CONNECTIONS_PER_POOL, max_concurrency - start)
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+                # Waiting for a connection is bounded by the slots instead.
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None),
+                headers={
+                    'Accept': 'application/sparql-results+json, application/json',
+                    'Accept-Encoding': ACCEPT_ENCODING,
+                })
+            self.clients.append(client)
+            for _ in range(size):
+                self._slots.put_nowait(client)
+        self.single_flight = AsyncSingleFlight(metrics) if coalesce else None
+
+    async def query(self, sparql_query, timeout=None):
+        """Execute a query and return the decoded SPARQL JSON results."""
+        if self.single_flight is None:
+            return await self._query(sparql_query, timeout)
+        return await self._coalesced(sparql_query, sparql_query, lambda: self._query(sparql_query, timeout), timeout)
+
+    async def _coalesced(self, key, sparql_query, coroutine_function, timeout):
+        # Waits for the same query in flight are bounded as in SparqlClient._coalesced.
+        wait_timeout = self.connect_timeout + (self.read_timeout if timeout is None else timeout)
+        if self.guard is not None:
+            wait_timeout = self.guard.within_budget(sparql_query, wait_timeout)
+        try:
+            return await self.single_flight.do(key, coroutine_function, wait_timeout)
+        except asyncio.TimeoutError as e:
+            raise SparqlQueryError("Timed out waiting for the same query in flight", sparql_query) from e
+
+    async def _query(self, sparql_query, timeout):
+        response = await self.post(sparql_query, timeout=timeout)
+        start = time.perf_counter()
+        try:
+            results = self.json_loads(response.content)
+        except ValueError as e:
+            logger.error("Invalid JSON returned for SPARQL query = %s", sparql_query)
+            raise SparqlQueryError("SPARQL endpoint returned invalid JSON", sparql_query,
+                                   response.status_code, response.text) from e
+        if self.metrics is not None:
+            self.metrics.observe_phase('decode', time.perf_counter() - start, current_query.get())
+        return results
+
+    async def query_raw(self, sparql_query, timeout=None):
+        """Execute a query and return the undecoded JSON body of its results (see SparqlClient.query_raw)."""
+        if self.single_flight is None:
+            return await self._query_raw(sparql_query, timeout)
+        return await self._coalesced(('raw', sparql_query), sparql_query,
+                                     lambda: self._query_raw(sparql_query, timeout), timeout)
+
+    async def _query_raw(self, sparql_query, timeout):
+        response = await self.post(sparql_query, timeout=timeout)
+        check_json_content_type(response, sparql_query)
+        return response.content
+
+    async def stream(self, sparql_query, timeout=None):
+        """Execute a query and yield the body of its results as it arrives, in decompressed chunks.
+
+        The query holds its slot until the generator finishes or is closed. Streamed queries
+        are not coalesced nor hedged.
+        """
+        read_timeout = self.read_timeout if timeout is None else timeout
+        if self.guard is not None:
+            read_timeout = self.guard.admit(sparql_query, read_timeout)
+        client = await self._slots.get()
+        try:
+            request = client.build_request(
+                'POST', self.endpoint_url,
+                data={
+                    'query': sparql_query,
+                    'format': 'json'
+                },
+                timeout=httpx.Timeout(read_timeout, connect=self.connect_timeout, pool=None))
+            start = time.perf_counter()
+            try:
+                response = await client.send(request, stream=True)
+            except httpx.HTTPError as e:
+                self._observe(sparql_query, start, 'error')
+                logger.error("Error contacting SPARQL endpoint %s: %s\nQuery = %s",
+                             self.endpoint_url, e, sparql_query)
+                raise SparqlQueryError(f"Unable to reach SPARQL endpoint: {e}", sparql_query) from e
+            self._observe(sparql_query, start, response.status_code)
+            try:
+                if response.status_code != 200:
+                    await response.aread()
+                    logger.error("Error executing SPARQL query (status %s) = %s\n%s",
+                                 response.status_code, sparql_query, response.text)
+                    raise SparqlQueryError("Failed to execute SPARQL query", sparql_query,
+                                           response.status_code, response.text)
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+            except httpx.HTTPError as e:
+                logger.error("Error reading from SPARQL endpoint %s: %s\nQuery = %s",
+                             self.endpoint_url, e, sparql_query)
+                raise SparqlQueryError(f"Unable to read the SPARQL results: {e}", sparql_query) from e
+            finally:
+                await response.aclose()
+        finally:
+            self._slots.put_nowait(client)
+
+    async def post(self, sparql_query, timeout=None):
+        """Send a query to the endpoint and return the successful `httpx.Response`."""
+        read_timeout = self.read_timeout if timeout is None else timeout
+        if self.guard is None:
+            return await self._post(sparql_query, read_timeout)
+        read_timeout = self.guard.admit(sparql_query, read_timeout)
+        delay = self.guard.hedge_delay()
+        if delay is None or delay >= read_timeout:
+            return await self._post(sparql_query, read_timeout)
+        return await self._hedged_post(sparql_query, read_timeout, delay)
+
+    async def _hedged_post(self, sparql_query, read_timeout, delay):
+        start = time.monotonic()
+        tasks = [self._attempt(sparql_query, read_timeout)]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+            first = tasks[0]
+            if done and (first.exception() is None or not self.guard.should_retry(first.exception())):
+                return first.result()
+            remaining = read_timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                # No time is left for a hedge: the first attempt is all there is.
+                return await first
+            self.guard.hedged()
+            tasks.append(self._attempt(sparql_query, remaining))
+            pending.add(tasks[-1])
+            error = first.exception() if done else None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.guard.hedge_won()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The losing attempt, or both when the caller goes away.
+            for task in tasks:
+                task.cancel()
+
+    def _attempt(self, sparql_query, read_timeout):
+        task = asyncio.ensure_future(self._post(sparql_query, read_timeout))
+        # The failure of an attempt that lost is of no interest: retrieve it so that asyncio does not log it.
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return task
+
+    async def _post(self, sparql_query, read_timeout):
+        client = await self._slots.get()
+        start = time.perf_counter()
+        try:
+            response = await client.post(
+                self.endpoint_url,
+                data={
+                    'query': sparql_query,
+                    'format': 'json'
+                },
+                timeout=httpx.Timeout(read_timeout, connect=self.connect_timeout, pool=None)
+            )
+        except httpx.HTTPError as e:
+            self._observe(sparql_query, start, 'error')
+            logger.error("Error contacting SPARQL endpoint %s: %s\nQuery = %s",
+                         self.endpoint_url, e, sparql_query)
+            raise SparqlQueryError(f"Unable to reach SPARQL endpoint: {e}", sparql_query) from e
+        finally:
+            self._slots.put_nowait(client)
+        self._observe(sparql_query, start, response.status_code)
+        if response.status_code != 200:
+            logger.error("Error executing SPARQL query (status %s) = %s\n%s",
+                         response.status_code, sparql_query, response.text)
+            raise SparqlQueryError("Failed to execute SPARQL query", sparql_query,
+                                   response.status_code, response.text)
+        return response
+
+    def _observe(self, sparql_query, start, status):
+        seconds = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics.observe_query(sparql_query, seconds, status)
+        if self.guard is not None:
+            self.guard.record(seconds, status)
+
+    async def aclose(self):
+        for client in self.clients:
+            await client.aclose()
@@ -0,0 +1,54 @@
+from query_factory import (NUM_COMMON_PATTERNS, get_tune_data_batch, get_most_common_patterns_for_tunes,
+                           get_pattern_search_query_batch)
+
+# Ids compiled into one VALUES query; longer batches are sent as several queries.
+MAX_IDS_PER_QUERY = 200
+
+# Endpoints answering batches, named after their /api/ route: the batch query builder, the variable
+# keying its rows, and the number of rows kept per key (None keeps all of them).
+BATCH_ENDPOINTS = {
+    'tune_by_id': (get_tune_data_batch, 'id', None),
+    'patterns': (get_most_common_patterns_for_tunes, 'id', NUM_COMMON_PATTERNS),
+    'tunes_by_pattern': (get_pattern_search_query_batch, 'patternLabel', None),
+}
+
+
+class BatchRequestError(ValueError):
+    """Raised when a batch request is not a mapping of batch endpoints to lists of ids."""
+
+
+# Check a decoded POST /api/batch body, {endpoint: [id, ...]}, and return it with duplicate ids removed.
+def parse_batch_request(body):
+    if not isinstance(body, dict) or not body:
+        raise BatchRequestError("The batch must map endpoints to lists of ids.")
+    lookups = {}
+    for endpoint, ids in body.items():
+        if endpoint not in BATCH_ENDPOINTS:
+            raise BatchRequestError(f"Unknown batch endpoint {endpoint!r}; expected one of "
+                                    f"{', '.join(sorted(BATCH_ENDPOINTS))}.")
+        if not isinstance(ids, list) or not all(isinstance(key, str) for key in ids):
+            raise BatchRequestError(f"The {endpoint} ids must be a list of strings.")
+        lookups[endpoint] = list(dict.fromkeys(ids))
+    return lookups
+
+
+# Yield (sparql_query, ids) for the queries answering the lookups of an endpoint.
+def batch_queries(endpoint, ids):
+    query_builder = BATCH_ENDPOINTS[endpoint][0]
+    for start in range(0, len(ids), MAX_IDS_PER_QUERY):
+        chunk = ids[start:start + MAX_IDS_PER_QUERY]
+        yield query_builder(chunk), chunk
+
+
+# Split the results of a batch query into {id: results}, each shaped as the single-id endpoint returns it.
+def split_results(endpoint, results, ids):
+    key_var, limit = BATCH_ENDPOINTS[endpoint][1:]
+    variables = [var for var in results["head"]["vars"] if var != key_var]
+    split = {key: [] for key in ids}
+    for binding in results["results"]["bindings"]:
+        bindings = split.get(binding.get(key_var, {}).get('value'))
+        if bindings is None or (limit is not None and len(bindings) >= limit):
+            continue
+        bindings.append({var: term for var, term in binding.items() if var != key_var})
+    return {key: {"head": {"vars": list(variables)}, "results": {"bindings": bindings}}
+            for key, bindings in split.items()}
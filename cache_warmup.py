@@ -0,0 +1,138 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAVE_INTERVAL = 300
+# Ids kept in the statistics file, the most requested.
+DEFAULT_MAX_IDS = 10000
+DEFAULT_WARMUP_COUNT = 200
+
+# Whether the requests of the current context are counted: not those of the warm-up itself.
+recording = contextvars.ContextVar('recording', default=True)
+
+
+class AccessStats:
+    """Counts the requests of each tune id, kept across restarts in the JSON file at `path`.
+
+    Counts are added to the file every `save_interval` seconds once `start` is called, and the
+    file keeps the `max_ids` most requested ids. Each process, e.g. each prefork.py worker, adds
+    its own counts to the file; writes are atomic, but a count written by another process between
+    the read and the write of a save is lost.
+    """
+
+    def __init__(self, path, save_interval=DEFAULT_SAVE_INTERVAL, max_ids=DEFAULT_MAX_IDS):
+        self.path = path
+        self.save_interval = save_interval
+        self.max_ids = max_ids
+        self.counts = self.load()
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._started = False
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent saves its own counts, and its saving thread does not run in the child.
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        if self._started:
+            self._started = False
+            self.start()
+
+    def load(self):
+        try:
+            with open(self.path) as stats:
+                return Counter(json.load(stats))
+        except (OSError, ValueError):
+            return Counter()
+
+    def record(self, tune_id):
+        if not recording.get():
+            return
+        with self._lock:
+            self._pending[tune_id] += 1
+
+    def most_common(self, count):
+        with self._lock:
+            counts = self.counts + self._pending
+        return [tune_id for tune_id, _ in counts.most_common(count)]
+
+    def save(self):
+        """Add the counts since the last save to those of the file."""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        counts = self.load() + pending
+        counts = Counter(dict(counts.most_common(self.max_ids)))
+        temporary_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary_path, 'w') as stats:
+                json.dump(counts, stats)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logger.warning("Unable to save the access statistics to %s: %s", self.path, e)
+            with self._lock:
+                self._pending.update(pending)
+            return
+        self.counts = counts
+
+    def start(self):
+        """Save the counts every `save_interval` seconds from a daemon thread."""
+        if not self._started:
+            self._started = True
+            threading.Thread(target=self._save_periodically, name='access-stats', daemon=True).start()
+        return self
+
+    def _save_periodically(self):
+        while True:
+            time.sleep(self.save_interval)
+            if self._pending:
+                self.save()
+
+
+class CacheWarmer:
+    """Requests the `paths` of the `count` most requested tune ids of `access_stats` from the Flask
+    `app`, one at a time, so that their responses are cached before users ask for them.
+
+    `paths` are templates with an `{id}` field. The warm-up stops at the first 503: the endpoint
+    is down. Its requests are not counted in the statistics.
+    """
+
+    def __init__(self, app, access_stats, paths, count=DEFAULT_WARMUP_COUNT):
+        self.app = app
+        self.access_stats = access_stats
+        self.paths = paths
+        self.count = count
+        self.warmed = 0
+
+    def warm(self):
+        recording.set(False)
+        client = self.app.test_client()
+        tune_ids = self.access_stats.most_common(self.count)
+        requests = 0
+        for tune_id in tune_ids:
+            for path in self.paths:
+                status = client.get(path.format(id=quote(tune_id, safe=''))).status_code
+                if status == 503:
+                    logger.warning("SPARQL endpoint unavailable; cache warm-up stopped after %d requests", requests)
+                    return
+                requests += 1
+                self.warmed += 1
+        logger.info("Cache warmed with %d requests for %d tunes", requests, len(tune_ids))
+
+    def collect_metrics(self):
+        """The requests sent so far, for metrics.Metrics.register_collector."""
+        return {('cache_warmup_requests_total', ()): self.warmed}
+
+    def warm_in_background(self, old_version=None, new_version=None):
+        """KGVersionMonitor listener warming the cache of each release, emptied when it changes."""
+        if not self.count or not self.paths:
+            return None
+        thread = threading.Thread(target=self.warm, name='cache-warm-up', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,237 @@
+import logging
+import threading
+from itertools import product
+
+from incidence_index import sparql_results, term_order
+from query_factory import (ADVANCED_SEARCH_FIELD_PATTERNS, get_advanced_search_tune_ids,
+                           get_advanced_search_field_values, get_tune_ids_with_pattern_content)
+from response_cache import LRUCache
+from sparql_client import SparqlQueryError
+
+logger = logging.getLogger(__name__)
+
+XSD_STRING = "http://www.w3.org/2001/XMLSchema#string"
+DEFAULT_MAX_PATTERNS = 1000
+
+# The advanced search parameters filtering on a field, and the variables of its results.
+FILTER_FIELDS = ('corpus', 'tuneType', 'key', 'timeSignature')
+RESULT_VARS = ['title', 'tuneType', 'key', 'signature', 'id']
+# The filtered fields returned with the results, and their variables.
+VALUE_FIELDS = ('tuneType', 'key', 'timeSignature')
+VALUE_VARS = ('tuneType', 'key', 'signature')
+FIELD_VARS = dict(zip(VALUE_FIELDS, VALUE_VARS))
+
+
+def literal(value):
+    return {'type': 'literal', 'value': value}
+
+
+# Whether a term equals the plain literal of its value, as a VALUES ( "value" ) row matches it.
+def is_plain_literal(term):
+    return term['type'] == 'literal' and 'xml:lang' not in term and term.get('datatype', XSD_STRING) == XSD_STRING
+
+
+# An integer with the bits of `slots` set.
+def bitset(slots, size):
+    bits = bytearray((size + 7) // 8)
+    for slot in slots:
+        bits[slot >> 3] |= 1 << (slot & 7)
+    return int.from_bytes(bits, 'little')
+
+
+# Yield the positions of the set bits of an integer, lowest first.
+def set_bits(bits):
+    binary = bin(bits)[:1:-1]
+    position = binary.find('1')
+    while position != -1:
+        yield position
+        position = binary.find('1', position + 1)
+
+
+class FacetIndex:
+    """An in-memory faceted index of the tune metadata the advanced search filters on.
+
+    Tunes get integer slots; `values` holds, per field, each tune's values (SPARQL terms) and
+    `postings`, per filtered field, the bitset (an int) of the tunes having each value. Filters on one field are
+    ORed and filters on different fields ANDed, so the candidates of a search are found with a
+    handful of integer operations. The result rows are sorted once, when the index is built.
+    Answers use the SPARQL JSON results shape of advanced_search.
+    """
+
+    def __init__(self, idsJSON, fieldsJSON):
+        self.ids = []
+        self.slots = {}
+        for item in idsJSON['results']['bindings']:
+            if item['id']['value'] not in self.slots:
+                self.slots[item['id']['value']] = len(self.ids)
+                self.ids.append(item['id'])
+        self.all = (1 << len(self.ids)) - 1
+        self.values = {}
+        self.postings = {}
+        for field, resultsJSON in fieldsJSON.items():
+            values = [[] for _ in self.ids]
+            members = {}
+            for item in resultsJSON['results']['bindings']:
+                slot = self.slots.get(item['id']['value'])
+                if slot is None or item['value'] in values[slot]:
+                    continue
+                values[slot].append(item['value'])
+                if field in FILTER_FIELDS and is_plain_literal(item['value']):
+                    members.setdefault(item['value']['value'], []).append(slot)
+            self.values[field] = values
+            if field in FILTER_FIELDS:
+                self.postings[field] = {value: bitset(slots, len(self.ids)) for value, slots in members.items()}
+        self._sort_rows()
+
+    @classmethod
+    def fetch(cls, sparql_client):
+        """Bulk-load the metadata of every tune from the SPARQL endpoint."""
+        return cls(sparql_client.query(get_advanced_search_tune_ids()),
+                   {field: sparql_client.query(get_advanced_search_field_values(field))
+                    for field in ADVANCED_SEARCH_FIELD_PATTERNS})
+
+    def __len__(self):
+        return len(self.ids)
+
+    def tunes(self, tune_ids):
+        """The bitset of the tunes with the given ids."""
+        return bitset((self.slots[tune_id] for tune_id in tune_ids if tune_id in self.slots), len(self.ids))
+
+    def candidates(self, query_params):
+        """The bitset of the tunes matching the field filters of an advanced search."""
+        candidates = self.all
+        for field in FILTER_FIELDS:
+            if field in query_params:
+                postings = self.postings[field]
+                selected = 0
+                for value in query_params[field]:
+                    selected |= postings.get(value, 0)
+                candidates &= selected
+        return candidates
+
+    def _field_values(self, slot, query_params):
+        """Per returned field, the values of a tune its rows combine (None for an unbound one)."""
+        combined = []
+        for field in VALUE_FIELDS:
+            values = self.values[field][slot]
+            if field in query_params:
+                wanted = set(query_params[field])
+                values = [term for term in values if is_plain_literal(term) and term['value'] in wanted]
+            combined.append(values or [None])
+        return combined
+
+    def _rows(self, slot, titles, query_params):
+        for title, *terms in product(titles, *self._field_values(slot, query_params)):
+            row = {'id': self.ids[slot]}
+            for variable, term in zip(('title', *VALUE_VARS), (title, *terms)):
+                if term is not None:
+                    row[variable] = term
+            yield row
+
+    def _sort_rows(self):
+        """Sort the rows of every tune without filters, which the rows of any search without a
+        title are a subset of, into `rows`, and keep the positions of each tune's rows."""
+        rows = [(slot, row) for slot, titles in enumerate(self.values['title'])
+                for row in self._rows(slot, titles or [None], {})]
+        rows.sort(key=lambda entry: self._row_order(entry[1]))
+        self.rows = [row for _, row in rows]
+        self.slot_rows = [[] for _ in self.ids]
+        for position, (slot, _) in enumerate(rows):
+            self.slot_rows[slot].append(position)
+
+    def search(self, query_params, matched_ids, pattern_tunes=None):
+        """Results of advanced_search(query_params, matched_ids), among the tunes of the
+        `pattern_tunes` bitset when a pattern is searched for."""
+        candidates = self.candidates(query_params)
+        if pattern_tunes is not None:
+            candidates &= pattern_tunes
+        if query_params['title'][0]:
+            # One row per matched (title, strength, id) whose tune has that title, strongest first.
+            ranked = []
+            for title, strength, tune_id in matched_ids:
+                slot = self.slots.get(str(tune_id))
+                title = literal(str(title))
+                if slot is None or not candidates >> slot & 1 or title not in self.values['title'][slot]:
+                    continue
+                ranked.extend((-int(strength), row) for row in self._rows(slot, [title], query_params))
+            ranked.sort(key=lambda entry: (entry[0],) + self._row_order(entry[1]))
+            # DISTINCT keeps one row per title, id and fields, whatever its match strength.
+            rows, seen = [], set()
+            for _, row in ranked:
+                key = self._row_key(row)
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(row)
+        else:
+            positions = [position for slot in set_bits(candidates) for position in self.slot_rows[slot]]
+            positions.sort()
+            rows = [self.rows[position] for position in positions]
+            wanted = {FIELD_VARS[field]: set(query_params[field]) for field in VALUE_FIELDS if field in query_params}
+            if wanted:
+                rows = [row for row in rows
+                        if all(is_plain_literal(row[variable]) and row[variable]['value'] in values
+                               for variable, values in wanted.items())]
+        return sparql_results(RESULT_VARS, rows)
+
+    @staticmethod
+    def _row_order(row):
+        return tuple(term_order(row.get(variable)) for variable in ('title', 'id', *VALUE_VARS))
+
+    @staticmethod
+    def _row_key(row):
+        return tuple(sorted((variable, term['value']) for variable, term in row.items()))
+
+
+class AdvancedSearchPrefilter:
+    """Answers advanced searches from a local FacetIndex, asking the SPARQL endpoint only which
+    tunes contain the searched pattern (not at all without one).
+
+    The tunes of each pattern are kept, up to `max_patterns` of them, until the KG release
+    changes. The index is loaded in the background (see `refresh_in_background`, a
+    KGVersionMonitor listener); until it is available `search` returns None and advanced
+    searches keep going to the SPARQL endpoint.
+    """
+
+    def __init__(self, sparql_client, version_provider, enabled=True, max_patterns=DEFAULT_MAX_PATTERNS):
+        self.sparql_client = sparql_client
+        self.version_provider = version_provider
+        self.enabled = enabled
+        self.index = None
+        self.pattern_ids = LRUCache(max_entries=max_patterns, ttl=None)
+        self._refresh_lock = threading.Lock()
+
+    def tunes_with_pattern(self, pattern):
+        """The ids of the tunes containing a pattern."""
+        key = (pattern, self.version_provider())
+        tune_ids = self.pattern_ids.get(key)
+        if tune_ids is None:
+            resultsJSON = self.sparql_client.query(get_tune_ids_with_pattern_content(pattern))
+            tune_ids = frozenset(item['id']['value'] for item in resultsJSON['results']['bindings'])
+            # Without a known KG release the ids could outlive the data they came from.
+            if key[1] is not None:
+                self.pattern_ids.put(key, tune_ids)
+        return tune_ids
+
+    def search(self, query_params, matched_ids):
+        """Results of advanced_search(query_params, matched_ids), or None before the index is loaded."""
+        index = self.index
+        if index is None:
+            return None
+        pattern = query_params['pattern'][0]
+        pattern_tunes = index.tunes(self.tunes_with_pattern(pattern)) if pattern else None
+        return index.search(query_params, matched_ids, pattern_tunes)
+
+    def refresh_in_background(self, old_version=None, new_version=None):
+        if not self.enabled:
+            return None
+        thread = threading.Thread(target=self._refresh, name='facet-index-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    def _refresh(self):
+        with self._refresh_lock:
+            try:
+                self.index = FacetIndex.fetch(self.sparql_client)
+            except SparqlQueryError:
+                logger.warning("Unable to load the advanced search facet index; keeping the previous one")
+            self.pattern_ids.clear()
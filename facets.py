@@ -0,0 +1,61 @@
+import logging
+import threading
+
+from query_factory import get_corpus_list, get_keys_list, get_time_sig_list, get_tune_type_list
+from sparql_client import SparqlQueryError
+
+logger = logging.getLogger(__name__)
+
+# Facet name (as used by the advanced search parameters) -> (query builder, result variable).
+FACET_QUERIES = {
+    'corpus': (get_corpus_list, 'corpus'),
+    'key': (get_keys_list, 'key'),
+    'timeSignature': (get_time_sig_list, 'signature'),
+    'tuneType': (get_tune_type_list, 'genre'),
+}
+
+
+class FacetRegistry:
+    """Holds the value lists of the advanced search drop-downs in memory.
+
+    The lists only change with a knowledge graph release, so they are fetched once by
+    `load` and refreshed in a background thread by `refresh_in_background`, which is
+    meant to be registered as a KGVersionMonitor listener.
+    """
+
+    def __init__(self, sparql_client):
+        self.sparql_client = sparql_client
+        self.facets = {}
+        self._refresh_lock = threading.Lock()
+
+    def load(self):
+        """Fetch every facet list, replacing the current ones only when all of them succeed."""
+        facets = {}
+        for name, (build_query, variable) in FACET_QUERIES.items():
+            facetJSON = self.sparql_client.query(build_query())
+            facets[name] = [item[variable]['value'] for item in facetJSON['results']['bindings']]
+        self.facets = facets
+        return facets
+
+    def get(self, name):
+        """Return one facet list, loading the lists first if the startup load failed."""
+        if name not in self.facets:
+            with self._refresh_lock:
+                if name not in self.facets:
+                    self.load()
+        return self.facets[name]
+
+    def get_all(self):
+        return {name: self.get(name) for name in FACET_QUERIES}
+
+    def refresh_in_background(self, old_version=None, new_version=None):
+        thread = threading.Thread(target=self._refresh, name='facet-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    def _refresh(self):
+        with self._refresh_lock:
+            try:
+                self.load()
+            except SparqlQueryError:
+                logger.warning("Unable to refresh the advanced search facets; keeping the previous lists")
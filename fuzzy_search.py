@@ -1,41 +1,118 @@
+import logging
+import os
+import threading
+
 from singleton_decorator import singleton
 from query_factory import get_all_tune_names
-import requests
-from fuzzywuzzy import process as fuzzy_process
+from sparql_client import SparqlQueryError
+from title_index import TitleIndex, TitleNames, TitlePrefixIndex
+from title_snapshot import SnapshotError, load_snapshot, save_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+# Return a {id: title} dict of every tune title in the knowledge graph.
+def fetch_names(sparql_client):
+    # Generate the SPARQL query
+    sparql_query = get_all_tune_names()
+    # Execute the SPARQL query
+    try:
+        namesJSON = sparql_client.query(sparql_query)
+    except SparqlQueryError as e:
+        raise ConnectionError(f"Unable to get all composition names from SPARQL endpoint: {sparql_client.endpoint_url}.\n"
+                              f"Server response code: {e.status_code}\n"
+                              f"Server response: {e.response_text}") from e
+
+    return {item['id']['value']: item['title']['value'] for item in namesJSON['results']['bindings']}
 
 
 @singleton
 class FuzzySearch:
-    def __init__(self, blazegraph_url):
-        # Generate the SPARQL query
-        sparql_query = get_all_tune_names()
-        # Execute the SPARQL query
-        response = requests.post(
-            blazegraph_url,
-            data={
-                'query': sparql_query,
-                'format': 'json'
-            }
-        )
-        # Check the response status
-        if response.status_code != 200:
-            raise ConnectionError(f"Unable to get all composition names from SPARQL endpoint: {blazegraph_url}.\n"
-                                  f"Server response code: {response.status_code}\n"
-                                  f"Server response: {response.text}")
-
-        namesJSON = response.json()
-        self.names = {item['id']['value']: item['title']['value'] for item in namesJSON['results']['bindings']}
+    def __init__(self, sparql_client, snapshot_path=None, **index_options):
+        # index_options (scorer, workers, max_candidates) configure the TitleIndex.
+        self.sparql_client = sparql_client
+        self.snapshot_path = snapshot_path
+        self.index_options = index_options
+        # The KG release the index was built from, if known.
+        self.kg_version = None
+        self._rebuild_lock = threading.Lock()
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                # Start from the snapshot, even when the SPARQL endpoint is unreachable.
+                self.index, self.prefix_index, self.kg_version = load_snapshot(snapshot_path, **index_options)
+                self.names = TitleNames(self.index)
+                logger.info("Loaded %d titles from snapshot %s (KG version %s)",
+                            len(self.index), snapshot_path, self.kg_version)
+                return
+            except SnapshotError as e:
+                logger.warning("Ignoring title index snapshot: %s", e)
+        self.names = fetch_names(sparql_client)
+        self.index = TitleIndex.build(self.names, **index_options)
+        self.prefix_index = TitlePrefixIndex.build(self.index.ids, self.index.titles)
 
     def get_title_best_match(self, title, score_cutoff=60, limit=50, retry_till_match=True, max_retries=3):
-        best_matches = fuzzy_process.extractBests(title, self.names,
-                                                  score_cutoff=score_cutoff,
-                                                  limit=limit)
-        if not best_matches and retry_till_match:
-            retry_count = 0
-            while not best_matches and retry_count < max_retries:
-                retry_count += 1
-                score_cutoff /= 2
-                best_matches = fuzzy_process.extractBests(title, self.names,
-                                                          score_cutoff=score_cutoff,
-                                                          limit=limit)
-        return best_matches
+        # Each retry halves score_cutoff; the index answers all of the cutoffs in one pass.
+        return self.index.search(title, score_cutoff=score_cutoff, limit=limit,
+                                 retry_till_match=retry_till_match, max_retries=max_retries)
+
+    def suggest(self, query, limit=10, **fuzzy_options):
+        # Typeahead suggestions from the prefix index: (title, id) pairs, see TitlePrefixIndex.suggest.
+        return self.prefix_index.suggest(query, limit=limit, **fuzzy_options)
+
+    def refresh_in_background(self, old_version, new_version):
+        """KGVersionMonitor listener keeping the index, and its snapshot, on the current release."""
+        if new_version == self.kg_version:
+            return None
+        if self.kg_version is None and old_version is None:
+            # This is the first version check, just after the titles were fetched at startup.
+            self.kg_version = new_version
+            target, args = self.save_snapshot, ()
+        else:
+            target, args = self.rebuild, (new_version,)
+        thread = threading.Thread(target=target, args=args, name='title-index-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    def rebuild(self, kg_version):
+        """Fetch every title again, swap in a new index and save it, tagged with `kg_version`."""
+        with self._rebuild_lock:
+            try:
+                names = fetch_names(self.sparql_client)
+            except ConnectionError:
+                logger.warning("Unable to rebuild the title index; keeping the current one")
+                return
+            index = TitleIndex.build(names, **self.index_options)
+            prefix_index = TitlePrefixIndex.build(index.ids, index.titles)
+            self.index, self.prefix_index = index, prefix_index
+            self.names = names
+            self.kg_version = kg_version
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        try:
+            save_snapshot(self.index, self.prefix_index, self.snapshot_path, self.kg_version)
+        except OSError as e:
+            logger.warning("Unable to save the title index snapshot to %s: %s", self.snapshot_path, e)
+
+    def map_snapshot(self):
+        """Swap the in-memory tables for the memory-mapped ones of the saved snapshot.
+
+        Called before forking worker processes, so that they share the pages of the file
+        instead of each holding a copy of the titles.
+        """
+        if not self.snapshot_path:
+            return False
+        with self._rebuild_lock:
+            try:
+                index, prefix_index, kg_version = load_snapshot(self.snapshot_path, **self.index_options)
+            except SnapshotError as e:
+                logger.warning("Keeping the in-memory title index: %s", e)
+                return False
+            if kg_version != self.kg_version:
+                logger.warning("The title index snapshot is of KG version %s, not %s; keeping the in-memory one",
+                               kg_version, self.kg_version)
+                return False
+            self.index, self.prefix_index, self.names = index, prefix_index, TitleNames(index)
+        return True
@@ -0,0 +1,226 @@
+import hashlib
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
+
+from flask import g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MIN_COMPRESS_BYTES = 1024
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 5
+# Content codings applied to responses, in order of preference.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def accepted_encoding(accept_encoding, encodings=ENCODINGS):
+    """The first of `encodings` an Accept-Encoding header accepts with a non-zero quality, or None."""
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, parameters = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith('q='):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name] = quality
+    for encoding in encodings:
+        if qualities.get(encoding, qualities.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+class StreamCompressor:
+    """Compresses a body given in chunks with one of ENCODINGS."""
+
+    def __init__(self, encoding, gzip_level=DEFAULT_GZIP_LEVEL, brotli_quality=DEFAULT_BROTLI_QUALITY):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=brotli_quality)
+            self.compress, self._finish = compressor.process, compressor.finish
+        else:
+            # wbits 31: a gzip header and trailer around the deflate stream.
+            compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self.compress, self._finish = compressor.compress, compressor.flush
+
+    def finish(self):
+        return self._finish()
+
+
+class HTTPCaching:
+    """HTTP validators, Cache-Control and compression of the API responses.
+
+    GET routes with a `cache_control` policy get a strong ETag, derived from the cache key
+    `make_key` gives the request (see ResponseCache.make_key): as every response is a function
+    of its parameters and the knowledge graph release, a request whose If-None-Match holds the
+    current ETag is answered 304 before the view runs, without touching the endpoint. They also
+    get the time the release was first seen (`last_changed`) as Last-Modified, for If-Modified-Since.
+    Nothing is validated while the release is unknown.
+
+    Bodies of `min_compress_bytes` or more of the /api/* routes are compressed with the preferred
+    encoding the client accepts, streamed bodies chunk by chunk. Each compressed variant gets an
+    ETag of its own, and the variants of the responses with an ETag are kept in `variants` (an
+    LRUCache keyed on ETag and encoding) rather than compressed for every request.
+    """
+
+    def __init__(self, make_key, last_changed, cache_control, min_compress_bytes=DEFAULT_MIN_COMPRESS_BYTES,
+                 gzip_level=DEFAULT_GZIP_LEVEL, brotli_quality=DEFAULT_BROTLI_QUALITY, variants=None):
+        self.make_key = make_key
+        self.last_changed = last_changed
+        self.cache_control = cache_control
+        self.min_compress_bytes = min_compress_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.variants = variants
+        self._last_modified = (None, None)
+
+    def invalidate(self, old_version=None, new_version=None):
+        if self.variants is not None:
+            self.variants.clear()
+
+    @staticmethod
+    def compressible(route):
+        return route.startswith('/api/')
+
+    def policy(self, method, route):
+        """The Cache-Control of a request, None if its response is not validated."""
+        return self.cache_control.get(route) if method == 'GET' else None
+
+    def etag(self, path, params):
+        key = self.make_key(path, params)
+        if key[2] is None:
+            return None
+        return '"' + hashlib.blake2b(repr(key).encode('utf-8'), digest_size=12).hexdigest() + '"'
+
+    @staticmethod
+    def variant_etag(etag, encoding):
+        return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+    def last_modified(self):
+        changed_at = self.last_changed()
+        if changed_at is None:
+            return None
+        # Formatted once per release.
+        formatted_at, formatted = self._last_modified
+        if formatted_at != changed_at:
+            formatted = formatdate(changed_at, usegmt=True)
+            self._last_modified = (changed_at, formatted)
+        return formatted
+
+    def not_modified(self, etag, if_none_match, if_modified_since):
+        """The ETag to answer 304 with, if the client's copy is current (If-None-Match taking
+        precedence over If-Modified-Since), else None."""
+        if etag is None:
+            return None
+        if if_none_match:
+            if if_none_match.strip() == '*':
+                return etag
+            # Weak comparison: a W/ prefix is ignored.
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            for tag in [etag] + [self.variant_etag(etag, encoding) for encoding in ENCODINGS]:
+                if tag in tags:
+                    return tag
+            return None
+        changed_at = self.last_changed()
+        if if_modified_since and changed_at is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return None
+            if int(changed_at) <= since:
+                return etag
+        return None
+
+    def headers(self, cache_control, etag, encoding=None):
+        """The caching headers of a response (of its `encoding` variant)."""
+        headers = {'Cache-Control': cache_control}
+        if etag is not None:
+            headers['ETag'] = self.variant_etag(etag, encoding)
+            last_modified = self.last_modified()
+            if last_modified is not None:
+                headers['Last-Modified'] = last_modified
+        return headers
+
+    def encoding(self, accept_encoding, size=None):
+        """The encoding of a body of `size` bytes (None when streamed), None to send it as it is."""
+        if size is not None and size < self.min_compress_bytes:
+            return None
+        return accepted_encoding(accept_encoding)
+
+    def compressor(self, encoding):
+        return StreamCompressor(encoding, self.gzip_level, self.brotli_quality)
+
+    def compressed(self, body, encoding, etag=None):
+        """The `encoding` variant of a body, kept in `variants` when the body has an ETag."""
+        if etag is None or self.variants is None:
+            return self.compress(body, encoding)
+        key = (etag, encoding)
+        variant = self.variants.get(key)
+        if variant is None:
+            variant = self.compress(body, encoding)
+            self.variants.put(key, variant)
+        return variant
+
+    def compress(self, body, encoding):
+        compressor = self.compressor(encoding)
+        return compressor.compress(body) + compressor.finish()
+
+    def compressed_chunks(self, chunks, encoding):
+        compressor = self.compressor(encoding)
+        try:
+            for chunk in chunks:
+                chunk = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+                if chunk:
+                    yield chunk
+            yield compressor.finish()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def check_not_modified(self, route):
+        """Flask before_request hook: answer 304 when the client's copy of the response is current."""
+        cache_control = self.policy(request.method, route)
+        if cache_control is None:
+            return None
+        etag = g.etag = self.etag(request.path, request.args)
+        matched = self.not_modified(etag, request.headers.get('If-None-Match'),
+                                    request.headers.get('If-Modified-Since'))
+        if matched is None:
+            return None
+        headers = self.headers(cache_control, etag)
+        headers['ETag'] = matched
+        return '', 304, headers
+
+    def finish_response(self, response, route):
+        """Flask after_request hook: add the caching headers to a successful response and compress it."""
+        if response.status_code != 200 or not self.compressible(route):
+            return response
+        cache_control = self.policy(request.method, route)
+        etag = g.get('etag') if cache_control is not None else None
+        headers = response.headers
+        vary = headers.get('Vary')
+        headers['Vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+        if response.is_streamed:
+            encoding = self.encoding(request.headers.get('Accept-Encoding'))
+            if encoding is not None:
+                response.response = self.compressed_chunks(response.response, encoding)
+                headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            encoding = self.encoding(request.headers.get('Accept-Encoding'), len(body))
+            if encoding is not None:
+                response.set_data(self.compressed(body, encoding, etag))
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        if cache_control is not None:
+            for name, value in self.headers(cache_control, etag, encoding).items():
+                headers[name] = value
+        return response
@@ -0,0 +1,195 @@
+import logging
+import threading
+from array import array
+
+from query_factory import (NUM_COMMON_PATTERNS, get_tune_pattern_incidence, get_pattern_labels,
+                           get_tune_metadata)
+from sparql_client import SparqlQueryError
+
+logger = logging.getLogger(__name__)
+
+TUNE_BASE_IRI = "http://w3id.org/polifonia/harmory/"
+INTEGER_DATATYPE = "http://www.w3.org/2001/XMLSchema#integer"
+
+# Endpoints the local engine can answer, named after their /api/ route.
+# (/api/common_patterns reads the JAMS observations rather than the segments, so it is not one.)
+LOCAL_ENDPOINTS = ('patterns', 'neighbour_patterns', 'neighbour_tunes', 'tunes_by_pattern')
+
+
+def sparql_results(variables, bindings):
+    return {"head": {"vars": list(variables)}, "results": {"bindings": bindings}}
+
+
+# Sort key placing unbound values first and comparing bound ones by their lexical value, like ORDER BY.
+def term_order(term):
+    return (0, '') if term is None else (1, term['value'])
+
+
+# Build CSR rows from {row: {column: count}}: offsets, column ids and counts, each row sorted by `row_order`.
+def compressed_rows(rows, size, row_order):
+    offsets = array('I', [0])
+    columns = array('I')
+    counts = array('I')
+    for row in range(size):
+        entries = sorted(rows.get(row, {}).items(), key=row_order)
+        columns.extend(column for column, _ in entries)
+        counts.extend(count for _, count in entries)
+        offsets.append(len(columns))
+    return offsets, columns, counts
+
+
+class IncidenceIndex:
+    """An in-memory tune <-> pattern incidence graph answering the composition page queries.
+
+    Tunes and patterns get integer ids; `tune_offsets`/`tune_patterns`/`tune_pattern_counts`
+    hold, per tune, its patterns and the number of segments with each (most frequent first),
+    and `pattern_offsets`/`pattern_tunes`/`pattern_tune_counts` the reverse. Answers use the
+    SPARQL JSON results shape of the corresponding query_factory queries.
+    """
+
+    def __init__(self, incidenceJSON, labelsJSON, metadataJSON):
+        self.tune_iris = []
+        self.tune_slots = {}
+        self.pattern_iris = []
+        self.pattern_slots = {}
+        tune_rows, pattern_rows = {}, {}
+        for item in incidenceJSON['results']['bindings']:
+            tune = self._slot(item['tune']['value'], self.tune_iris, self.tune_slots)
+            pattern = self._slot(item['pattern']['value'], self.pattern_iris, self.pattern_slots)
+            count = int(item['count']['value'])
+            tune_rows.setdefault(tune, {})[pattern] = count
+            pattern_rows.setdefault(pattern, {})[tune] = count
+
+        # Pattern labels and the titles, genres and artists of tunes typed as musical works.
+        self.label_patterns = {}
+        for item in labelsJSON['results']['bindings']:
+            pattern = self.pattern_slots.get(item['pattern']['value'])
+            if pattern is not None:
+                self.label_patterns.setdefault(item['label']['value'], []).append(pattern)
+        self.metadata = {}
+        for item in metadataJSON['results']['bindings']:
+            tune = self._slot(item['tune']['value'], self.tune_iris, self.tune_slots)
+            terms = self.metadata.setdefault(tune, {'title': [], 'genre': [], 'artist': []})
+            for variable, values in terms.items():
+                if variable in item and item[variable] not in values:
+                    values.append(item[variable])
+
+        self.tune_offsets, self.tune_patterns, self.tune_pattern_counts = compressed_rows(
+            tune_rows, len(self.tune_iris),
+            lambda entry: (-entry[1], self.pattern_iris[entry[0]]))
+        self.pattern_offsets, self.pattern_tunes, self.pattern_tune_counts = compressed_rows(
+            pattern_rows, len(self.pattern_iris),
+            lambda entry: (-entry[1], self._first_title(entry[0]), self.tune_id(entry[0])))
+
+    @classmethod
+    def fetch(cls, sparql_client):
+        """Bulk-load the incidence data from the SPARQL endpoint."""
+        return cls(sparql_client.query(get_tune_pattern_incidence()),
+                   sparql_client.query(get_pattern_labels()),
+                   sparql_client.query(get_tune_metadata()))
+
+    @staticmethod
+    def _slot(iri, iris, slots):
+        slot = slots.get(iri)
+        if slot is None:
+            slot = slots[iri] = len(iris)
+            iris.append(iri)
+        return slot
+
+    def tune_id(self, tune):
+        iri = self.tune_iris[tune]
+        return iri[len(TUNE_BASE_IRI):] if iri.startswith(TUNE_BASE_IRI) else ""
+
+    def _first_title(self, tune):
+        titles = self.metadata.get(tune, {}).get('title')
+        return titles[0]['value'] if titles else ''
+
+    def tune_row(self, tune_id):
+        """(pattern, count) pairs of a tune, most frequent first."""
+        tune = self.tune_slots.get(TUNE_BASE_IRI + tune_id)
+        if tune is None:
+            return []
+        start, end = self.tune_offsets[tune], self.tune_offsets[tune + 1]
+        return list(zip(self.tune_patterns[start:end], self.tune_pattern_counts[start:end]))
+
+    def pattern_row(self, label):
+        """(tune, count) pairs of the musical works containing the patterns with a label."""
+        counts = {}
+        for pattern in self.label_patterns.get(label, ()):
+            start, end = self.pattern_offsets[pattern], self.pattern_offsets[pattern + 1]
+            for tune, count in zip(self.pattern_tunes[start:end], self.pattern_tune_counts[start:end]):
+                if tune in self.metadata:
+                    counts[tune] = counts.get(tune, 0) + count
+        return counts.items()
+
+    def tune_rows(self, tune, variables):
+        """Bindings for every combination of the tune's values of `variables` (as OPTIONAL joins give)."""
+        rows = [{'id': {'type': 'literal', 'value': self.tune_id(tune)}}]
+        terms = self.metadata[tune]
+        for variable in variables:
+            values = terms[variable]
+            if values:
+                rows = [dict(row, **{variable: value}) for row in rows for value in values]
+        return rows
+
+    def most_common_patterns(self, tune_id):
+        """Results of get_most_common_patterns_for_a_tune."""
+        bindings = [{'pattern': {'type': 'uri', 'value': self.pattern_iris[pattern]},
+                     'patternFreq': {'datatype': INTEGER_DATATYPE, 'type': 'literal', 'value': str(count)}}
+                    for pattern, count in self.tune_row(tune_id)[:NUM_COMMON_PATTERNS]]
+        return sparql_results(['pattern', 'patternFreq'], bindings)
+
+    def ranked_neighbour_patterns(self, tune_id):
+        """Results of get_ranked_neighbour_patterns_by_tune."""
+        bindings = [{'pattern': {'type': 'uri', 'value': self.pattern_iris[pattern]}}
+                    for pattern, _ in self.tune_row(tune_id)]
+        return sparql_results(['pattern'], bindings)
+
+    def ranked_neighbour_tunes(self, label):
+        """Results of get_ranked_neighbour_tunes_by_pattern."""
+        rows = [(count, row) for tune, count in self.pattern_row(label)
+                for row in self.tune_rows(tune, ('title', 'genre'))]
+        rows.sort(key=lambda entry: (-entry[0], term_order(entry[1].get('title')), entry[1]['id']['value']))
+        return sparql_results(['title', 'id', 'genre'], [row for _, row in rows])
+
+    def tunes_by_pattern(self, label):
+        """Results of get_pattern_search_query: one row per segment containing the pattern."""
+        rows = [row for tune, count in self.pattern_row(label)
+                for row in self.tune_rows(tune, ('title', 'genre', 'artist')) for _ in range(count)]
+        rows.sort(key=lambda row: (term_order(row.get('title')), row['id']['value']))
+        return sparql_results(['title', 'genre', 'artist', 'id'], rows)
+
+
+class IncidenceEngine:
+    """Routes the endpoints in `routes` to a local IncidenceIndex instead of the SPARQL endpoint.
+
+    The index is loaded in the background (see `refresh_in_background`, a KGVersionMonitor
+    listener); until it is available every endpoint keeps going to the SPARQL endpoint.
+    """
+
+    def __init__(self, sparql_client, routes=()):
+        unknown = set(routes) - set(LOCAL_ENDPOINTS)
+        if unknown:
+            raise ValueError(f"The local engine cannot answer {', '.join(sorted(unknown))}")
+        self.sparql_client = sparql_client
+        self.routes = frozenset(routes)
+        self.index = None
+        self._refresh_lock = threading.Lock()
+
+    def serves(self, endpoint):
+        """The index to answer `endpoint` with, or None to query the SPARQL endpoint."""
+        return self.index if endpoint in self.routes else None
+
+    def refresh_in_background(self, old_version=None, new_version=None):
+        if not self.routes:
+            return None
+        thread = threading.Thread(target=self._refresh, name='incidence-index-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    def _refresh(self):
+        with self._refresh_lock:
+            try:
+                self.index = IncidenceIndex.fetch(self.sparql_client)
+            except SparqlQueryError:
+                logger.warning("Unable to load the tune-pattern incidence index; keeping the previous one")
@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+
+from query_factory import get_kg_version
+from sparql_client import SparqlQueryError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECK_INTERVAL = 60
+
+
+class KGVersionMonitor:
+    """Tracks the knowledge graph release (`jams:release`) reported by the SPARQL endpoint.
+
+    The release is polled from a background thread every `check_interval` seconds so that
+    request handlers can read it for free; the first check is made by that thread too, so that
+    starting the monitor never waits on the endpoint. Callbacks registered with `on_change` are called
+    with (old_version, new_version) whenever the release changes, and `last_changed` is the
+    time at which the current release was first seen.
+    """
+
+    def __init__(self, sparql_client, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.sparql_client = sparql_client
+        self.check_interval = check_interval
+        self.version = None
+        self.changed_at = None
+        self._listeners = []
+        self._refreshes = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._first_check = threading.Event()
+        self._thread = None
+
+    def current(self):
+        return self.version
+
+    def last_changed(self):
+        return self.changed_at
+
+    def on_change(self, callback):
+        self._listeners.append(callback)
+        return callback
+
+    def check(self):
+        """Query the endpoint for the release now and notify listeners if it changed."""
+        try:
+            versionJSON = self.sparql_client.query(get_kg_version())
+        except SparqlQueryError:
+            logger.warning("Unable to check the knowledge graph version; keeping %s", self.version)
+            return self.version
+        # The release is normally a single value, but join them all in case there are several.
+        version = '|'.join(sorted(item['version']['value'] for item in versionJSON['results']['bindings']))
+        with self._lock:
+            old_version, self.version = self.version, version
+            if old_version != version:
+                self.changed_at = time.time()
+        if old_version != version:
+            logger.info("Knowledge graph version changed from %s to %s", old_version, version)
+            for callback in self._listeners:
+                try:
+                    refresh = callback(old_version, version)
+                    if isinstance(refresh, threading.Thread):
+                        self._refreshes.append(refresh)
+                except Exception:
+                    logger.exception("KG version listener %r failed", callback)
+        return version
+
+    def wait_for_refreshes(self, timeout=None):
+        """Wait for the first check of a started monitor and the background refreshes started by the
+        listeners; return whether they all finished."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._thread is not None and not self._first_check.wait(timeout):
+            return False
+        while self._refreshes:
+            refresh = self._refreshes[0]
+            refresh.join(None if deadline is None else max(0, deadline - time.monotonic()))
+            if refresh.is_alive():
+                return False
+            self._refreshes.remove(refresh)
+        return True
+
+    def start(self):
+        """Check the version, and keep polling it, from a daemon thread."""
+        if self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._poll, name='kg-version-monitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=False):
+        """Stop polling; with `wait`, also wait for a check in progress to finish."""
+        self._stopped.set()
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _poll(self):
+        self.check()
+        self._first_check.set()
+        while not self._stopped.wait(self.check_interval):
+            self.check()
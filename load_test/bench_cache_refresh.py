@@ -0,0 +1,116 @@
+# Measure what the first request after a response cache expiry costs, with and without
+# stale-while-revalidate (ResponseCache with a BackgroundRefresher), and the response cache hit
+# ratio of a cold start with and without the warm-up from the access statistics (cache_warmup.py).
+#
+# Run from the repository root with:
+#     python -m load_test.bench_cache_refresh --tunes 100 --latency 0.1
+#
+# The app runs in process against the stub endpoint serving a synthetic knowledge graph with
+# --latency seconds per query. Composition pages of --tunes tunes are cached, left to expire
+# (--ttl) and requested again. For the warm-up, --requests composition pages are drawn with a
+# Zipf-like popularity over all the tunes: the first half is counted in the access statistics, and
+# the second half is replayed against a cache emptied (as at startup) and against the warmed cache.
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from cache_warmup import AccessStats, CacheWarmer
+from load_test.bench_suite import settle
+from load_test.sparql_stub import StubSparqlServer
+from load_test.synthetic_kg import SyntheticKG
+
+PAGE = '/api/composition_page?id={id}&excludeTrivialPatterns=false'
+
+
+def timed_requests(client, paths):
+    seconds = []
+    for path in paths:
+        start = time.perf_counter()
+        assert client.get(path).status_code == 200
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def wait_for_refreshes(refresher, count, timeout=120):
+    deadline = time.monotonic() + timeout
+    while refresher.refreshed + refresher.failed + refresher.dropped < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def report(name, seconds):
+    print(f"  {name:<34} p50 {statistics.median(seconds) * 1000:8.1f} ms  max {max(seconds) * 1000:8.1f} ms")
+
+
+def hit_ratio(cache, client, paths):
+    hits = cache.hits
+    timed_requests(client, paths)
+    return (cache.hits - hits) / len(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stale-while-revalidate and cache warm-up.")
+    parser.add_argument('--tunes', type=int, default=100, help="Composition pages cached and left to expire.")
+    parser.add_argument('--latency', type=float, default=0.1, help="Seconds the stub takes to answer a query.")
+    parser.add_argument('--ttl', type=float, default=1.0, help="Seconds the responses stay fresh in the cache.")
+    parser.add_argument('--requests', type=int, default=2000, help="Composition pages drawn for the warm-up.")
+    parser.add_argument('--warmup-tunes', type=int, default=200, help="Tunes warmed (CACHE_WARMUP_TUNES).")
+    args = parser.parse_args()
+
+    kg = SyntheticKG()
+    stub = StubSparqlServer(responder=kg).start()
+    directory = tempfile.mkdtemp()
+    os.environ.update(BLAZEGRAPH_URL=stub.url,
+                      TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+                      TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+                      ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+    import app
+    app.kg_version_monitor.wait_for_refreshes()
+    settle(stub)
+    stub.latency = args.latency
+    cache, refresher = app.response_cache, app.response_cache.refresher
+    cache.ttl = args.ttl
+    client = app.app.test_client()
+    ids = iter(kg.tune_ids)
+
+    try:
+        print(f"First request after expiry ({args.tunes} composition pages, {args.latency * 1000:.0f} ms per query)")
+        for name, with_refresher in (("without refresh", False), ("stale-while-revalidate", True)):
+            cache.refresher = refresher if with_refresher else None
+            paths = [PAGE.format(id=next(ids)) for _ in range(args.tunes)]
+            report("cold", timed_requests(client, paths))
+            time.sleep(args.ttl)
+            refreshed = refresher.refreshed + refresher.failed + refresher.dropped
+            report(f"expired, {name}", timed_requests(client, paths))
+            if with_refresher:
+                wait_for_refreshes(refresher, refreshed + args.tunes)
+                print(f"  refreshed in the background {refresher.refreshed}, failed {refresher.failed}, "
+                      f"dropped {refresher.dropped}")
+
+        cache.ttl = app.RESPONSE_CACHE_TTL
+        rng = random.Random(0)
+        weights = [1 / (rank + 1) for rank in range(len(kg.tune_ids))]
+        drawn = rng.choices(kg.tune_ids, weights=weights, k=args.requests)
+        stats = AccessStats(os.path.join(directory, 'bench_access_stats.json'))
+        for tune_id in drawn[:len(drawn) // 2]:
+            stats.record(tune_id)
+        stats.save()
+        replay = [PAGE.format(id=tune_id) for tune_id in drawn[len(drawn) // 2:]]
+        print(f"Cold start hit ratio ({len(replay)} composition pages, {args.warmup_tunes} tunes warmed)")
+        cache.clear()
+        print(f"  {'without warm-up':<34} {hit_ratio(cache, client, replay):.2f}")
+        cache.clear()
+        warmer = CacheWarmer(app.app, stats, [PAGE], count=args.warmup_tunes)
+        start = time.perf_counter()
+        warmer.warm()
+        print(f"  {'warm-up':<34} {warmer.warmed} requests in {time.perf_counter() - start:.1f} s")
+        print(f"  {'with warm-up':<34} {hit_ratio(cache, client, replay):.2f}")
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
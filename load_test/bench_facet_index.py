@@ -0,0 +1,55 @@
+# Time the advanced search facet index over synthetic tune metadata: loading it, finding the
+# candidates of a search with its bitsets, and building the complete results.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_facet_index --tunes 50000
+
+import argparse
+import random
+import time
+
+from facet_index import FacetIndex, set_bits
+from load_test.synthetic import make_tune_metadata
+
+SEARCHES = {
+    "one key": {'key': ["D"]},
+    "corpus + type": {'corpus': ["Irish"], 'tuneType': ["reel", "jig"]},
+    "all four facets": {'corpus': ["Irish", "Scottish"], 'tuneType': ["hornpipe"], 'key': ["G"],
+                        'timeSignature': ["4/4"]},
+    "rare values": {'corpus': ["Cape Breton"], 'key': ["Ador"]},
+    "no filter": {},
+}
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Advanced search facet index benchmark.")
+    parser.add_argument('--tunes', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    idsJSON, fieldsJSON = make_tune_metadata(args.tunes)
+    index, seconds = timed(lambda: FacetIndex(idsJSON, fieldsJSON), 1)
+    print(f"{len(index)} tunes indexed in {seconds * 1000:.0f} ms")
+
+    rng = random.Random(1)
+    pattern_tunes = index.tunes(rng.sample([item['id']['value'] for item in idsJSON['results']['bindings']],
+                                           args.tunes // 20))
+    print(f"{'search':<18} {'candidates':>10} {'bitsets':>10} {'+ pattern':>10} {'results':>10}")
+    for name, filters in SEARCHES.items():
+        query_params = dict(filters, pattern=[""], title=[""])
+        candidates, filter_time = timed(lambda: index.candidates(query_params), args.repeat)
+        _, pattern_time = timed(lambda: index.search(query_params, [], pattern_tunes), args.repeat)
+        _, search_time = timed(lambda: index.search(query_params, []), max(1, args.repeat // 10))
+        print(f"{name:<18} {sum(1 for _ in set_bits(candidates)):>10} {filter_time * 1e6:>8.0f}us "
+              f"{pattern_time * 1e3:>8.1f}ms {search_time * 1e3:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Measure what HTTP caching and compression (http_caching.py) save on the API responses: the bytes
+# of each response body sent as it is and compressed with each encoding, and the time per request
+# of a 200 from the response cache, as it is and compressed (first compression and cached
+# compressed variant), and of a 304 revalidation.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_http_cache --requests 500
+#
+# The app runs in process against the stub endpoint serving a synthetic knowledge graph of --tunes
+# tunes; every path is requested once before it is timed, so that its response is cached.
+
+import argparse
+import os
+import tempfile
+import time
+
+from http_caching import ENCODINGS
+from load_test.bench_suite import settle
+from load_test.sparql_stub import StubSparqlServer
+from load_test.synthetic_kg import SyntheticKG
+
+
+def paths(kg):
+    tune_id = kg.tune_ids[0]
+    return [f'/api/composition_page?id={tune_id}&excludeTrivialPatterns=false',
+            f'/api/patterns?id={tune_id}&excludeTrivialPatterns=false',
+            '/api/search?searchType=title&searchTerm=a',
+            '/api/facets']
+
+
+def per_request(client, path, requests, headers, expected_status):
+    start = time.perf_counter()
+    for _ in range(requests):
+        assert client.get(path, headers=headers).status_code == expected_status
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ETag revalidation and compression of API responses.")
+    parser.add_argument('--requests', type=int, default=500, help="Requests per path and configuration.")
+    parser.add_argument('--tunes', type=int, default=2000)
+    args = parser.parse_args()
+
+    kg = SyntheticKG(tunes=args.tunes)
+    stub = StubSparqlServer(responder=kg).start()
+    directory = tempfile.mkdtemp()
+    os.environ.update(BLAZEGRAPH_URL=stub.url,
+                      TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+                      TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+                      ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+    import app
+    app.kg_version_monitor.wait_for_refreshes()
+    settle(stub)
+    client = app.app.test_client()
+
+    try:
+        for path in paths(kg):
+            response = client.get(path)
+            sizes = [f"identity {len(response.data)} B"]
+            for encoding in ENCODINGS:
+                compressed = client.get(path, headers={'Accept-Encoding': encoding})
+                sizes.append(f"{encoding} {len(compressed.data)} B")
+            print(f"{path}\n  {'  '.join(sizes)}")
+            timings = [("200", {}, 200)]
+            for encoding in ENCODINGS:
+                app.http_caching.variants.clear()
+                first = per_request(client, path, 1, {'Accept-Encoding': encoding}, 200)
+                print(f"  {'200 ' + encoding + ', compressed':<24} {first * 1e6:8.0f} us")
+                timings.append((f"200 {encoding}, cached", {'Accept-Encoding': encoding}, 200))
+            timings.append(("304", {'If-None-Match': response.headers['ETag']}, 304))
+            for name, headers, status in timings:
+                print(f"  {name:<24} {per_request(client, path, args.requests, headers, status) * 1e6:8.0f} us")
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
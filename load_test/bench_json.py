@@ -0,0 +1,87 @@
+# Measure the CPU time the Flask app spends per request with each JSON configuration: decoding
+# the SPARQL results and re-encoding them with the standard library (as before), with orjson, and
+# forwarding untransformed results as raw bytes.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_json --requests 500 --rows 500
+#
+# The stub endpoint runs in a thread of its own, and only the CPU time of the thread sending the
+# requests is counted. Every request has new parameters, so none is answered by the response cache.
+
+import argparse
+import os
+import re
+import tempfile
+import time
+
+from json_codecs import CodecJSONProvider, make_codec
+from load_test.sparql_stub import StubSparqlServer, empty_results
+from load_test.synthetic import literal
+
+
+def make_responder(rows):
+    def tune_row(tune_id):
+        return {'title': literal(f"Tune {tune_id} é"), 'genre': literal("reel"), 'artist': literal("Unknown")}
+
+    def responder(sparql_query):
+        results = empty_results(sparql_query)
+        bindings = results['results']['bindings']
+        values = re.search(r'VALUES \?id \{(.*?)\}', sparql_query)
+        if values:
+            bindings.extend(dict(tune_row(tune_id), id=literal(tune_id))
+                            for tune_id in re.findall(r'"([^"]*)"', values.group(1)))
+        elif 'tuneFamilyName' in sparql_query:
+            bindings.extend({'title': literal(f"Tune {n} é"), 'id': literal(f"tune_{n}"), 'type': literal("reel")}
+                            for n in range(rows))
+        elif 'hasTitle ?title' in sparql_query and 'BIND(IRI' in sparql_query:
+            bindings.append(tune_row("1"))
+        return results
+    return responder
+
+
+def configure(app, codec_name, raw_passthrough):
+    app.json_codec = make_codec(codec_name)
+    app.app.json = CodecJSONProvider(app.app, app.json_codec)
+    app.sparql_client.json_loads = app.json_codec.loads
+    app.RAW_PASSTHROUGH = raw_passthrough
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON decoding and encoding CPU time per request.")
+    parser.add_argument('--requests', type=int, default=500, help="Requests per endpoint and configuration.")
+    parser.add_argument('--rows', type=int, default=500, help="Rows of the tune family and batch results.")
+    args = parser.parse_args()
+
+    server = StubSparqlServer(responder=make_responder(args.rows)).start()
+    directory = tempfile.mkdtemp()
+    os.environ.update(BLAZEGRAPH_URL=server.url,
+                      TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+                      TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+                      ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+    import app
+    client = app.app.test_client()
+    endpoints = [
+        ("tune_by_id", lambda n: client.get(f'/api/tune_by_id?id=tune_{n}')),
+        (f"tuneFamilyMembers ({args.rows} rows)", lambda n: client.get(f'/api/tuneFamilyMembers?family=f{n}')),
+        (f"batch ({args.rows} ids)",
+         lambda n: client.post('/api/batch', json={'tune_by_id': [f"{n}_{i}" for i in range(args.rows)]})),
+    ]
+    configurations = [("json", "json", False), ("orjson", "orjson", False), ("orjson + raw", "orjson", True)]
+    try:
+        for label, request in endpoints:
+            print(label)
+            for name, codec_name, raw_passthrough in configurations:
+                configure(app, codec_name, raw_passthrough)
+                for n in range(10):
+                    request(f"warm{name}{n}")
+                start = time.thread_time()
+                for n in range(args.requests):
+                    assert request(f"{name}{n}").status_code == 200
+                cpu = (time.thread_time() - start) / args.requests
+                print(f"  {name:<14} {cpu * 1e6:8.0f} us CPU per request")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Measure the CPU time the instrumentation adds to a request: the Flask app against a local stub
+# SPARQL endpoint, with the metrics enabled and disabled.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_metrics --requests 2000
+#
+# Only the CPU time of the thread sending the requests is counted, and every request has new
+# parameters, so none is answered by the response cache. As the difference is within the noise of
+# whole requests on a small machine, the cost of each instrumentation call is also timed on its own.
+
+import argparse
+import os
+import tempfile
+import time
+import timeit
+
+from load_test.bench_json import make_responder
+from load_test.sparql_stub import StubSparqlServer
+from metrics import Metrics, query_builder
+
+
+def timed_block(metrics):
+    with metrics.timed('fuzzy_match'):
+        pass
+
+
+# Time each instrumentation call; a request makes one observe_request and a handful of the others.
+def time_calls(repeat=100000):
+    metrics = Metrics(slow_query_seconds=None)
+    build = query_builder(lambda tune_id: "SELECT * WHERE { ?s ?p ?o }")
+    calls = {
+        "observe_request": lambda: metrics.observe_request('/api/tune_by_id', 0.01, 200),
+        "observe_phase": lambda: metrics.observe_phase('decode', 0.001, 'get_tune_data'),
+        "observe_query": lambda: metrics.observe_query("SELECT", 0.05, 200),
+        "query_builder": lambda: build("1"),
+        "timed block": lambda: timed_block(metrics),
+    }
+    for name, call in calls.items():
+        seconds = min(timeit.repeat(call, number=repeat, repeat=3)) / repeat
+        print(f"{name:<18} {seconds * 1e6:6.2f} us per call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU time per request with and without metrics.")
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per endpoint and configuration.")
+    parser.add_argument('--rounds', type=int, default=3, help="Alternating rounds of each configuration.")
+    args = parser.parse_args()
+
+    time_calls()
+    server = StubSparqlServer(responder=make_responder(50)).start()
+    directory = tempfile.mkdtemp()
+    os.environ.update(BLAZEGRAPH_URL=server.url,
+                      TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+                      TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+                      ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+    import app
+    app.kg_version_monitor.wait_for_refreshes()
+    app.metrics.slow_query_seconds = None
+    client = app.app.test_client()
+    endpoints = [
+        ("tune_by_id", lambda n: client.get(f'/api/tune_by_id?id=tune_{n}')),
+        ("composition_page", lambda n: client.get(f'/api/composition_page?id=tune_{n}')),
+        ("search (title)", lambda n: client.get(f'/api/search?searchType=title&searchTerm=tune+{n}')),
+    ]
+    try:
+        for label, request in endpoints:
+            cpu = {True: [], False: []}
+            for round_number in range(args.rounds):
+                for enabled in (False, True):
+                    app.metrics.enabled = enabled
+                    for n in range(10):
+                        request(f"warm{round_number}{enabled}{n}")
+                    start = time.thread_time()
+                    for n in range(args.requests):
+                        request(f"{round_number}{enabled}{n}")
+                    cpu[enabled].append((time.thread_time() - start) / args.requests)
+            disabled, enabled = min(cpu[False]), min(cpu[True])
+            print(f"{label:<18} {disabled * 1e6:7.0f} us without metrics, {enabled * 1e6:7.0f} us with them "
+                  f"({(enabled - disabled) * 1e6:+.0f} us)")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
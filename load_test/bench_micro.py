@@ -0,0 +1,232 @@
+# Microbenchmarks of the Python-side hot paths, over synthetic inputs of increasing size: the fuzzy
+# title search (the index FuzzySearch.get_title_best_match searches, with the scorer settings of
+# app.py) and its build, the query_factory builders given many matched titles or facet values, and
+# the reshaping of results by the list and batch endpoints.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_micro --titles 1000 10000 100000 1000000 --save micro.json
+#     python -m load_test.bench_micro --targets title_search --compare micro.json
+#
+# Each target is timed with timeit (the best of --repeat runs, each of as many calls as take 0.2 s,
+# within --budget seconds per size) and its peak memory is that traced by tracemalloc during one
+# more call (allocations of C extensions not reporting to tracemalloc, such as rapidfuzz's, are
+# left out). The growth column is the exponent k of time ~ size^k between consecutive sizes: 0 for
+# constant time, 1 for linear. --save writes the curves as JSON, and --compare prints the time and
+# memory ratios against curves saved earlier.
+
+import argparse
+import gc
+import itertools
+import json
+import math
+import random
+import time
+import timeit
+import tracemalloc
+
+from batch_lookups import split_results
+from json_codecs import make_codec
+from load_test.synthetic import TUNE_FACETS, literal, make_queries, make_titles
+from query_factory import advanced_search, get_tune_given_name
+from ranked_lists import page_results
+from results_stream import reshaped_results
+from search_pages import results_page
+from title_index import TitleIndex
+
+# The title index settings of app.py.
+INDEX_OPTIONS = {'scorer': 'rapidfuzz', 'workers': 1, 'max_candidates': None}
+SEARCH_QUERIES = 60
+# Results of a batch are split among this many ids (MAX_IDS_PER_QUERY).
+BATCH_IDS = 200
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# The titles and index of the last corpus size: one at a time, as the largest ones take a gigabyte.
+corpora = {}
+
+
+def corpus(size, with_index=True):
+    if corpora.get('size') != size:
+        corpora.clear()
+        corpora.update(size=size, names=make_titles(size))
+    if with_index and 'index' not in corpora:
+        corpora['index'] = TitleIndex.build(corpora['names'], **INDEX_OPTIONS)
+    return corpora['names'], corpora.get('index')
+
+
+def matched_tuples(size):
+    names = make_titles(max(size, 1))
+    return [(title, 86 - n % 30, tune_id) for n, (tune_id, title) in enumerate(itertools.islice(names.items(), size))]
+
+
+def facet_values(size):
+    # `size` values per facet, the real ones first.
+    return {field: (values + [f"{values[0]} {n}" for n in range(size)])[:size] for field, values in TUNE_FACETS.items()}
+
+
+def result_rows(size, variables=('title', 'genre', 'id')):
+    rng = random.Random(size)
+    return {'head': {'vars': list(variables)},
+            'results': {'bindings': [{'title': literal(f"Tune {n}"), 'genre': literal(rng.choice(TUNE_FACETS['tuneType'])),
+                                      'id': literal(f"tune_{n}")} for n in range(size)]}}
+
+
+def setup_title_index_build(size):
+    names = corpus(size, with_index=False)[0]
+    return lambda: TitleIndex.build(names, **INDEX_OPTIONS)
+
+
+def setup_title_search(size):
+    names, index = corpus(size)
+    queries = itertools.cycle([query for n, query in enumerate(make_queries(names, SEARCH_QUERIES)) if n % 3 != 2])
+    return lambda: index.search(next(queries))
+
+
+def setup_title_search_no_match(size):
+    # Queries matching no title: every cutoff of the retry loop, then the fallback candidates, are tried.
+    names, index = corpus(size)
+    queries = itertools.cycle([query for n, query in enumerate(make_queries(names, SEARCH_QUERIES)) if n % 3 == 2])
+    return lambda: index.search(next(queries))
+
+
+def setup_get_tune_given_name(size):
+    matches = matched_tuples(size)
+    return lambda: get_tune_given_name(matches)
+
+
+def setup_advanced_search(size):
+    # A title search narrowed by a pattern and three values of every facet.
+    matches = matched_tuples(size)
+    query_params = {'title': ['a title'], 'pattern': ['0-2-4-5-7'], **facet_values(3)}
+    return lambda: advanced_search(query_params, matches)
+
+
+def setup_advanced_search_facets(size):
+    query_params = {'title': [''], 'pattern': [''], **facet_values(size)}
+    return lambda: advanced_search(query_params, [])
+
+
+def setup_split_results(size):
+    results = result_rows(size)
+    ids = [f"tune_{n}" for n in range(0, size, max(1, size // BATCH_IDS))][:BATCH_IDS]
+    for n, binding in enumerate(results['results']['bindings']):
+        binding['id'] = literal(ids[n % len(ids)])
+    return lambda: split_results('tune_by_id', results, ids)
+
+
+def setup_page_results(size):
+    results = result_rows(size)
+    return lambda: page_results(results, size // 2)
+
+
+def setup_results_page(size):
+    results = result_rows(size)
+    return lambda: results_page(results, 20, size // 2, with_count=True)
+
+
+def setup_reshaped_results(size):
+    codec = make_codec('orjson')
+    body = codec.dumps(result_rows(size))
+    chunks = [body[start:start + STREAM_CHUNK_SIZE] for start in range(0, len(body), STREAM_CHUNK_SIZE)]
+    return lambda: b''.join(reshaped_results(chunks, codec=codec))
+
+
+# Targets: the option giving their sizes, and a function returning the callable to time for a size.
+TARGETS = {
+    'title_index_build': ('titles', setup_title_index_build),
+    'title_search': ('titles', setup_title_search),
+    'title_search_no_match': ('titles', setup_title_search_no_match),
+    'get_tune_given_name': ('matches', setup_get_tune_given_name),
+    'advanced_search': ('matches', setup_advanced_search),
+    'advanced_search_facets': ('facet_values', setup_advanced_search_facets),
+    'split_results': ('rows', setup_split_results),
+    'page_results': ('rows', setup_page_results),
+    'results_page': ('rows', setup_results_page),
+    'reshaped_results': ('rows', setup_reshaped_results),
+}
+
+
+def time_per_call(function, repeat, budget):
+    timer = timeit.Timer(function)
+    start = time.perf_counter()
+    number, elapsed = timer.autorange()
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        if time.perf_counter() - start > budget:
+            break
+        best = min(best, timer.timeit(number) / number)
+    return best
+
+
+def peak_memory(function):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def format_seconds(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:7.2f} {unit}"
+    return f"{seconds * 1e9:7.0f} ns"
+
+
+def run_target(name, sizes, repeat, budget, reference):
+    print(f"{name}")
+    print(f"  {'size':>9} {'time/call':>11} {'growth':>7} {'peak memory':>12}" + ("   vs saved" if reference else ""))
+    curve = []
+    for size in sizes:
+        function = TARGETS[name][1](size)
+        seconds = time_per_call(function, repeat, budget)
+        memory = peak_memory(function)
+        line = f"  {size:9d} {format_seconds(seconds):>11} "
+        if curve and curve[-1]['size'] != size:
+            line += f"{math.log(seconds / curve[-1]['seconds']) / math.log(size / curve[-1]['size']):7.2f} "
+        else:
+            line += f"{'':7} "
+        line += f"{memory / 2**20:9.2f} MB"
+        saved = reference.get(size)
+        if saved:
+            line += f"   x{seconds / saved['seconds']:.2f} time, x{memory / max(saved['peak_bytes'], 1):.2f} memory"
+        print(line)
+        curve.append({'size': size, 'seconds': seconds, 'peak_bytes': memory})
+    return curve
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of title search, query builders and reshaping.")
+    parser.add_argument('--targets', nargs='+', choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument('--titles', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Corpus sizes of the title search targets (1000000 takes about 1 GB).")
+    parser.add_argument('--matches', type=int, nargs='+', default=[1, 10, 50, 250, 1000],
+                        help="Matched titles given to the query builders (searches match up to 50).")
+    parser.add_argument('--facet-values', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help="Values of every facet in advanced_search_facets.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Result rows reshaped.")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=10, help="Seconds of timing per size, at least one call.")
+    parser.add_argument('--save', help="Write the curves to this JSON file.")
+    parser.add_argument('--compare', help="Compare with curves written by --save.")
+    args = parser.parse_args()
+
+    saved = {}
+    if args.compare:
+        with open(args.compare) as curves:
+            saved = json.load(curves)
+    curves = {}
+    for name in args.targets:
+        reference = {point['size']: point for point in saved.get(name, [])}
+        curves[name] = run_target(name, getattr(args, TARGETS[name][0]), args.repeat, args.budget, reference)
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(curves, output, indent=2)
+            output.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Compare the memory of pre-forked workers when the master loads the app once and shares its
+# indexes (the default) with every worker loading the app on its own (--no-preload), against a
+# local stub SPARQL endpoint serving synthetic titles and tune metadata.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_prefork --workers 4 --tunes 100000
+#
+# For each mode prefork.py runs in a process of its own, with a fresh snapshot directory. Once
+# every worker serves, some typeahead and title searches are sent, and the resident (RSS),
+# proportional (PSS, shared pages divided among the processes sharing them) and private memory
+# of every worker is read from /proc (Linux only), along with the queries the endpoint got
+# while the server started.
+
+import argparse
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+from load_test.sparql_stub import StubSparqlServer, empty_results
+from load_test.synthetic import literal, make_tune_metadata
+from prefork import process_memory
+
+MODES = {'preload': [], 'no-preload': ['--no-preload']}
+KG_VERSION = "2024-01"
+# A triple pattern telling the query of each advanced search field apart.
+FIELD_MARKERS = {'title': 'core:title ?value', 'corpus': 'core:isMemberOf', 'tuneType': 'mm:hasFormType',
+                 'key': 'mm:hasKey', 'timeSignature': 'jams:timeSignature'}
+
+
+def make_responder(tunes):
+    idsJSON, fieldsJSON = make_tune_metadata(tunes)
+    names = [{'title': item['value'], 'id': item['id']} for item in fieldsJSON['title']['results']['bindings']]
+
+    def responder(sparql_query):
+        results = empty_results(sparql_query)
+        bindings = results['results']['bindings']
+        if 'jams:release ?version' in sparql_query:
+            bindings.append({'version': literal(KG_VERSION)})
+        elif 'core:hasTitle ?title' in sparql_query and 'SELECT DISTINCT ?title ?id' in sparql_query:
+            bindings.extend(names)
+        elif re.search(r'SELECT DISTINCT \?id\s+WHERE', sparql_query) and 'core:id ?id' in sparql_query:
+            return idsJSON
+        elif 'SELECT DISTINCT ?id ?value' in sparql_query:
+            for field, marker in FIELD_MARKERS.items():
+                if marker in sparql_query:
+                    return fieldsJSON[field]
+        return results
+    return responder, [item['title']['value'] for item in names]
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def worker_pids(master):
+    try:
+        with open(f'/proc/{master}/task/{master}/children') as children:
+            return [int(pid) for pid in children.read().split()]
+    except OSError:
+        return []
+
+
+def wait_for_workers(process, port, workers, timeout):
+    """Wait until every worker logged that it serves and the port answers."""
+    deadline = time.monotonic() + timeout
+    serving = 0
+    while serving < workers:
+        line = process.stderr.readline()
+        if not line or time.monotonic() > deadline:
+            raise RuntimeError("prefork.py did not start its workers")
+        serving += ' serving' in line
+    while True:
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/api/suggest', params={'searchTerm': 'a'}, timeout=10)
+            return
+        except httpx.HTTPError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def drain(stream):
+    threading.Thread(target=stream.read, daemon=True).start()
+
+
+def run_mode(name, options, stub, workers, titles, requests, timeout):
+    port = free_port()
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ, BLAZEGRAPH_URL=stub.url,
+               TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+               TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+               ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+    stub.reset_counters()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'prefork.py', '--workers', str(workers), '--port', str(port),
+                                *options], env=env, stderr=subprocess.PIPE, text=True)
+    try:
+        wait_for_workers(process, port, workers, timeout)
+        drain(process.stderr)
+        startup = time.perf_counter() - start
+        startup_queries = stub.requests
+        with httpx.Client(base_url=f'http://127.0.0.1:{port}', timeout=30) as client:
+            for n in range(requests):
+                title = titles[n * 7919 % len(titles)]
+                client.get('/api/suggest', params={'searchTerm': title[:3 + n % 5], 'fuzzy': str(n % 2 == 0).lower()})
+                client.get('/api/search', params={'searchType': 'title', 'searchTerm': title, 'limit': 20})
+        memory = [process_memory(pid) for pid in worker_pids(process.pid)]
+        master = process_memory(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    print(f"{name}: workers up in {startup:.1f} s, {startup_queries} SPARQL queries at startup")
+    print(f"  {'process':<10} {'RSS':>9} {'PSS':>9} {'private':>9}")
+    for label, usage in [('master', master)] + [(f'worker {n}', usage) for n, usage in enumerate(memory)]:
+        if usage:
+            print(f"  {label:<10} {usage['rss'] / 2**20:7.1f}MB {usage['pss'] / 2**20:7.1f}MB "
+                  f"{usage['private'] / 2**20:7.1f}MB")
+    total = sum(usage['pss'] for usage in [master, *memory] if usage)
+    print(f"  total PSS {total / 2**20:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory of pre-forked workers with and without preloading.")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--tunes', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=200, help="Requests sent before measuring.")
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds allowed for the workers to start.")
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    args = parser.parse_args()
+
+    responder, titles = make_responder(args.tunes)
+    stub = StubSparqlServer(responder=responder).start()
+    try:
+        for name in args.modes:
+            run_mode(name, MODES[name], stub, args.workers, titles, args.requests, args.timeout)
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# Exercise the upstream resilience layer (resilience.UpstreamGuard) of the Flask app against the
+# stub endpoint injecting delays and errors: hedged queries cutting the latency tail, and the
+# circuit breaker with stale cached responses while the endpoint is down.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_resilience --requests 400 --slow-rate 0.02
+#
+# The app runs in process against a synthetic knowledge graph, and /api/tune_by_id is requested
+# by --users threads in four phases:
+#   slow tail    a fraction --slow-rate of the queries take --slow-latency seconds; new ids (so
+#                that no response is cached) are requested without, then with hedging
+#   outage       every query fails: ids cached during the slow tail phase, whose entries have
+#                expired, are answered stale, and new ids fail, fast once the breaker is open
+#   recovery     the endpoint answers again: once the breaker lets a trial query through, new
+#                ids are answered
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from load_test.bench_suite import settle
+from load_test.sparql_stub import StubSparqlServer
+from load_test.synthetic_kg import SyntheticKG
+
+
+def run(client_factory, paths, users):
+    """Request the paths from `users` threads; return the (seconds, status) of each response."""
+    outcomes = []
+    lock = threading.Lock()
+
+    def user(share):
+        client = client_factory()
+        for path in share:
+            start = time.perf_counter()
+            status = client.get(path).status_code
+            with lock:
+                outcomes.append((time.perf_counter() - start, status))
+
+    threads = [threading.Thread(target=user, args=(paths[n::users],)) for n in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def report(name, outcomes, stub, guard, cache, before):
+    seconds = sorted(outcome[0] for outcome in outcomes)
+    statuses = Counter(outcome[1] for outcome in outcomes)
+    p99 = seconds[min(len(seconds) - 1, int(len(seconds) * 0.99))]
+    print(f"{name:<24} p50 {statistics.median(seconds) * 1000:7.1f} ms  p99 {p99 * 1000:7.1f} ms  "
+          f"statuses {dict(sorted(statuses.items()))}  upstream queries {stub.requests - before['requests']}  "
+          f"hedges {guard.hedges - before['hedges']} (won {guard.hedge_wins - before['hedge_wins']})  rejected {guard.rejections - before['rejections']}  "
+          f"stale {cache.stale_hits - before['stale']}  breaker opened {guard.breaker.opened - before['opened']}")
+
+
+def counters(stub, guard, cache):
+    return {'requests': stub.requests, 'hedges': guard.hedges, 'hedge_wins': guard.hedge_wins,
+            'rejections': guard.rejections, 'stale': cache.stale_hits, 'opened': guard.breaker.opened}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hedging, circuit breaking and stale responses against a faulty stub.")
+    parser.add_argument('--requests', type=int, default=400, help="Requests per phase.")
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds the stub takes to answer a query.")
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--slow-rate', type=float, default=0.02, help="Fraction of the queries answered late.")
+    parser.add_argument('--slow-latency', type=float, default=1.0)
+    parser.add_argument('--ttl', type=float, default=1.0, help="Seconds the responses stay fresh in the cache.")
+    parser.add_argument('--open-seconds', type=float, default=2.0, help="Seconds the circuit breaker stays open.")
+    args = parser.parse_args()
+
+    kg = SyntheticKG(tunes=max(2000, 4 * args.requests))
+    stub = StubSparqlServer(responder=kg, latency=args.latency, jitter=args.jitter).start()
+    directory = tempfile.mkdtemp()
+    os.environ.update(BLAZEGRAPH_URL=stub.url,
+                      TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+                      TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+                      ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+    import app
+    settle(stub)
+    guard, cache = app.upstream_guard, app.response_cache
+    guard.breaker.open_seconds = args.open_seconds
+    cache.ttl = args.ttl
+    ids = iter(kg.tune_ids)
+
+    def paths(count):
+        return [f'/api/tune_by_id?id={next(ids)}' for _ in range(count)]
+
+    try:
+        # Latency samples for the hedge delays and timeouts.
+        run(app.app.test_client, paths(max(guard.min_samples, args.users) * 2), args.users)
+        stub.slow_rate, stub.slow_latency = args.slow_rate, args.slow_latency
+        hedge_quantile, guard.hedge_quantile = guard.hedge_quantile, None
+        before = counters(stub, guard, cache)
+        report("slow tail, no hedging", run(app.app.test_client, paths(args.requests), args.users),
+               stub, guard, cache, before)
+        guard.hedge_quantile = hedge_quantile
+        cached = paths(args.requests)
+        before = counters(stub, guard, cache)
+        report("slow tail, hedging", run(app.app.test_client, cached, args.users), stub, guard, cache, before)
+
+        stub.slow_rate, stub.error_rate = 0.0, 1.0
+        time.sleep(args.ttl)
+        before = counters(stub, guard, cache)
+        report("outage, cached ids", run(app.app.test_client, cached, args.users), stub, guard, cache, before)
+        before = counters(stub, guard, cache)
+        report("outage, new ids", run(app.app.test_client, paths(args.requests), args.users),
+               stub, guard, cache, before)
+
+        stub.error_rate = 0.0
+        time.sleep(args.open_seconds)
+        before = counters(stub, guard, cache)
+        report("recovery", run(app.app.test_client, paths(args.requests), args.users), stub, guard, cache, before)
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
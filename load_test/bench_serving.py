@@ -0,0 +1,158 @@
+# Compare the threaded Flask server with the asyncio (ASGI) serving mode against a local stub
+# SPARQL endpoint with injected latency.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_serving --concurrency 200 --duration 10 --latency 0.1
+#
+# The stub endpoint and each server run in their own processes. Every request asks
+# /api/tune_by_id for a new id, so each one reaches the endpoint. Requests per second per core
+# is the number of requests served divided by the CPU seconds the server process used (read
+# from /proc, so Linux only).
+
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+SERVERS = {
+    'flask': [sys.executable, '-c', "import sys, app; app.app.run(port=int(sys.argv[1]), threaded=True)"],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--log-level', 'warning', '--port'],
+}
+
+
+def cpu_seconds(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime are the 12th and 13th fields after the command name.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def wait_until_up(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.post(url, data={'query': 'SELECT ?version WHERE {}'})
+                return
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+# A minimal HTTP/1.1 client. httpx costs several milliseconds of CPU per request, which on a
+# small machine would load the benchmark rather than the server.
+class Connection:
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            self.writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.encode('ascii'))
+            status_line, _, headers = (await self.reader.readuntil(b'\r\n\r\n')).partition(b'\r\n')
+            await self.reader.readexactly(int(re.search(rb'(?i)content-length:\s*(\d+)', headers).group(1)))
+        except (OSError, asyncio.IncompleteReadError):
+            self.close()
+            raise
+        # The Flask development server closes the connection after every response.
+        if re.search(rb'(?i)connection:\s*close', headers):
+            self.close()
+        return int(status_line.split()[1])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+async def generate_load(port, concurrency, duration):
+    latencies = []
+    errors = 0
+    next_id = 0
+    deadline = time.monotonic() + duration
+
+    async def user():
+        nonlocal next_id, errors
+        connection = Connection(port)
+        while time.monotonic() < deadline:
+            next_id += 1
+            start = time.perf_counter()
+            try:
+                if await connection.get(f'/api/tune_by_id?id=tune_{next_id}') != 200:
+                    errors += 1
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def run(name, stub_url, port, concurrency, duration):
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, BLAZEGRAPH_URL=stub_url,
+                   TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+                   TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+                   ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+        server = subprocess.Popen(SERVERS[name] + [str(port)], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base_url = f'http://127.0.0.1:{port}'
+            asyncio.run(wait_until_up(f'{base_url}/api/kg_version'))
+            cpu_before = cpu_seconds(server.pid)
+            start = time.perf_counter()
+            latencies, errors = asyncio.run(generate_load(port, concurrency, duration))
+            elapsed = time.perf_counter() - start
+            cpu_after = cpu_seconds(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+    line = (f"{name:<6} {len(latencies) / elapsed:7.0f} req/s, p50 {percentile(latencies, 0.5) * 1000:6.0f} ms, "
+            f"p95 {percentile(latencies, 0.95) * 1000:6.0f} ms, p99 {percentile(latencies, 0.99) * 1000:6.0f} ms, "
+            f"{errors} errors")
+    if cpu_before is not None:
+        cpu = cpu_after - cpu_before
+        line += f", {cpu:.1f} CPU s, {len(latencies) / cpu:.0f} req/s per core"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flask and ASGI serving mode benchmark.")
+    parser.add_argument('--concurrency', type=int, default=200, help="Concurrent clients.")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds of load per server.")
+    parser.add_argument('--latency', type=float, default=0.1, help="Stub latency per query in seconds.")
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--servers', nargs='+', choices=sorted(SERVERS), default=['flask', 'asgi'])
+    args = parser.parse_args()
+
+    stub_url = f'http://127.0.0.1:{args.port + 1}/sparql'
+    stub = subprocess.Popen([sys.executable, '-m', 'load_test.sparql_stub', '--port', str(args.port + 1),
+                             '--latency', str(args.latency)], stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_until_up(stub_url))
+        for name in args.servers:
+            run(name, stub_url, args.port, args.concurrency, args.duration)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# Send bursts of identical queries, as when a popular tune page is opened by many users at once,
+# with and without coalescing in the SparqlClient, against a local stub endpoint.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_single_flight --users 50 --tunes 5 --latency 0.2
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from load_test.sparql_stub import StubSparqlServer
+from query_factory import get_most_common_patterns_for_a_tune, get_tune_data
+from sparql_client import SparqlClient
+
+
+def run(label, server, client, queries, num_threads):
+    server.reset_counters()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(client.query, queries))
+    elapsed = time.perf_counter() - start
+    line = (f"{label:<16} {len(queries)} queries in {elapsed:.3f}s, "
+            f"{server.requests} sent to the endpoint")
+    if client.single_flight is not None:
+        line += f", coalescing ratio {client.single_flight.coalescing_ratio:.2f}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SPARQL request coalescing benchmark.")
+    parser.add_argument('--users', type=int, default=50, help="Concurrent users opening each tune page.")
+    parser.add_argument('--tunes', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.2, help="Stub latency per query in seconds.")
+    args = parser.parse_args()
+
+    # Each user loads the tune data and its patterns, as the composition page does.
+    queries = [query for tune in range(args.tunes) for _ in range(args.users)
+               for query in (get_tune_data(str(tune)), get_most_common_patterns_for_a_tune(str(tune), "false"))]
+    server = StubSparqlServer(latency=args.latency).start()
+    try:
+        for label, coalesce in (("no coalescing", False), ("single-flight", True)):
+            client = SparqlClient(server.url, pool_size=args.users, coalesce=coalesce)
+            run(label, server, client, queries, args.users)
+            client.close()
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Compare bare `requests.post` calls with the pooled SparqlClient against a local stub endpoint.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_sparql_client --queries 500 --threads 8
+#
+# The stub counts accepted TCP connections, which shows whether connections are reused.
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from load_test.sparql_stub import StubSparqlServer
+from query_factory import get_tune_data
+from sparql_client import SparqlClient
+
+
+def bare_post(url, sparql_query):
+    response = requests.post(url, data={'query': sparql_query, 'format': 'json'})
+    response.raise_for_status()
+    return response.json()
+
+
+def run(label, server, send, num_queries, num_threads):
+    server.reset_counters()
+    queries = [get_tune_data(str(i)) for i in range(num_queries)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(send, queries))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<14} {num_queries} queries in {elapsed:.3f}s "
+          f"({num_queries / elapsed:.0f} q/s), "
+          f"{server.connections} TCP connections opened")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SPARQL client connection reuse benchmark.")
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--pool-size', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help="Stub latency per query in seconds.")
+    args = parser.parse_args()
+
+    server = StubSparqlServer(latency=args.latency).start()
+    try:
+        run("requests.post", server, lambda q: bare_post(server.url, q), args.queries, args.threads)
+        client = SparqlClient(server.url, pool_size=args.pool_size)
+        run("SparqlClient", server, client.query, args.queries, args.threads)
+        client.close()
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
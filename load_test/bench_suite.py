@@ -0,0 +1,281 @@
+# Load test of the search and composition pages: virtual users visit the search page and then the
+# composition page of a tune found there (see load_test/flows.py), through the /api/* routes of the
+# app served by Flask or ASGI, while a local stub SPARQL endpoint replays recorded query results
+# (see load_test/fixtures.py) with configurable latency.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_suite --server flask --users 10 --duration 30 --latency 0.02
+#
+# The first run records the fixtures from a synthetic knowledge graph of --tunes tunes, by running
+# every flow once; --record --endpoint URL records them from a real endpoint instead. Latency,
+# percentiles and throughput are reported per request type, and compared with a baseline saved by
+# --save-baseline when --baseline names one: a p50 or p95 more than --tolerance above the
+# baseline's, or a throughput that much below it, is a regression and exits with status 1.
+#
+# The response cache is on, as in production: requests repeating an earlier one are answered from
+# it, so the more --terms, the more requests reach the stub endpoint.
+
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+from load_test.bench_serving import SERVERS, cpu_seconds, percentile
+from load_test.fixtures import EndpointResponder, RecordingResponder, ReplayResponder, load_fixtures
+from load_test.flows import search_terms, visit
+from load_test.sparql_stub import StubSparqlServer
+from load_test.synthetic_kg import SyntheticKG
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# Requests of a type needed before its percentiles are compared with the baseline.
+MIN_COMPARED_REQUESTS = 20
+# The stub endpoint is considered idle (the app's startup loads done) after this many quiet seconds.
+SETTLE_SECONDS = 1.0
+
+
+class Stats:
+    """Latencies and errors of the requests sent, by name."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if status != 200:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self, elapsed):
+        """{name: {requests, errors, rps, p50, p95, p99}} with latencies in milliseconds, 'all' included."""
+        with self._lock:
+            groups = dict(self.latencies, all=[value for values in self.latencies.values() for value in values])
+            errors = dict(self.errors, all=sum(self.errors.values()))
+        return {name: {'requests': len(values), 'errors': errors.get(name, 0), 'rps': len(values) / elapsed,
+                       **{key: percentile(values, fraction) * 1000
+                          for key, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))}}
+                for name, values in groups.items()}
+
+
+class Session:
+    """A virtual user's keep-alive connection to the server, the session of the flows."""
+
+    def __init__(self, port, stats):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        self.stats = stats
+
+    def request(self, name, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            status, data = response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            status, data = None, None
+        self.stats.record(name, time.perf_counter() - start, status)
+        return json.loads(data) if status == 200 else None
+
+    def get(self, name, path, params=None):
+        return self.request(name, 'GET', f'{path}?{urlencode(params)}' if params else path)
+
+    def post(self, name, path, body):
+        return self.request(name, 'POST', path, json.dumps(body))
+
+    def close(self):
+        self.connection.close()
+
+
+def wait_until_up(port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            connection.request('GET', '/api/kg_version')
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def settle(stub, timeout=300):
+    """Wait until the stub got no query for SETTLE_SECONDS: the app's background loads are done."""
+    deadline = time.monotonic() + timeout
+    count = -1
+    while count != stub.requests and time.monotonic() < deadline:
+        count = stub.requests
+        time.sleep(SETTLE_SECONDS)
+
+
+@contextmanager
+def serving(server, stub, port):
+    """Run the app with `server` against the stub endpoint, until its startup loads are done."""
+    with tempfile.TemporaryDirectory() as directory:
+        # A fixed hash seed, so that fuzzy title matches tied on score come in the same order (and
+        # send the same queries) as when the fixtures were recorded.
+        env = dict(os.environ, BLAZEGRAPH_URL=stub.url, PYTHONHASHSEED='0',
+                   TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+                   TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+                   ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+        process = subprocess.Popen(SERVERS[server] + [str(port)], env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(port)
+            settle(stub)
+            yield process
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def record(path, source, terms, server, port):
+    """Record the queries the app sends while starting and running every flow once."""
+    recorder = RecordingResponder(source)
+    stub = StubSparqlServer(responder=recorder).start()
+    try:
+        with serving(server, stub, port):
+            session = Session(port, Stats())
+            for choice, term in enumerate(terms):
+                visit(session, term, choice)
+            session.close()
+            settle(stub)
+    finally:
+        stub.stop()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    recorder.save(path, terms)
+    print(f"Recorded {len(recorder.fixtures)} queries in {path}")
+
+
+def generate_load(port, terms, users, duration, think_time, seed):
+    stats = Stats()
+    deadline = time.monotonic() + duration
+
+    def user(number):
+        rng = random.Random(seed + number)
+        session = Session(port, stats)
+        while time.monotonic() < deadline:
+            choice = rng.randrange(len(terms))
+            visit(session, terms[choice], choice)
+            if think_time:
+                time.sleep(rng.uniform(0, 2 * think_time))
+        session.close()
+    threads = [threading.Thread(target=user, args=(number,)) for number in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+
+def print_summary(summary):
+    print(f"  {'request':<32} {'count':>6} {'errors':>6} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name in sorted(summary, key=lambda name: (name == 'all', name)):
+        entry = summary[name]
+        print(f"  {name:<32} {entry['requests']:6d} {entry['errors']:6d} {entry['rps']:7.1f} "
+              f"{entry['p50']:8.1f} {entry['p95']:8.1f} {entry['p99']:8.1f}")
+
+
+def regressions(summary, baseline, tolerance):
+    """The measures of `summary` worse than those of `baseline` by more than `tolerance`."""
+    found = []
+    for name, reference in baseline['requests'].items():
+        entry = summary.get(name)
+        if entry is None or min(entry['requests'], reference['requests']) < MIN_COMPARED_REQUESTS:
+            continue
+        for key in ('p50', 'p95'):
+            if entry[key] > reference[key] * (1 + tolerance):
+                found.append(f"{name}: {key} {entry[key]:.1f} ms, baseline {reference[key]:.1f} ms")
+        if entry['rps'] < reference['rps'] * (1 - tolerance):
+            found.append(f"{name}: {entry['rps']:.1f} req/s, baseline {reference['rps']:.1f} req/s")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search and composition page load test against replayed SPARQL results.")
+    parser.add_argument('--server', choices=sorted(SERVERS), default='flask')
+    parser.add_argument('--users', type=int, default=10, help="Concurrent virtual users.")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds of load.")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Mean seconds a user waits between visits.")
+    parser.add_argument('--latency', type=float, default=0.02, help="Stub latency per query in seconds.")
+    parser.add_argument('--jitter', type=float, default=0.5, help="Stub latency variation, as a fraction of it.")
+    parser.add_argument('--recorded-latency', type=float, metavar='SCALE',
+                        help="Also delay each answer by the time its source took to give it, times SCALE.")
+    parser.add_argument('--fixtures', help="Fixture file (by default one per source in load_test/fixtures).")
+    parser.add_argument('--record', action='store_true', help="Record the fixtures even if the file exists.")
+    parser.add_argument('--endpoint', help="Record from this SPARQL endpoint instead of a synthetic graph.")
+    parser.add_argument('--tunes', type=int, default=2000, help="Tunes of the synthetic graph.")
+    parser.add_argument('--terms', type=int, default=200, help="Search terms of the synthetic graph's flows.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--baseline', help="Compare with this baseline file.")
+    parser.add_argument('--save-baseline', help="Save the results as a baseline file.")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed regression, as a fraction.")
+    args = parser.parse_args()
+
+    path = args.fixtures or os.path.join(FIXTURES_DIRECTORY, 'endpoint.jsonl.gz' if args.endpoint else
+                                         f'synthetic-{args.tunes}-{args.terms}-{args.seed}.jsonl.gz')
+    if args.record or not os.path.exists(path):
+        if args.endpoint:
+            source, terms = EndpointResponder(args.endpoint), search_terms()
+        else:
+            source = SyntheticKG(tunes=args.tunes, seed=args.seed)
+            terms = search_terms(source.titles, args.terms, args.seed + 1)
+        record(path, source, terms, args.server, args.port)
+    fixtures, terms = load_fixtures(path)
+
+    replay = ReplayResponder(fixtures, latency_scale=args.recorded_latency)
+    stub = StubSparqlServer(responder=replay, latency=args.latency, jitter=args.jitter).start()
+    try:
+        with serving(args.server, stub, args.port) as process:
+            startup_misses = replay.misses
+            cpu_before = cpu_seconds(process.pid)
+            stub.reset_counters()
+            stats, elapsed = generate_load(args.port, terms, args.users, args.duration, args.think_time, args.seed)
+            cpu_after = cpu_seconds(process.pid)
+    finally:
+        stub.stop()
+
+    summary = stats.summary(elapsed)
+    print(f"{args.server}: {args.users} users for {elapsed:.1f} s, {len(terms)} search terms, stub latency "
+          f"{args.latency * 1000:.0f} ms (+/- {args.jitter:.0%}), {stub.requests} SPARQL queries, "
+          f"{replay.misses} not recorded ({startup_misses} at startup)")
+    if cpu_before is not None:
+        cpu = cpu_after - cpu_before
+        print(f"  server CPU {cpu:.1f} s, {summary['all']['requests'] / cpu:.0f} requests per CPU second")
+    print_summary(summary)
+
+    if args.save_baseline:
+        config = {key: getattr(args, key) for key in ('server', 'users', 'duration', 'think_time', 'latency',
+                                                      'jitter', 'recorded_latency')}
+        with open(args.save_baseline, 'w') as output:
+            json.dump({'config': dict(config, fixtures=os.path.basename(path)), 'requests': summary},
+                      output, indent=2, sort_keys=True)
+            output.write('\n')
+        print(f"Saved the baseline in {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        found = regressions(summary, baseline, args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"No regression from {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Compare the linear fuzzywuzzy title search with the n-gram TitleIndex on a synthetic corpus.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_title_index --titles 100000 --queries 12
+#
+# --scorer rapidfuzz scores titles in one batch call per query. Every title is scored, which
+# reproduces the linear results exactly, unless --max-candidates limits the scoring to that many
+# n-gram candidates, whose results are approximate.
+#
+# The typeahead suggestions of the prefix index are timed for every keystroke of the queries.
+#
+# The linear search scores every title up to four times per query, so keep --queries small
+# for large corpora.
+
+import argparse
+import time
+
+from fuzzywuzzy import process as fuzzy_process
+
+from load_test.synthetic import make_queries, make_titles
+from title_index import TitleIndex, TitlePrefixIndex
+
+
+# The title search as it was before the index: extractBests retried with halved cutoffs.
+def linear_best_match(names, title, score_cutoff=60, limit=50, retry_till_match=True, max_retries=3):
+    best_matches = fuzzy_process.extractBests(title, names, score_cutoff=score_cutoff, limit=limit)
+    retry_count = 0
+    while not best_matches and retry_till_match and retry_count < max_retries:
+        retry_count += 1
+        score_cutoff /= 2
+        best_matches = fuzzy_process.extractBests(title, names, score_cutoff=score_cutoff, limit=limit)
+    return best_matches
+
+
+def time_queries(search, queries):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        results.append(search(query))
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzzy title search benchmark.")
+    parser.add_argument('--titles', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=12)
+    parser.add_argument('--scorer', choices=['fuzzywuzzy', 'rapidfuzz'], default='fuzzywuzzy')
+    parser.add_argument('--workers', type=int, default=1, help="Threads used by the rapidfuzz scorer.")
+    parser.add_argument('--max-candidates', type=int, default=None,
+                        help="Score only this many n-gram candidates per query (approximate results).")
+    parser.add_argument('--skip-linear', action='store_true', help="Only time the index.")
+    args = parser.parse_args()
+
+    names = make_titles(args.titles)
+    queries = make_queries(names, args.queries)
+
+    start = time.perf_counter()
+    options = {'scorer': args.scorer}
+    if args.scorer == 'rapidfuzz':
+        options['workers'] = args.workers
+    options['max_candidates'] = args.max_candidates
+    index = TitleIndex.build(names, **options)
+    print(f"Built index over {len(index)} titles ({len(index.ngram_slots)} n-grams, "
+          f"{len(index.postings)} postings) in {time.perf_counter() - start:.2f}s")
+
+    indexed, indexed_time = time_queries(index.search, queries)
+    print(f"TitleIndex:   {indexed_time * 1000:9.2f} ms/query ({args.scorer} scorer"
+          f"{f', {args.max_candidates} candidates' if args.max_candidates else ''})")
+
+    start = time.perf_counter()
+    prefix_index = TitlePrefixIndex.build(index.ids, index.titles)
+    print(f"Built prefix index ({len(prefix_index.word_keys)} words) in {time.perf_counter() - start:.2f}s")
+    keystrokes = [query[:length] for query in queries for length in range(1, len(query) + 1)]
+    for max_edits in (0, 1):
+        _, suggest_time = time_queries(lambda prefix: prefix_index.suggest(prefix, max_edits=max_edits), keystrokes)
+        print(f"Suggestions:  {suggest_time * 1000:9.3f} ms/keystroke (max_edits={max_edits})")
+    if args.skip_linear:
+        return
+    linear, linear_time = time_queries(lambda query: linear_best_match(names, query), queries)
+    print(f"extractBests: {linear_time * 1000:9.2f} ms/query ({linear_time / indexed_time:.0f}x slower)")
+    # Equal scores can be broken differently, so compare best matches and score lists too.
+    same_best = sum(a[:1] == b[:1] for a, b in zip(indexed, linear))
+    same_scores = sum([match[1] for match in a] == [match[1] for match in b] for a, b in zip(indexed, linear))
+    identical = sum(a == b for a, b in zip(indexed, linear))
+    print(f"Same best match for {same_best}/{len(queries)} queries, same scores for {same_scores}, "
+          f"identical results for {identical}")
+    for query, a, b in zip(queries, indexed, linear):
+        if a[:1] != b[:1]:
+            print(f"  best match differs for {query!r}: index {a[:1]}, linear {b[:1]}")
+
+
+if __name__ == "__main__":
+    main()
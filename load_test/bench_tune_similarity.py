@@ -0,0 +1,72 @@
+# Build the top-K tune similarity lists over synthetic observations, from scratch and then
+# incrementally after a fraction of the tunes change, reporting build time and memory use.
+#
+# Run from the repository root with:
+#     python -m load_test.bench_tune_similarity --tunes 20000 --patterns 5000
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from load_test.synthetic import change_observations, make_observations
+from tune_similarity import TuneIncidence, TuneSimilarity, format_build_stats, load_similarity, save_similarity
+
+
+# Build and describe the build; tracing allocations slows the pure Python parts down severalfold,
+# so it is only done on request, in a second build.
+def timed_build(incidence, top_k, previous=None, trace_memory=False):
+    similarity, stats = TuneSimilarity.build(incidence, top_k, previous=previous)
+    description = format_build_stats(stats)
+    if trace_memory:
+        tracemalloc.start()
+        TuneSimilarity.build(incidence, top_k, previous=previous)
+        description += f", peak traced allocations {tracemalloc.get_traced_memory()[1] / 2**20:.0f} MB"
+        tracemalloc.stop()
+    return similarity, description
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune similarity build benchmark.")
+    parser.add_argument('--tunes', type=int, default=20000)
+    parser.add_argument('--patterns', type=int, default=5000)
+    parser.add_argument('--patterns-per-tune', type=int, default=20)
+    parser.add_argument('--top-k', type=int, default=250)
+    parser.add_argument('--changed', type=float, default=0.01, help="Fraction of tunes changed between releases.")
+    parser.add_argument('--trace-memory', action='store_true', help="Also report the peak traced allocations.")
+    args = parser.parse_args()
+
+    observations, titles = make_observations(args.tunes, args.patterns, args.patterns_per_tune)
+    incidence = TuneIncidence.from_results(observations, titles)
+    print(f"{len(incidence)} tunes, {len(incidence.pattern_iris)} patterns, {len(incidence.patterns)} tune-pattern pairs")
+
+    similarity, description = timed_build(incidence, args.top_k, trace_memory=args.trace_memory)
+    print(f"Full build:        {description}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tune_similarity.snapshot')
+        save_similarity(similarity, path)
+        start = time.perf_counter()
+        previous = load_similarity(path)
+        print(f"Saved {os.path.getsize(path) / 2**20:.1f} MB, mapped in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        changed = TuneIncidence.from_results(change_observations(observations, args.changed), titles)
+        incremental, description = timed_build(changed, args.top_k, previous=previous,
+                                               trace_memory=args.trace_memory)
+        print(f"Incremental build: {description}")
+
+        rebuilt, stats = TuneSimilarity.build(changed, args.top_k)
+        same = all(list(incremental.neighbours[incremental.offsets[t]:incremental.offsets[t + 1]])
+                   == list(rebuilt.neighbours[rebuilt.offsets[t]:rebuilt.offsets[t + 1]]) for t in range(len(changed)))
+        print(f"Incremental lists identical to a full rebuild: {same}")
+
+        tune_ids = list(changed.ids)[:1000]
+        start = time.perf_counter()
+        for tune_id in tune_ids:
+            previous.page(tune_id, 0)
+        print(f"Page lookup: {(time.perf_counter() - start) / len(tune_ids) * 1e6:.0f} us/request")
+
+
+if __name__ == "__main__":
+    main()
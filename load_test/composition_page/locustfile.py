@@ -1,33 +1,31 @@
-# Composition page load test
-# For each user make 4-5 queries about pairwise similarity between tunes + get all patterns from tunes
+# Composition page load test: each user opens the composition page of a tune suggested for one of
+# the search terms, then explores it (see load_test/flows.py): more patterns of the network, the
+# tunes of a pattern, the patterns shared with a neighbour tune, a batch of the neighbours' details
+# and the neighbour's family.
+#
+# Run from the repository root against a running server with:
+#     locust -f load_test/composition_page/locustfile.py --host http://localhost:5000
 
-from locust import HttpUser, task, between
+import os
+import random
+import sys
 
+from locust import HttpUser, task, between
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
-def get_most_common_patterns_for_a_tune(tune):
-    sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
-                        PREFIX mm: <http://w3id.org/polifonia/ontology/music-meta/>
-                        SELECT ?tune_name ?pattern (count(?pattern) as ?patternFreq)
-                        {
-                            ?tune_file mm:title ?tune_name.
-                            FILTER (?tune_name = \"""" + tune + """\").
-                            ?xx jams:isJAMSAnnotationOf ?tune_file.
-                            ?xx jams:includesObservation ?observation .
-                            ?observation jams:ofPattern ?pattern .
-                        } group by ?tune_name ?pattern
-                        order by DESC (?patternFreq )"""
-    return sparql_query
+from load_test.flows import LocustSession, composition_page_flow, pick, search_terms, values  # noqa: E402
 
 
 class ApiUser(HttpUser):
     wait_time = between(1, 2)  # Wait between 1 to 2 seconds between tasks
+    terms = search_terms()
 
     @task
-    def make_api_calls(self):
-        # Simulating 5 simultaneous API calls
-        self.client.get("/api1")
-        self.client.get("/api2")
-        self.client.get("/api3")
-        self.client.get("/api4")
-        self.client.get("/api5")
+    def composition_page(self):
+        session = LocustSession(self.client)
+        choice = random.randrange(len(self.terms))
+        suggestions = session.get('suggest', '/api/suggest', {'searchTerm': self.terms[choice]})
+        tune_id = pick(values(suggestions, 'id'), choice)
+        if tune_id is not None:
+            composition_page_flow(session, tune_id, choice)
@@ -0,0 +1,104 @@
+# Recorded SPARQL results for the benchmark suite (see load_test/bench_suite.py): every query the
+# app sends while the user flows run once is recorded with its results and the time the source took
+# to answer, and replayed by the stub endpoint during load runs.
+#
+# The source is the synthetic knowledge graph of load_test/synthetic_kg.py or a real endpoint, e.g.
+#     python -m load_test.bench_suite --record --endpoint https://polifonia.disi.unibo.it/harmory/sparql
+# Fixture files are gzipped JSON lines: the search terms of the flows ({"terms"}), then one line per
+# query ({"query", "results", "seconds"}).
+
+import gzip
+import json
+import threading
+import time
+
+import requests
+
+from load_test.sparql_stub import empty_results
+
+
+# Queries are matched with their whitespace normalized, as the builders indent them freely.
+def query_key(sparql_query):
+    return " ".join(sparql_query.split())
+
+
+def save_fixtures(path, fixtures, terms):
+    with gzip.open(path, 'wt', encoding='utf-8') as output:
+        output.write(json.dumps({'terms': terms}) + '\n')
+        for key, (results, seconds) in fixtures.items():
+            output.write(json.dumps({'query': key, 'results': results, 'seconds': seconds}) + '\n')
+
+
+# Return the recorded ({query key: (results, seconds)}, search terms).
+def load_fixtures(path):
+    fixtures = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as lines:
+        terms = json.loads(next(lines))['terms']
+        for line in lines:
+            fixture = json.loads(line)
+            fixtures[fixture['query']] = (fixture['results'], fixture['seconds'])
+    return fixtures, terms
+
+
+class EndpointResponder:
+    """A stub responder forwarding every query to a real SPARQL endpoint."""
+
+    def __init__(self, url, timeout=120):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def __call__(self, sparql_query):
+        response = self.session.post(self.url, data={'query': sparql_query, 'format': 'json'},
+                                     headers={'Accept': 'application/sparql-results+json'}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+class RecordingResponder:
+    """A stub responder answering from `source` (another responder) and recording its answers."""
+
+    def __init__(self, source):
+        self.source = source
+        self.fixtures = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, sparql_query):
+        start = time.perf_counter()
+        results = self.source(sparql_query)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.fixtures[query_key(sparql_query)] = (results, round(seconds, 6))
+        return results
+
+    def save(self, path, terms):
+        with self._lock:
+            save_fixtures(path, self.fixtures, terms)
+
+
+class ReplayResponder:
+    """A stub responder answering from recorded fixtures.
+
+    With `latency_scale`, each answer is delayed by the time the source took to give it, times the
+    scale (on top of the stub's own latency). Queries that were not recorded are answered with no
+    results and counted in `misses`.
+    """
+
+    def __init__(self, fixtures, latency_scale=None):
+        self.fixtures = fixtures
+        self.latency_scale = latency_scale
+        self.misses = 0
+        self.missed = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, sparql_query):
+        fixture = self.fixtures.get(query_key(sparql_query))
+        if fixture is None:
+            with self._lock:
+                self.misses += 1
+                self.missed.add(query_key(sparql_query))
+            return empty_results(sparql_query)
+        results, seconds = fixture
+        if self.latency_scale:
+            time.sleep(seconds * self.latency_scale)
+        return results
@@ -0,0 +1,128 @@
+# User flows of the two pages of the GUI, sent through the /api/* routes: shared by the benchmark
+# suite (load_test/bench_suite.py) and the locustfiles.
+#
+# A flow follows the links between responses as the GUI does (the tune opened is one of the search
+# results, the pattern clicked one of the tune's patterns, ...). Which link is followed is decided by
+# the flow's `choice`, so that the same (term, choice) always sends the same requests: the queries
+# recorded by running every flow once are then the ones a load run needs.
+#
+# A flow talks to the server through a session with two methods, returning the decoded JSON body of
+# a successful response and None otherwise:
+#     get(name, path, params=None)
+#     post(name, path, body)
+# `name` labels the request in the statistics.
+
+from load_test.synthetic import make_queries
+
+# Titles of the real knowledge graph, searched when no synthetic titles are given.
+DEFAULT_SEARCH_TERMS = ["Maggie", "Johnny", "DE RUITER", "Foxhunters", "First Of May", "College Groves", "Gilderoy",
+                        "PINKSTERLIED I"]
+SEARCH_PAGE_SIZE = 20
+# Typeahead requests are sent from this many characters, then every TYPEAHEAD_STEP characters.
+TYPEAHEAD_MIN_LENGTH = 2
+TYPEAHEAD_STEP = 2
+# Neighbour tunes whose details the composition page fetches in a batch.
+BATCH_SIZE = 10
+
+
+# Return `count` search terms for synthetic titles: titles with a typo, partial titles and strings
+# matching none.
+def search_terms(titles=None, count=100, seed=1):
+    if not titles:
+        return list(DEFAULT_SEARCH_TERMS)
+    return make_queries(titles, count, seed)
+
+
+def bindings(results):
+    return results['results']['bindings'] if results and 'results' in results else []
+
+
+def values(results, variable):
+    return [item[variable]['value'] for item in bindings(results) if variable in item]
+
+
+def pick(items, choice):
+    return items[choice % len(items)] if items else None
+
+
+# The label of a pattern from its IRI, as pattern searches and /api/neighbour_tunes expect it.
+def pattern_label(pattern):
+    return pattern.rstrip('/').rsplit('/', 1)[-1]
+
+
+def search_page_flow(session, term, choice=0):
+    """The search page: the facet lists load, the title is typed with typeahead suggestions, then
+    searched and paged, followed by an advanced search on facets. Returns the id of the tune
+    opened from the results, if any."""
+    facets = session.get('facets', '/api/facets') or {}
+    for length in range(TYPEAHEAD_MIN_LENGTH, len(term) + 1, TYPEAHEAD_STEP):
+        session.get('suggest', '/api/suggest', {'searchTerm': term[:length]})
+    page = session.get('search title', '/api/search', {'searchType': 'title', 'searchTerm': term,
+                                                       'limit': SEARCH_PAGE_SIZE, 'count': 'true'})
+    tune_ids = values(page, 'id')
+    if page and page.get('cursor') and choice % 2:
+        page = session.get('search title (next page)', '/api/search',
+                           {'searchType': 'title', 'searchTerm': term, 'limit': SEARCH_PAGE_SIZE,
+                            'cursor': page['cursor']})
+        tune_ids = values(page, 'id') or tune_ids
+    params = {'searchType': 'advanced', 'title': '', 'pattern': '', 'limit': SEARCH_PAGE_SIZE, 'count': 'true'}
+    for name, variable in (('corpus', 'corpus'), ('tuneType', 'genre')):
+        value = pick(values(facets.get(name), variable), choice)
+        if value is not None:
+            params[name] = value
+    session.get('search advanced', '/api/search', params)
+    return pick(tune_ids, choice)
+
+
+def composition_page_flow(session, tune_id, choice=0):
+    """The composition page of a tune: the page loads, the next patterns of the network are shown,
+    a pattern is clicked to show its tunes and searched for, a neighbour tune is compared with the
+    tune, the neighbours' details are fetched in a batch and the neighbour's family is listed."""
+    page = session.get('composition page', '/api/composition_page', {'id': tune_id, 'excludeTrivialPatterns': 'false'})
+    if not page:
+        return
+    patterns = values(page.get('patterns'), 'pattern')
+    if page.get('neighbour_patterns', {}).get('has_more'):
+        session.get('neighbour patterns (next page)', '/api/neighbour_patterns',
+                    {'id': tune_id, 'click_num': 1, 'excludeTrivialPatterns': 'false'})
+    pattern = pick(patterns, choice)
+    if pattern is not None:
+        label = pattern_label(pattern)
+        session.get('neighbour tunes', '/api/neighbour_tunes', {'id': label})
+        session.get('search pattern', '/api/search', {'searchType': 'pattern', 'searchTerm': label,
+                                                      'limit': SEARCH_PAGE_SIZE})
+    neighbours = bindings(page.get('neighbour_tunes_by_common_patterns'))
+    neighbour = pick(neighbours, choice)
+    if neighbour is None:
+        return
+    other = neighbour['id']['value']
+    session.get('common patterns', '/api/common_patterns', {'id': tune_id, 'prev': other,
+                                                            'excludeTrivialPatterns': 'false'})
+    session.post('batch', '/api/batch', {'tune_by_id': [item['id']['value'] for item in neighbours[:BATCH_SIZE]],
+                                         'patterns': [other]})
+    if 'family' in neighbour:
+        session.get('tune family members', '/api/tuneFamilyMembers', {'family': neighbour['family']['value']})
+
+
+def visit(session, term, choice=0):
+    """A visit: the search page, then the composition page of the tune opened from it."""
+    tune_id = search_page_flow(session, term, choice)
+    if tune_id is not None:
+        composition_page_flow(session, tune_id, choice)
+
+
+class LocustSession:
+    """The session of the flows over a locust HttpSession (an HttpUser's `client`)."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, name, path, params=None):
+        return self.decoded(self.client.get(path, params=params, name=name))
+
+    def post(self, name, path, body):
+        return self.decoded(self.client.post(path, json=body, name=name))
+
+    @staticmethod
+    def decoded(response):
+        return response.json() if response.status_code == 200 else None
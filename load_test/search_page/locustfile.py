@@ -1,37 +1,25 @@
+# Search page load test: each user visits the search page (see load_test/flows.py) for one of the
+# search terms: facet lists, typeahead suggestions, a paged title search and an advanced search.
+#
+# Run from the repository root against a running server with:
+#     locust -f load_test/search_page/locustfile.py --host http://localhost:5000
+
+import os
 import random
+import sys
+
 from locust import HttpUser, task, between
 
-BLAZEGRAPH_URL = 'https://polifonia.disi.unibo.it/fonn/sparql'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
-def get_tune_given_name2(name):
-    sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
-                        PREFIX mm: <http://w3id.org/polifonia/ontology/music-meta/>
-                        SELECT DISTINCT ?tune_name ?tuneType ?key ?signature
-                        {
-                            ?tune mm:title ?tune_name.
-                            ?tune jams:tuneType ?tuneType.
-                            ?tune jams:key ?key.
-                            ?tune jams:timeSignature ?signature .
-                            FILTER (CONTAINS( ?tune_name, \"""" + name + """\" )).
-                        } LIMIT 10
-                     """
-    return sparql_query
+from load_test.flows import LocustSession, search_page_flow, search_terms  # noqa: E402
 
 
 class ApiUser(HttpUser):
     wait_time = between(1, 2)  # Wait between 1 to 2 seconds between tasks
-    names = ["Maggie", "Johnny", "DE RUITER", "Foxhunters", "First Of May", "College Groves", "Gilderoy", "PINKSTERLIED I"]
+    terms = search_terms()
 
     @task
-    def make_api_calls(self):
-        idxs = list(range(len(self.names)))
-        random.shuffle(idxs)
-
-        query = get_tune_given_name2(self.names[idxs[0]])
-        response = self.client.post(
-            BLAZEGRAPH_URL,
-            data={
-                'query': query,
-                'format': 'json'
-            }
-        )
+    def search_page(self):
+        choice = random.randrange(len(self.terms))
+        search_page_flow(LocustSession(self.client), self.terms[choice], choice)
@@ -0,0 +1,135 @@
+# A local stand-in for the Blazegraph SPARQL endpoint, used by the benchmarks.
+#
+# Run it on its own with:
+#     python -m load_test.sparql_stub --port 9999 --latency 0.05
+# and point BLAZEGRAPH_URL at http://localhost:9999/sparql.
+
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+SELECT_VARS = re.compile(r'SELECT\s+(?:DISTINCT\s+)?(.*?)\s*(?:WHERE|\{)', re.IGNORECASE | re.DOTALL)
+
+
+# Build an empty SPARQL JSON result whose head lists the variables selected by the query.
+def empty_results(sparql_query):
+    match = SELECT_VARS.search(sparql_query)
+    projection = match.group(1) if match else ''
+    # Drop aggregate expressions such as (count(?p) as ?freq) but keep their alias.
+    projection = re.sub(r'\(.*?\bas\s+\?(\w+)\s*\)', r'?\1', projection, flags=re.IGNORECASE)
+    variables = re.findall(r'\?(\w+)', projection)
+    return {"head": {"vars": variables}, "results": {"bindings": []}}
+
+
+class StubSparqlServer(ThreadingHTTPServer):
+    """A threaded HTTP/1.1 server answering SPARQL POSTs with canned JSON results.
+
+    `responder` maps the query text to a results dict. `latency` seconds are slept
+    before every answer to imitate the upstream round-trip, varied by up to `jitter`
+    times the latency either way. The server counts the
+    TCP connections it accepts so callers can check that connections are reused.
+
+    Faults are injected at random, and can be changed while the server runs: a fraction
+    `error_rate` of the queries fail with a 500, and a fraction `slow_rate` is answered after
+    `slow_latency` seconds instead.
+    """
+
+    daemon_threads = True
+    # Load tests open many connections at once; the default backlog of 5 would reset some.
+    request_queue_size = 1024
+
+    def __init__(self, address=('127.0.0.1', 0), responder=empty_results, latency=0.0, jitter=0.0,
+                 error_rate=0.0, slow_rate=0.0, slow_latency=1.0):
+        super().__init__(address, StubSparqlHandler)
+        self.responder = responder
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/sparql'
+
+    def count(self, attribute):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def reset_counters(self):
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+            self.errors = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubSparqlHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def do_POST(self):
+        self.server.count('requests')
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        sparql_query = form.get('query', [''])[0]
+        if self.server.slow_rate and random.random() < self.server.slow_rate:
+            time.sleep(self.server.slow_latency)
+        elif self.server.latency:
+            time.sleep(self.server.latency * random.uniform(1 - self.server.jitter, 1 + self.server.jitter))
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count('errors')
+            self.send_error(500, "Injected failure")
+            return
+        body = json.dumps(self.server.responder(sparql_query)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub SPARQL endpoint.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds slept before each answer.")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Latency variation, as a fraction of it.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of the queries failing with a 500.")
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help="Fraction of the queries answered after --slow-latency seconds.")
+    parser.add_argument('--slow-latency', type=float, default=1.0)
+    args = parser.parse_args()
+    server = StubSparqlServer((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                              error_rate=args.error_rate, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    print(f"Stub SPARQL endpoint listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,140 @@
+# Synthetic, reproducible data for the benchmarks: tune titles and search queries.
+
+import random
+from itertools import accumulate
+
+COMMON_WORDS = [
+    "the", "of", "and", "a", "in", "to", "my", "on", "an", "o",
+    "reel", "jig", "hornpipe", "polka", "slide", "waltz", "march", "air", "mazurka", "set",
+    "lass", "lad", "boys", "girls", "piper", "fiddler", "drover", "sailor", "soldier", "miller",
+    "green", "blue", "high", "lonesome", "merry", "wild", "old", "new", "little", "bonny",
+]
+SYLLABLES = [
+    "ba", "bal", "bally", "ben", "bra", "ca", "car", "con", "cul", "da", "der", "dun", "el", "en", "fa",
+    "fer", "gal", "glen", "gor", "ha", "hen", "in", "ish", "kil", "kin", "la", "lin", "lough", "ma", "mor",
+    "na", "ney", "o", "ock", "pa", "per", "ra", "ric", "ro", "sa", "sha", "sli", "ta", "ter", "tra", "van",
+    "we", "win", "ya", "zo",
+]
+
+
+# Return a vocabulary of common words followed by `size` pseudo-words, most frequent first.
+def make_vocabulary(size, rng):
+    words = dict.fromkeys(COMMON_WORDS)
+    while len(words) < len(COMMON_WORDS) + size:
+        words["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))] = None
+    return list(words)
+
+
+# Return a {id: title} dict of `size` distinct synthetic tune titles.
+# Words are drawn with Zipf-like frequencies, so a few words are very common and most are rare.
+def make_titles(size, seed=0, vocabulary_size=None):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size or max(size // 5, 100), rng)
+    # Cumulated once: rng.choices would otherwise sum the weights of the whole vocabulary per title.
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    names = {}
+    while len(names) < size:
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(2, 6))
+        title = " ".join(words).title()
+        names[f"tune_{len(names)}"] = f"{title} {rng.randint(1, 99)}" if rng.random() < 0.2 else title
+    return names
+
+
+# Introduce one random character edit (delete, insert, substitute or swap) into a string.
+def add_typo(text, rng):
+    if len(text) < 2:
+        return text
+    i = rng.randrange(len(text) - 1)
+    edit = rng.randrange(4)
+    letter = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    if edit == 0:
+        return text[:i] + text[i + 1:]
+    if edit == 1:
+        return text[:i] + letter + text[i:]
+    if edit == 2:
+        return text[:i] + letter + text[i + 1:]
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+# Return `count` search queries: titles with a typo, partial titles and unrelated strings.
+def make_queries(names, count, seed=1):
+    rng = random.Random(seed)
+    titles = list(names.values())
+    queries = []
+    for n in range(count):
+        title = rng.choice(titles)
+        if n % 3 == 0:
+            queries.append(add_typo(title, rng))
+        elif n % 3 == 1:
+            words = title.split()
+            queries.append(" ".join(words[:max(1, len(words) // 2)]))
+        else:
+            queries.append("".join(rng.choice("qxzvkjwy") for _ in range(rng.randint(3, 8))))
+    return queries
+
+
+def literal(value):
+    return {'type': 'literal', 'value': str(value)}
+
+
+# Return SPARQL JSON results shaped like get_tune_pattern_observations and get_tune_titles_and_families:
+# `tunes` tunes with `patterns_per_tune` patterns each on average, drawn with Zipf-like frequencies.
+def make_observations(tunes, patterns, patterns_per_tune=20, seed=0):
+    rng = random.Random(seed)
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(patterns)))
+    complexities = [round(rng.random(), 3) for _ in range(patterns)]
+    observations, titles = [], []
+    for tune in range(tunes):
+        tune_id = f"tune_{tune}"
+        counts = {}
+        for pattern in rng.choices(range(patterns), cum_weights=cum_weights, k=rng.randint(1, 2 * patterns_per_tune)):
+            counts[pattern] = counts.get(pattern, 0) + 1
+        for pattern, count in counts.items():
+            observations.append({'id': literal(tune_id),
+                                 'patternURI': {'type': 'uri', 'value': f"http://example.org/pattern/{pattern}"},
+                                 'complexity': literal(complexities[pattern]), 'count': literal(count)})
+        if rng.random() < 0.95:
+            row = {'id': literal(tune_id), 'title': literal(f"Tune {tune}")}
+            if rng.random() < 0.3:
+                row['family'] = literal(f"Family {tune % 97}")
+            titles.append(row)
+    return ({'head': {'vars': ['id', 'patternURI', 'complexity', 'count']}, 'results': {'bindings': observations}},
+            {'head': {'vars': ['id', 'title', 'family']}, 'results': {'bindings': titles}})
+
+
+# Return a copy of make_observations results where `fraction` of the tunes have new pattern counts.
+def change_observations(observationsJSON, fraction, seed=2):
+    rng = random.Random(seed)
+    tune_ids = sorted({item['id']['value'] for item in observationsJSON['results']['bindings']})
+    changed = set(rng.sample(tune_ids, max(1, int(len(tune_ids) * fraction))))
+    bindings = [dict(item, count=literal(int(item['count']['value']) + 1)) if item['id']['value'] in changed
+                else item for item in observationsJSON['results']['bindings']]
+    return {'head': observationsJSON['head'], 'results': {'bindings': bindings}}
+
+
+# Facet values of the synthetic tune metadata, most frequent first.
+TUNE_FACETS = {
+    'corpus': ["Irish", "Scottish", "English", "Breton", "Swedish", "Cape Breton"],
+    'tuneType': ["reel", "jig", "hornpipe", "polka", "slide", "waltz", "march", "air", "mazurka", "slip jig"],
+    'key': ["D", "G", "A", "Em", "Am", "C", "Bm", "F", "Dmix", "Ador"],
+    'timeSignature': ["4/4", "6/8", "2/4", "3/4", "9/8", "12/8"],
+}
+
+
+# Return SPARQL JSON results shaped like get_advanced_search_tune_ids and, per field,
+# get_advanced_search_field_values: `tunes` tunes with titles from make_titles, each with mostly one
+# (sometimes no or two) value of every facet.
+def make_tune_metadata(tunes, seed=0):
+    rng = random.Random(seed)
+    titles = make_titles(tunes, seed)
+    fields = {field: [] for field in ['title', *TUNE_FACETS]}
+    for tune_id, title in titles.items():
+        fields['title'].append({'id': literal(tune_id), 'value': literal(title)})
+        for field, values in TUNE_FACETS.items():
+            weights = [1 / (rank + 1) for rank in range(len(values))]
+            count = rng.choices([0, 1, 2], [0.05, 0.85, 0.1])[0]
+            for value in set(rng.choices(values, weights, k=count)):
+                fields[field].append({'id': literal(tune_id), 'value': literal(value)})
+    return ({'head': {'vars': ['id']}, 'results': {'bindings': [{'id': literal(tune_id)} for tune_id in titles]}},
+            {field: {'head': {'vars': ['id', 'value']}, 'results': {'bindings': bindings}}
+             for field, bindings in fields.items()})
@@ -0,0 +1,305 @@
+# A synthetic knowledge graph answering every query of query_factory.py by its shape, for recording
+# the fixtures of the benchmark suite (see load_test/fixtures.py) without the real endpoint.
+#
+# Tunes have the titles and advanced search facets of synthetic.make_tune_metadata and the pattern
+# observations of synthetic.make_observations; some belong to a tune family. The answers are
+# consistent with each other (the patterns of a tune page contain the tune, its neighbours share
+# patterns with it, ...), so the user flows can follow the links between responses as the GUI does.
+
+import re
+
+from load_test.sparql_stub import empty_results
+from load_test.synthetic import literal, make_observations, make_tune_metadata
+
+TUNE_BASE_IRI = "http://w3id.org/polifonia/harmory/"
+PATTERN_BASE_IRI = TUNE_BASE_IRI + "pattern/"
+INTEGER_DATATYPE = "http://www.w3.org/2001/XMLSchema#integer"
+NUM_COMMON_PATTERNS = 18
+
+QUOTED = re.compile(r'"([^"]*)"')
+PAGE = re.compile(r'\s*(?:LIMIT\s+(\d+)(?:\s+OFFSET\s+(\d+))?|OFFSET\s+(\d+)\s+LIMIT\s+(\d+))\s*$')
+COUNT_WRAPPER = "SELECT (COUNT(*) AS ?count) WHERE { SELECT"
+
+
+def uri(value):
+    return {'type': 'uri', 'value': value}
+
+
+def integer(value):
+    return {'datatype': INTEGER_DATATYPE, 'type': 'literal', 'value': str(value)}
+
+
+def results(variables, bindings):
+    return {"head": {"vars": list(variables)}, "results": {"bindings": bindings}}
+
+
+# The quoted string following `marker` in a query.
+def quoted_after(sparql_query, marker):
+    match = QUOTED.search(sparql_query, sparql_query.index(marker) + len(marker))
+    return match.group(1) if match else ''
+
+
+# The quoted strings of the VALUES block following `marker`.
+def values_after(sparql_query, marker):
+    start = sparql_query.index(marker)
+    return QUOTED.findall(sparql_query[start:sparql_query.index('}', start)])
+
+
+class SyntheticKG:
+    """A SPARQL stub responder (query text -> results dict) over a synthetic knowledge graph."""
+
+    def __init__(self, tunes=2000, patterns=400, patterns_per_tune=15, families=60, seed=0, version="synthetic-1"):
+        self.version = version
+        idsJSON, fieldsJSON = make_tune_metadata(tunes, seed)
+        self.metadata = (idsJSON, fieldsJSON)
+        self.tune_ids = [item['id']['value'] for item in idsJSON['results']['bindings']]
+        self.titles = {item['id']['value']: item['value']['value'] for item in fieldsJSON['title']['results']['bindings']}
+        self.facets = {}
+        for field, resultsJSON in fieldsJSON.items():
+            values = self.facets[field] = {}
+            for item in resultsJSON['results']['bindings']:
+                values.setdefault(item['id']['value'], []).append(item['value']['value'])
+        self.families = {tune_id: f"Family {index // 3 % families}" for index, tune_id in enumerate(self.tune_ids)
+                         if index % 3 == 0}
+        observationsJSON, _ = make_observations(tunes, patterns, patterns_per_tune, seed)
+        self.tune_patterns, self.pattern_tunes, self.complexity = {}, {}, {}
+        for item in observationsJSON['results']['bindings']:
+            label = self.pattern_label(int(item['patternURI']['value'].rsplit('/', 1)[1]))
+            count = int(item['count']['value'])
+            self.tune_patterns.setdefault(item['id']['value'], {})[label] = count
+            self.pattern_tunes.setdefault(label, {})[item['id']['value']] = count
+            self.complexity[label] = float(item['complexity']['value'])
+        self.handlers = [
+            ('jams:release ?version', self.kg_version),
+            ('SELECT DISTINCT ?title ?id', self.all_tune_names),
+            ('SELECT ?patternLabel ?title', self.pattern_search_batch),
+            ('SELECT ?title ?genre ?artist ?id', self.title_or_pattern_search),
+            ('SELECT ?id ?title ?genre ?artist', self.tune_data_batch),
+            ('SELECT ?title ?genre ?artist', self.tune_data),
+            ('SELECT DISTINCT ?title ?tuneType ?key ?signature ?id', self.advanced_search),
+            ('SELECT DISTINCT ?id ?value', self.field_values),
+            ('xyz:pattern_content "', self.tune_ids_with_pattern),
+            ('SELECT DISTINCT ?id', self.advanced_search_tune_ids),
+            ('SELECT ?id ?pattern (count(?pattern)', self.patterns_of_tunes),
+            ('SELECT ?pattern (count(?pattern)', self.most_common_patterns),
+            ('?tune2 rdf:type', self.common_patterns),
+            ('SELECT ?pattern', self.ranked_patterns),
+            ('SELECT ?title ?id ?genre', self.ranked_tunes_by_pattern),
+            ('SELECT ?title ?id ?family', self.ranked_neighbour_tunes),
+            ('SELECT ?title ?id ?type', self.family_members),
+            ('SELECT ?tune ?pattern (COUNT(?segment)', self.incidence),
+            ('SELECT DISTINCT ?pattern ?label', self.pattern_labels),
+            ('SELECT ?tune ?title ?genre ?artist', self.tune_metadata),
+            ('SELECT ?id ?patternURI ?complexity', self.observations),
+            ('SELECT ?id ?title ?family', self.titles_and_families),
+            ('SELECT DISTINCT ?corpus', lambda q: self.facet_list('corpus', 'corpus')),
+            ('SELECT DISTINCT ?key', lambda q: self.facet_list('key', 'key')),
+            ('SELECT DISTINCT ?signature', lambda q: self.facet_list('timeSignature', 'signature')),
+            ('SELECT DISTINCT ?genre', lambda q: self.facet_list('tuneType', 'genre')),
+        ]
+
+    @staticmethod
+    def pattern_label(number):
+        # Interval-like labels, safe in URLs.
+        return "-".join(str((number * 7 + step * (number % 5 + 1)) % 12) for step in range(4)) + f"-{number}"
+
+    def pattern_iri(self, label):
+        return PATTERN_BASE_IRI + label
+
+    def __call__(self, sparql_query):
+        if COUNT_WRAPPER in sparql_query:
+            prologue, _, inner = sparql_query.partition(COUNT_WRAPPER)
+            count = len(self(prologue + "SELECT" + inner.rstrip()[:-1])['results']['bindings'])
+            return results(['count'], [{'count': integer(count)}])
+        page = PAGE.search(sparql_query)
+        if page:
+            limit, offset = (page.group(1), page.group(2) or 0) if page.group(1) else (page.group(4), page.group(3))
+            limit, offset = int(limit), int(offset)
+            answer = self(sparql_query[:page.start()])
+            bindings = answer['results']['bindings'][offset:offset + limit]
+            return results(answer['head']['vars'], bindings)
+        for marker, handler in self.handlers:
+            if marker in sparql_query:
+                return handler(sparql_query)
+        return empty_results(sparql_query)
+
+    def tune_row(self, tune_id, variables):
+        row = {}
+        if 'title' in variables and tune_id in self.titles:
+            row['title'] = literal(self.titles[tune_id])
+        if 'genre' in variables and self.facets['tuneType'].get(tune_id):
+            row['genre'] = literal(self.facets['tuneType'][tune_id][0])
+        if 'family' in variables and tune_id in self.families:
+            row['family'] = literal(self.families[tune_id])
+        if 'id' in variables:
+            row['id'] = literal(tune_id)
+        return row
+
+    def kg_version(self, sparql_query):
+        return results(['version'], [{'version': literal(self.version)}])
+
+    def all_tune_names(self, sparql_query):
+        return results(['title', 'id'], [self.tune_row(tune_id, ('title', 'id')) for tune_id in self.titles])
+
+    def tune_data(self, sparql_query):
+        tune_id = quoted_after(sparql_query, 'harmory/",')
+        if tune_id not in self.titles:
+            return results(['title', 'genre', 'artist'], [])
+        return results(['title', 'genre', 'artist'], [self.tune_row(tune_id, ('title', 'genre'))])
+
+    def tune_data_batch(self, sparql_query):
+        ids = values_after(sparql_query, 'VALUES ?id')
+        return results(['id', 'title', 'genre', 'artist'],
+                       [self.tune_row(tune_id, ('id', 'title', 'genre')) for tune_id in ids if tune_id in self.titles])
+
+    def tunes_with_label(self, label):
+        return sorted(self.pattern_tunes.get(label, {}), key=lambda tune_id: (self.titles.get(tune_id, ''), tune_id))
+
+    def title_or_pattern_search(self, sparql_query):
+        variables = ('title', 'genre', 'artist', 'id')
+        if 'VALUES (?title ?match_strength ?id)' in sparql_query:
+            matches = values_after(sparql_query, 'VALUES (?title ?match_strength ?id)')
+            triples = [matches[i:i + 3] for i in range(0, len(matches) - 2, 3)]
+            triples.sort(key=lambda triple: (-int(triple[1]), triple[0], triple[2]))
+            return results(variables, [self.tune_row(tune_id, variables) for title, _, tune_id in triples
+                                       if self.titles.get(tune_id) == title])
+        label = quoted_after(sparql_query, 'rdfs:label')
+        return results(variables, [self.tune_row(tune_id, variables) for tune_id in self.tunes_with_label(label)])
+
+    def pattern_search_batch(self, sparql_query):
+        variables = ('title', 'genre', 'artist', 'id')
+        bindings = []
+        for label in sorted(values_after(sparql_query, 'VALUES ?patternLabel')):
+            bindings.extend(dict(self.tune_row(tune_id, variables), patternLabel=literal(label))
+                            for tune_id in self.tunes_with_label(label))
+        return results(['patternLabel', *variables], bindings)
+
+    def advanced_search(self, sparql_query):
+        candidates = self.tune_ids
+        if 'xyz:pattern_content "' in sparql_query:
+            candidates = [tune_id for tune_id in candidates
+                          if tune_id in self.pattern_tunes.get(quoted_after(sparql_query, 'xyz:pattern_content'), {})]
+        for field, variable in (('corpus', 'corpus'), ('tuneType', 'tuneType'), ('key', 'key'),
+                                ('timeSignature', 'signature')):
+            marker = f'VALUES (?{variable})'
+            if marker in sparql_query:
+                wanted = set(values_after(sparql_query, marker))
+                candidates = [tune_id for tune_id in candidates if wanted & set(self.facets[field].get(tune_id, ()))]
+        strengths = {}
+        if 'VALUES(?title ?match_strength ?id)' in sparql_query:
+            matches = values_after(sparql_query, 'VALUES(?title ?match_strength ?id)')
+            strengths = {matches[i + 2]: int(matches[i + 1]) for i in range(0, len(matches) - 2, 3)}
+            candidates = [tune_id for tune_id in candidates if tune_id in strengths]
+        rows = []
+        for tune_id in candidates:
+            row = self.tune_row(tune_id, ('title', 'id'))
+            for field, variable in (('tuneType', 'tuneType'), ('key', 'key'), ('timeSignature', 'signature')):
+                values = self.facets[field].get(tune_id)
+                if values:
+                    row[variable] = literal(values[0])
+            rows.append(row)
+        rows.sort(key=lambda row: (-strengths.get(row['id']['value'], 0), row.get('title', {}).get('value', ''),
+                                   row['id']['value']))
+        return results(['title', 'tuneType', 'key', 'signature', 'id'], rows)
+
+    def advanced_search_tune_ids(self, sparql_query):
+        return self.metadata[0]
+
+    def field_values(self, sparql_query):
+        for field, marker in (('title', 'core:title ?value'), ('corpus', 'core:isMemberOf'),
+                              ('tuneType', 'mm:hasFormType'), ('key', 'mm:hasKey'),
+                              ('timeSignature', 'jams:timeSignature')):
+            if marker in sparql_query:
+                return self.metadata[1][field]
+        return empty_results(sparql_query)
+
+    def tune_ids_with_pattern(self, sparql_query):
+        label = quoted_after(sparql_query, 'xyz:pattern_content')
+        return results(['id'], [{'id': literal(tune_id)} for tune_id in self.pattern_tunes.get(label, {})])
+
+    def ranked_labels(self, tune_id):
+        return sorted(self.tune_patterns.get(tune_id, {}).items(), key=lambda entry: (-entry[1], entry[0]))
+
+    def most_common_patterns(self, sparql_query):
+        tune_id = quoted_after(sparql_query, 'harmory/",')
+        return results(['pattern', 'patternFreq'],
+                       [{'pattern': uri(self.pattern_iri(label)), 'patternFreq': integer(count)}
+                        for label, count in self.ranked_labels(tune_id)])
+
+    def patterns_of_tunes(self, sparql_query):
+        bindings = []
+        for tune_id in sorted(values_after(sparql_query, 'VALUES ?id')):
+            bindings.extend({'id': literal(tune_id), 'pattern': uri(self.pattern_iri(label)),
+                             'patternFreq': integer(count)} for label, count in self.ranked_labels(tune_id))
+        return results(['id', 'pattern', 'patternFreq'], bindings)
+
+    def common_patterns(self, sparql_query):
+        first = quoted_after(sparql_query, '?tune1 core:id')
+        second = quoted_after(sparql_query, '?tune2 core:id')
+        shared = set(self.tune_patterns.get(first, {})) & set(self.tune_patterns.get(second, {}))
+        if 'pattern_complexity' in sparql_query.split('?tune2', 1)[0]:
+            shared = {label for label in shared if self.complexity[label] > 0.4}
+        ranked = sorted(shared, key=lambda label: (-self.tune_patterns[first][label], label))
+        return results(['pattern'], [{'pattern': literal(label)} for label in ranked])
+
+    def ranked_patterns(self, sparql_query):
+        tune_id = quoted_after(sparql_query, 'harmory/",')
+        return results(['pattern'], [{'pattern': uri(self.pattern_iri(label))}
+                                     for label, _ in self.ranked_labels(tune_id)])
+
+    def ranked_tunes_by_pattern(self, sparql_query):
+        label = quoted_after(sparql_query, 'rdfs:label')
+        tunes = self.pattern_tunes.get(label, {})
+        ranked = sorted(tunes, key=lambda tune_id: (-tunes[tune_id], self.titles.get(tune_id, ''), tune_id))
+        return results(['title', 'id', 'genre'], [self.tune_row(tune_id, ('title', 'id', 'genre')) for tune_id in ranked])
+
+    def ranked_neighbour_tunes(self, sparql_query):
+        tune_id = quoted_after(sparql_query, '?givenTune core:id')
+        scores = {}
+        for label, count in self.tune_patterns.get(tune_id, {}).items():
+            for other, other_count in self.pattern_tunes[label].items():
+                if other != tune_id and other in self.titles:
+                    scores[other] = scores.get(other, 0) + count * other_count * self.complexity[label]
+        ranked = sorted(scores, key=lambda other: (-scores[other], other))
+        return results(['title', 'id', 'family'], [self.tune_row(other, ('title', 'id', 'family')) for other in ranked])
+
+    def family_members(self, sparql_query):
+        family = quoted_after(sparql_query, 'mm:tuneFamilyName')
+        members = sorted((tune_id for tune_id, name in self.families.items() if name == family),
+                         key=lambda tune_id: self.titles.get(tune_id, ''))
+        bindings = []
+        for tune_id in members:
+            row = self.tune_row(tune_id, ('title', 'id'))
+            if self.facets['tuneType'].get(tune_id):
+                row['type'] = literal(self.facets['tuneType'][tune_id][0])
+            bindings.append(row)
+        return results(['title', 'id', 'type'], bindings)
+
+    def incidence(self, sparql_query):
+        return results(['tune', 'pattern', 'count'],
+                       [{'tune': uri(TUNE_BASE_IRI + tune_id), 'pattern': uri(self.pattern_iri(label)),
+                         'count': integer(count)}
+                        for tune_id, counts in self.tune_patterns.items() for label, count in counts.items()])
+
+    def pattern_labels(self, sparql_query):
+        return results(['pattern', 'label'], [{'pattern': uri(self.pattern_iri(label)), 'label': literal(label)}
+                                              for label in self.pattern_tunes])
+
+    def tune_metadata(self, sparql_query):
+        return results(['tune', 'title', 'genre', 'artist'],
+                       [dict(self.tune_row(tune_id, ('title', 'genre')), tune=uri(TUNE_BASE_IRI + tune_id))
+                        for tune_id in self.tune_ids])
+
+    def observations(self, sparql_query):
+        return results(['id', 'patternURI', 'complexity', 'count'],
+                       [{'id': literal(tune_id), 'patternURI': uri(self.pattern_iri(label)),
+                         'complexity': literal(self.complexity[label]), 'count': literal(count)}
+                        for tune_id, counts in self.tune_patterns.items() for label, count in counts.items()])
+
+    def titles_and_families(self, sparql_query):
+        return results(['id', 'title', 'family'],
+                       [self.tune_row(tune_id, ('id', 'title', 'family')) for tune_id in self.titles])
+
+    def facet_list(self, field, variable):
+        values = sorted({value for values in self.facets[field].values() for value in values})
+        return results([variable], [{variable: literal(value)} for value in values])
@@ -0,0 +1,220 @@
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = 'pattern_explorations'
+# Upper bounds (in seconds) of the histogram buckets, from in-process phases of a tenth of a
+# millisecond to upstream queries timing out after a minute.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+DEFAULT_SLOW_QUERY_SECONDS = 1.0
+
+# Metric families: their type, help text and label names.
+FAMILIES = {
+    'request_seconds': ('histogram', "Time until the response to a request is ready (streamed bodies excluded).",
+                        ('route',)),
+    'responses_total': ('counter', "Responses sent, by status code.", ('route', 'status')),
+    'phase_seconds': ('histogram', "Time spent serving requests, by phase: fuzzy_match, build (a query_factory "
+                                   "function), upstream (SPARQL round trip), decode (SPARQL JSON results) and "
+                                   "encode (JSON responses).", ('route', 'phase', 'query')),
+    'upstream_responses_total': ('counter', "SPARQL endpoint responses, by status code ('error' when none came).",
+                                 ('route', 'query', 'status')),
+    'sparql_calls_total': ('counter', "SPARQL queries asked of the client, streamed ones excepted.", ('route', 'query')),
+    'sparql_coalesced_total': ('counter', "SPARQL queries answered by an identical query already in flight, rather "
+                                          "than sent (see sparql_calls_total).", ('route', 'query')),
+    'upstream_hedges_total': ('counter', "SPARQL queries sent again for want of a timely answer.", ('route', 'query')),
+    'upstream_hedge_wins_total': ('counter', "Hedged SPARQL queries answered first by their second attempt.",
+                                  ('route', 'query')),
+    'upstream_rejections_total': ('counter', "SPARQL queries not sent, by reason: circuit_open or budget_spent.",
+                                  ('route', 'query', 'reason')),
+    'upstream_circuit_opened_total': ('counter', "Times the circuit breaker of the SPARQL endpoint opened.", ()),
+    'upstream_circuit_state': ('gauge', "State of the circuit breaker of the SPARQL endpoint: 1 for the current "
+                                        "one of closed, open and half_open.", ('state',)),
+    'cache_lookups_total': ('counter', "Cache lookups, by result ('stale' for expired entries served, also "
+                                       "counted as misses).", ('cache', 'result')),
+    'cache_refreshes_total': ('counter', "Background refreshes of expired responses, by result: refreshed, failed or "
+                                         "dropped (too many waiting).", ('result',)),
+    'cache_warmup_requests_total': ('counter', "Requests sent by the cache warm-up.", ()),
+}
+
+# The route of the request being served, and the query_factory function that built the last query
+# of the current context: the labels of the timings recorded meanwhile. Work handed to other threads
+# keeps them when it runs in a copy of the context (contextvars.copy_context).
+current_route = contextvars.ContextVar('current_route', default='background')
+current_query = contextvars.ContextVar('current_query', default='')
+
+
+class Histogram:
+    """Counts of observed values per bucket, with their sum, as a Prometheus histogram."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+# Escape a label value for the Prometheus text format.
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{label_value(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metrics:
+    """Request, phase and upstream query timings, response status codes, cache lookups and the
+    values of registered collectors, rendered in the Prometheus text exposition format by `render`.
+
+    Timings are labelled by route and by the query_factory function that built the query (see
+    `query_builder`). Upstream queries taking `slow_query_seconds` or longer are logged with their
+    SPARQL text (None turns this off). When not `enabled`, nothing is recorded. Each process keeps
+    metrics of its own.
+    """
+
+    def __init__(self, enabled=True, slow_query_seconds=DEFAULT_SLOW_QUERY_SECONDS, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_seconds
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._counters = {}
+        self._caches = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        # A worker forked while another thread held the lock would never get it.
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def configure(self, enabled=True, slow_query_seconds=DEFAULT_SLOW_QUERY_SECONDS):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_seconds
+
+    def observe(self, family, value, *labels):
+        if not self.enabled:
+            return
+        key = (family, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def increment(self, family, *labels):
+        if not self.enabled:
+            return
+        key = (family, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def observe_request(self, route, seconds, status):
+        self.observe('request_seconds', seconds, route)
+        self.increment('responses_total', route, str(status))
+
+    def observe_phase(self, phase, seconds, query=''):
+        self.observe('phase_seconds', seconds, current_route.get(), phase, query)
+
+    @contextmanager
+    def timed(self, phase, query=''):
+        """Time the block as a phase of the current request."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - start, query)
+
+    def observe_query(self, sparql_query, seconds, status):
+        """Record the round trip of a query to the SPARQL endpoint, and log it if it was slow."""
+        if not self.enabled:
+            return
+        route, query = current_route.get(), current_query.get()
+        self.observe('phase_seconds', seconds, route, 'upstream', query)
+        self.increment('upstream_responses_total', route, query, str(status))
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            logger.warning("Slow SPARQL query (%.3f s, status %s, route %s, built by %s) = %s",
+                           seconds, status, route, query or '-', sparql_query)
+
+    def observe_coalescing(self, coalesced):
+        """Count a query asked of a SPARQL client and, if `coalesced`, answered by one in flight."""
+        if not self.enabled:
+            return
+        labels = (current_route.get(), current_query.get())
+        with self._lock:
+            for family in ('sparql_calls_total', 'sparql_coalesced_total') if coalesced else ('sparql_calls_total',):
+                key = (family, labels)
+                self._counters[key] = self._counters.get(key, 0) + 1
+
+    def register_cache(self, name, cache):
+        """Report the lookups of a cache counting its `hits` and `misses` (such as an LRUCache)."""
+        self._caches[name] = cache
+
+    def register_collector(self, collect):
+        """Report values kept elsewhere: `collect()` returns them as {(family, labels): value}."""
+        self._collectors.append(collect)
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            histograms = [(key, list(histogram.cumulative_counts()), histogram.sum)
+                          for key, histogram in self._histograms.items()]
+            counters = dict(self._counters)
+        for name, cache in self._caches.items():
+            counters[('cache_lookups_total', (name, 'hit'))] = cache.hits
+            counters[('cache_lookups_total', (name, 'miss'))] = cache.misses
+            if getattr(cache, 'stale_hits', None):
+                counters[('cache_lookups_total', (name, 'stale'))] = cache.stale_hits
+        for collect in self._collectors:
+            counters.update(collect())
+        lines = []
+        for family, (metric_type, help_text, label_names) in FAMILIES.items():
+            name = f'{NAMESPACE}_{family}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            if metric_type == 'histogram':
+                for (_, labels), counts, total in sorted(entry for entry in histograms if entry[0][0] == family):
+                    for bound, count in zip((*self.buckets, '+Inf'), counts):
+                        lines.append(f'{name}_bucket{format_labels(label_names, labels, [("le", bound)])} {count}')
+                    lines.append(f'{name}_sum{format_labels(label_names, labels)} {total}')
+                    lines.append(f'{name}_count{format_labels(label_names, labels)} {counts[-1]}')
+            else:
+                for (_, labels), value in sorted(entry for entry in counters.items() if entry[0][0] == family):
+                    lines.append(f'{name}{format_labels(label_names, labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics of the process: query_factory records the time its functions take here.
+registry = Metrics()
+
+
+def query_builder(function):
+    """Decorate a query_factory function: the queries sent after calling it in the same context are
+    labelled with its name, and the time it takes is recorded as the build phase."""
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        sparql_query = function(*args, **kwargs)
+        registry.observe_phase('build', time.perf_counter() - start, name)
+        current_query.set(name)
+        return sparql_query
+    return wrapper
@@ -0,0 +1,230 @@
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# Seconds a worker is given to finish its requests after SIGTERM, before it is killed.
+GRACEFUL_TIMEOUT = 30
+
+
+def process_memory(pid):
+    """Return the resident (rss), proportional (pss), shared and private memory of a process in
+    bytes, read from /proc (Linux only), or None if it cannot be read."""
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as rollup:
+            for line in rollup:
+                name, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return None
+    return {'rss': fields.get('Rss', 0), 'pss': fields.get('Pss', 0),
+            'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+            'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)}
+
+
+def format_memory(memory):
+    if memory is None:
+        return "memory unavailable"
+    return ", ".join(f"{name.upper() if name in ('rss', 'pss') else name} {size / 2**20:.1f} MB"
+                     for name, size in memory.items())
+
+
+def load_app(asgi=False):
+    """Import the app, building or mapping every index, and wait for its startup refreshes."""
+    import app
+    if asgi:
+        import asgi_app  # noqa: F401
+    app.kg_version_monitor.wait_for_refreshes()
+    return app
+
+
+def serve(listener, asgi=False):
+    """Serve requests from the listening socket until SIGTERM, then finish the requests in progress."""
+    if asgi:
+        import uvicorn
+        import asgi_app
+        uvicorn.Server(uvicorn.Config(asgi_app.app, fd=listener.fileno(), log_level='warning')).run()
+        return
+    from werkzeug.serving import make_server
+    import app
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, app.app, threaded=True, fd=listener.fileno())
+    # Request threads are joined by server_close.
+    server.daemon_threads = False
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+    server.server_close()
+
+
+class PreforkServer:
+    """Serves the app from `workers` processes forked from one master.
+
+    With `preload` the master loads the app once: the title index is swapped for the
+    memory-mapped snapshot, the other indexes are built, and the collector is frozen so that
+    forked workers share every page of them instead of copying them. The master then checks
+    the KG release itself; when it changes, the indexes are refreshed in the master and a new
+    generation of workers replaces the old one, which finishes its requests first. Without
+    `preload` every worker loads the app, and keeps it up to date, on its own.
+    """
+
+    def __init__(self, listener, workers=DEFAULT_WORKERS, asgi=False, preload=True):
+        self.listener = listener
+        self.worker_count = workers
+        self.asgi = asgi
+        self.preload = preload
+        self.app = None
+        self.workers = set()
+        self.retiring = {}
+        self._stopping = False
+        self._memory_report = False
+
+    def run(self):
+        if self.preload:
+            self.app = load_app(self.asgi)
+            # The master checks the release from its main loop, so that it never forks while a
+            # check or refresh is running.
+            self.app.kg_version_monitor.stop(wait=True)
+            self.app.kg_version_monitor.wait_for_refreshes()
+            self._share_indexes()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGUSR1, self._request_memory_report)
+        self._spawn_generation()
+        next_check = time.monotonic() + self._check_interval()
+        while not self._stopping:
+            self._reap()
+            if self._memory_report:
+                self._memory_report = False
+                self.report_memory()
+            if self.preload and time.monotonic() >= next_check:
+                monitor = self.app.kg_version_monitor
+                old_version = monitor.current()
+                if monitor.check() != old_version:
+                    self._reload()
+                next_check = time.monotonic() + self._check_interval()
+            while len(self.workers) < self.worker_count and not self._stopping:
+                self._spawn()
+            time.sleep(1)
+        self._shutdown()
+
+    def _check_interval(self):
+        return self.app.kg_version_monitor.check_interval if self.preload else float('inf')
+
+    def _share_indexes(self):
+        self.app.fuzzy_search.map_snapshot()
+        gc.collect()
+        gc.freeze()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return pid
+        # In the worker.
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            if not self.preload:
+                load_app(self.asgi)
+            logger.info("Worker %d serving", os.getpid())
+            serve(self.listener, self.asgi)
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def _spawn_generation(self):
+        for _ in range(self.worker_count):
+            self._spawn()
+        self.report_memory()
+
+    def _reload(self):
+        """Refresh the indexes in the master and replace every worker by one forked afterwards."""
+        logger.info("KG version changed to %s; replacing the workers", self.app.kg_version_monitor.current())
+        self.app.kg_version_monitor.wait_for_refreshes()
+        self._share_indexes()
+        old_workers, self.workers = self.workers, set()
+        self._spawn_generation()
+        self._retire(old_workers)
+
+    def _retire(self, pids):
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        for pid in pids:
+            self.retiring[pid] = deadline
+            self._signal(pid, signal.SIGTERM)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if pid in self.workers:
+                logger.warning("Worker %d exited with status %d; starting another one", pid, status)
+                self.workers.discard(pid)
+            self.retiring.pop(pid, None)
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now > deadline:
+                self._signal(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _request_memory_report(self, signum, frame):
+        self._memory_report = True
+
+    def _shutdown(self):
+        self._retire(self.workers)
+        self.workers = set()
+        while self.retiring:
+            self._reap()
+            time.sleep(0.1)
+
+    def report_memory(self):
+        """Log the memory of the master and of every worker (also on SIGUSR1)."""
+        logger.info("Master %d: %s", os.getpid(), format_memory(process_memory(os.getpid())))
+        for pid in sorted(self.workers):
+            logger.info("Worker %d: %s", pid, format_memory(process_memory(pid)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the API from pre-forked worker processes.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--asgi', action='store_true', help="Serve asgi_app with uvicorn in every worker.")
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help="Load the app in every worker instead of once in the master.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(levelname)s %(message)s')
+    listener = socket.create_server((args.host, args.port), backlog=1024)
+    listener.set_inheritable(True)
+    PreforkServer(listener, workers=args.workers, asgi=args.asgi, preload=args.preload).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 import requests
 
+from metrics import query_builder
+
 NUM_NODES = 5
+# Number of patterns listed for a tune, or for a pair of tunes.
+NUM_COMMON_PATTERNS = 18
 
 
 # A search for tunes containing a given pattern.
+@query_builder
 def get_pattern_search_query(pattern):
     sparql_query = """PREFIX har: <http://w3id.org/polifonia/harmory/>
                         PREFIX mf:  <http://w3id.org/polifonia/musical-features/>
@@ -24,7 +29,32 @@ def get_pattern_search_query(pattern):
     return sparql_query
 
 
+# Search for the tunes containing any of several patterns in one query, keyed by ?patternLabel.
+# The rows of each pattern are those of get_pattern_search_query, in the same order.
+@query_builder
+def get_pattern_search_query_batch(patterns):
+    sparql_query = """PREFIX har: <http://w3id.org/polifonia/harmory/>
+                        PREFIX mf:  <http://w3id.org/polifonia/musical-features/>
+                        PREFIX core:  <http://w3id.org/polifonia/core/>
+                        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+                        SELECT ?patternLabel ?title ?genre ?artist ?id
+                        WHERE
+                        {
+                            VALUES ?patternLabel { \"""" + '\" \"'.join(patterns) + """\" }
+                            ?segment har:hasSegmentPattern ?pattern.
+                            ?pattern rdfs:label ?patternLabel.
+                            ?segment har:belongsToMusicalWork ?tune .
+                            ?tune rdf:type core:MusicalWork.
+                            OPTIONAL {?tune core:hasTitle ?title}
+                            BIND(STRAFTER(STR(?tune), "http://w3id.org/polifonia/harmory/") AS ?id).
+                            OPTIONAL {?tune core:hasGenre ?genre.}
+                            OPTIONAL {?tune core:hasArtist ?artist.}
+                        } ORDER BY ?patternLabel ?title ?id"""
+    return sparql_query
+
+
 # Return a list of the most frequent patterns in a tune.
+@query_builder
 def get_most_common_patterns_for_a_tune(id, excludeTrivialPatterns):
     sparql_query = """PREFIX har: <http://w3id.org/polifonia/harmory/>
 
@@ -34,11 +64,30 @@ def get_most_common_patterns_for_a_tune(id, excludeTrivialPatterns):
                       ?segment har:belongsToMusicalWork ?tune .
                       ?segment har:hasSegmentPattern ?pattern.
                     } GROUP BY ?pattern
-                    ORDER BY DESC (?patternFreq) ?pattern LIMIT 18"""
+                    ORDER BY DESC (?patternFreq) ?pattern LIMIT """ + str(NUM_COMMON_PATTERNS)
+    return sparql_query
+
+
+# Return the patterns of several tunes with their frequencies in one query, keyed by ?id and ranked
+# as get_most_common_patterns_for_a_tune ranks them. Every pattern is returned: the caller keeps the
+# first NUM_COMMON_PATTERNS of each tune.
+@query_builder
+def get_most_common_patterns_for_tunes(ids):
+    sparql_query = """PREFIX har: <http://w3id.org/polifonia/harmory/>
+
+                    SELECT ?id ?pattern (count(?pattern) as ?patternFreq)
+                    WHERE {
+                      VALUES ?id { \"""" + '\" \"'.join(ids) + """\" }
+                      BIND(IRI(CONCAT("http://w3id.org/polifonia/harmory/", ?id)) AS ?tune)
+                      ?segment har:belongsToMusicalWork ?tune .
+                      ?segment har:hasSegmentPattern ?pattern.
+                    } GROUP BY ?id ?pattern
+                    ORDER BY ?id DESC (?patternFreq) ?pattern"""
     return sparql_query
 
 
 # Return a list of patterns contained in two tunes.
+@query_builder
 def get_patterns_in_common_between_two_tunes(id, prev, excludeTrivialPatterns):
     sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
                         PREFIX core:  <http://w3id.org/polifonia/ontology/core/>
@@ -64,12 +113,13 @@ def get_patterns_in_common_between_two_tunes(id, prev, excludeTrivialPatterns):
                             ?observation2 jams:ofPattern ?patternURI .
                             ?patternURI xyz:pattern_content ?pattern .
                         } GROUP BY ?pattern
-                        ORDER BY DESC (count(?pattern)) ?pattern LIMIT 18"""
+                        ORDER BY DESC (count(?pattern)) ?pattern LIMIT """ + str(NUM_COMMON_PATTERNS)
     return sparql_query
 
 
 # A fuzzy search of tune titles.
 # H
+@query_builder
 def get_tune_given_name(matched_ids):
     sparql_query =   """PREFIX har: <http://w3id.org/polifonia/harmory/>
                         PREFIX mf:  <http://w3id.org/polifonia/musical-features/>
@@ -89,6 +139,7 @@ def get_tune_given_name(matched_ids):
 
 
 # Advanced search.
+@query_builder
 def advanced_search(query_params, matched_ids):
     sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
                         PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
@@ -166,8 +217,94 @@ def advanced_search(query_params, matched_ids):
     return sparql_query
 
 
+# Restrict a query ending with its ORDER BY clause to `limit` rows from `offset`.
+def get_query_page(sparql_query, limit, offset):
+    return sparql_query + " LIMIT " + str(limit) + " OFFSET " + str(offset)
+
+
+# Count the rows of a SELECT query ending with its ORDER BY clause, by wrapping it, unordered, in a
+# COUNT sub-select.
+def get_result_count(sparql_query):
+    prologue, _, select = sparql_query.partition("SELECT")
+    where, order_by, ordering = select.rpartition("ORDER BY")
+    if not order_by or "}" in ordering:
+        where = select
+    return prologue + "SELECT (COUNT(*) AS ?count) WHERE { SELECT" + where + "}"
+
+
+# The triple patterns by which advanced_search matches each of its fields to a ?tune, with the field
+# value as ?value.
+ADVANCED_SEARCH_FIELD_PATTERNS = {
+    'title': """?tune core:title ?value .""",
+    'corpus': """?tune core:isMemberOf ?corpusURI .
+                            ?corpusURI core:isDefinedBy <http://w3id.org/polifonia/resource/tunes/CollectionConcept/ElectronicCollection>.
+                            ?corpusURI core:name ?value .""",
+    'tuneType': """?tune mm:hasFormType ?tuneTypeURI .
+                            ?tuneTypeURI core:name ?value .""",
+    'key': """?tune mm:hasKey ?keyURI .
+                            ?keyURI mm:tuneKeyName ?value .""",
+    'timeSignature': """?tune jams:timeSignature ?signatureURI .
+                            ?signatureURI mm:timesig ?value .""",
+}
+
+
+# Return the id of every tune the advanced search can return.
+@query_builder
+def get_advanced_search_tune_ids():
+    sparql_query = """PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                        PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                        SELECT DISTINCT ?id
+                        WHERE
+                        {
+                            ?tune rdf:type mm:MusicEntity.
+                            ?tune core:id ?id.
+                        }"""
+    return sparql_query
+
+
+# Return the (?id, ?value) pairs of one advanced search field (a key of ADVANCED_SEARCH_FIELD_PATTERNS)
+# for every tune.
+@query_builder
+def get_advanced_search_field_values(field):
+    sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
+                        PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                        PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                        SELECT DISTINCT ?id ?value
+                        WHERE
+                        {
+                            ?tune rdf:type mm:MusicEntity.
+                            """ + ADVANCED_SEARCH_FIELD_PATTERNS[field] + """
+                            ?tune core:id ?id.
+                        }"""
+    return sparql_query
+
+
+# Return the id of every tune containing a pattern, matched as advanced_search matches it.
+@query_builder
+def get_tune_ids_with_pattern_content(pattern):
+    sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
+                        PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                        PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                        PREFIX xyz:<http://sparql.xyz/facade-x/data/>
+                        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                        SELECT DISTINCT ?id
+                        WHERE
+                        {
+                            ?patternURI xyz:pattern_content \"""" + pattern + """\".
+                            ?obs jams:ofPattern ?patternURI.
+                            ?annotation jams:includesObservation ?obs.
+                            ?annotation jams:isJAMSAnnotationOf ?tune.
+                            ?tune rdf:type mm:MusicEntity.
+                            ?tune core:id ?id.
+                        }"""
+    return sparql_query
+
+
 # Return a list of all tune names for use by the fuzzy search algorithm.
 # H
+@query_builder
 def get_all_tune_names():
     sparql_query =   """PREFIX har: <http://w3id.org/polifonia/harmory/>
                         PREFIX mf:  <http://w3id.org/polifonia/musical-features/>
@@ -183,9 +320,104 @@ def get_all_tune_names():
     return sparql_query
 
 
+# Return the number of segments of every tune containing each pattern, for the local incidence index.
+@query_builder
+def get_tune_pattern_incidence():
+    sparql_query =   """PREFIX har: <http://w3id.org/polifonia/harmory/>
+                        SELECT ?tune ?pattern (COUNT(?segment) AS ?count)
+                        WHERE
+                        {
+                            ?segment har:belongsToMusicalWork ?tune .
+                            ?segment har:hasSegmentPattern ?pattern .
+                        } GROUP BY ?tune ?pattern"""
+    return sparql_query
+
+
+# Return the label of every pattern found in a segment, for the local incidence index.
+@query_builder
+def get_pattern_labels():
+    sparql_query =   """PREFIX har: <http://w3id.org/polifonia/harmory/>
+                        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+                        SELECT DISTINCT ?pattern ?label
+                        WHERE
+                        {
+                            ?segment har:hasSegmentPattern ?pattern .
+                            ?pattern rdfs:label ?label .
+                        }"""
+    return sparql_query
+
+
+# Return the title, genre and artist of every tune, for the local incidence index.
+@query_builder
+def get_tune_metadata():
+    sparql_query =   """PREFIX core:  <http://w3id.org/polifonia/core/>
+                        SELECT ?tune ?title ?genre ?artist
+                        WHERE
+                        {
+                            ?tune rdf:type core:MusicalWork.
+                            OPTIONAL {?tune core:hasTitle ?title}
+                            OPTIONAL {?tune core:hasGenre ?genre.}
+                            OPTIONAL {?tune core:hasArtist ?artist.}
+                        }"""
+    return sparql_query
+
+
+# Return the number of observations of every pattern in every tune, with the pattern complexity,
+# for precomputing the tune-tune similarities.
+@query_builder
+def get_tune_pattern_observations():
+    sparql_query =       """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
+                            PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                            PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                            PREFIX xyz:<http://sparql.xyz/facade-x/data/>
+                            PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                            SELECT ?id ?patternURI ?complexity (COUNT(*) AS ?count)
+                            WHERE
+                            {
+                                ?tune rdf:type mm:MusicEntity.
+                                ?tune core:id ?id.
+                                ?annot jams:isJAMSAnnotationOf ?tune.
+                                ?annot jams:includesObservation ?obs.
+                                ?obs jams:ofPattern ?patternURI.
+                                ?patternURI xyz:pattern_content ?pattern.
+                                ?patternURI xyz:pattern_complexity ?complexity.
+                            } GROUP BY ?id ?patternURI ?complexity"""
+    return sparql_query
+
+
+# Return the title and tune family of every tune, for precomputing the tune-tune similarities.
+@query_builder
+def get_tune_titles_and_families():
+    sparql_query =       """PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                            PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                            PREFIX tunes:<http://w3id.org/polifonia/ontology/tunes/>
+                            PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                            SELECT ?id ?title ?family
+                            WHERE
+                            {
+                                ?tune rdf:type mm:MusicEntity.
+                                ?tune core:id ?id.
+                                ?tune core:title ?title.
+                                OPTIONAL{?tune core:isMemberOf ?tuneFamilyURI.
+                                ?tuneFamilyURI rdf:type tunes:TuneFamily.
+                                ?tuneFamilyURI mm:tuneFamilyName ?family.}
+                            }"""
+    return sparql_query
+
+
 # Get the pattern node data for the tune-pattern network visualisation.
+@query_builder
 def get_neighbour_patterns_by_tune(id, click_num, excludeTrivialPatterns):
     offset = NUM_NODES*int(click_num)
+    sparql_query = get_ranked_neighbour_patterns_by_tune(id, excludeTrivialPatterns)
+    sparql_query += """
+                     OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+    return sparql_query
+
+
+# Get every pattern of a tune, most frequent first, for paging through the tune-pattern network.
+@query_builder
+def get_ranked_neighbour_patterns_by_tune(id, excludeTrivialPatterns):
     sparql_query =   """PREFIX har: <http://w3id.org/polifonia/harmory/>
 
                     SELECT ?pattern
@@ -194,14 +426,24 @@ def get_neighbour_patterns_by_tune(id, click_num, excludeTrivialPatterns):
                       ?segment har:belongsToMusicalWork ?tune .
                       ?segment har:hasSegmentPattern ?pattern.
                     } GROUP BY ?pattern
-                     ORDER BY DESC(COUNT(?pattern)) ?pattern
-                     OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+                     ORDER BY DESC(COUNT(?pattern)) ?pattern"""
     return sparql_query
 
 
 # Get the tune node data for the tune-pattern network visualisation.
+@query_builder
 def get_neighbour_tunes_by_pattern(pattern, click_num):
     offset = NUM_NODES*int(click_num)
+    sparql_query = get_ranked_neighbour_tunes_by_pattern(pattern)
+    sparql_query += """
+                        OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+    return sparql_query
+
+
+# Get every tune containing a pattern, most occurrences first, for paging through the tune-pattern network.
+# Every row is ordered, down to the genre of tunes with several, so that OFFSET pages are stable.
+@query_builder
+def get_ranked_neighbour_tunes_by_pattern(pattern):
     sparql_query =       """PREFIX har: <http://w3id.org/polifonia/harmory/>
                         PREFIX mf:  <http://w3id.org/polifonia/musical-features/>
                         PREFIX core:  <http://w3id.org/polifonia/core/>
@@ -216,12 +458,12 @@ def get_neighbour_tunes_by_pattern(pattern, click_num):
                             OPTIONAL {?tune core:hasTitle ?title}
                             BIND(STRAFTER(STR(?tune), "http://w3id.org/polifonia/harmory/") AS ?id).
                             OPTIONAL {?tune core:hasGenre ?genre.}
-                        }  GROUP BY ?id ?title ?genre ORDER BY DESC(COUNT(?pattern)) ?title ?id
-                        OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+                        }  GROUP BY ?id ?title ?genre ORDER BY DESC(COUNT(?pattern)) ?title ?id ?genre"""
     return sparql_query
 
 
 # Get tune data when composition page loads.
+@query_builder
 def get_tune_data(id):
     sparql_query =   """PREFIX har: <http://w3id.org/polifonia/harmory/>
                         PREFIX mf:  <http://w3id.org/polifonia/musical-features/>
@@ -238,7 +480,28 @@ def get_tune_data(id):
     return sparql_query
 
 
+# Get the tune data of several tunes in one query, keyed by ?id. The rows of each tune are those
+# of get_tune_data.
+@query_builder
+def get_tune_data_batch(ids):
+    sparql_query =   """PREFIX har: <http://w3id.org/polifonia/harmory/>
+                        PREFIX mf:  <http://w3id.org/polifonia/musical-features/>
+                        PREFIX core:  <http://w3id.org/polifonia/core/>
+                        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+                        SELECT ?id ?title ?genre ?artist
+                        WHERE {
+                            VALUES ?id { \"""" + '\" \"'.join(ids) + """\" }
+                            BIND(IRI(CONCAT("http://w3id.org/polifonia/harmory/", ?id)) AS ?tune)
+                            ?tune rdf:type core:MusicalWork.
+                            ?tune core:hasTitle ?title.
+                            OPTIONAL {?tune core:hasGenre ?genre.}
+                            OPTIONAL {?tune core:hasArtist ?artist.}
+                        }"""
+    return sparql_query
+
+
 # Get a list of member tunes of a given tune family for display on the tune family page.
+@query_builder
 def get_tune_family_members(family):
     sparql_query =       """PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
                             PREFIX core:  <http://w3id.org/polifonia/ontology/core/>
@@ -260,8 +523,20 @@ def get_tune_family_members(family):
 
 
 # Get the tune node data for the tune-tune network visualisation.
+@query_builder
 def get_neighbour_tunes_by_common_patterns(id, click_num):
     offset = NUM_NODES*int(click_num)
+    sparql_query = get_ranked_neighbour_tunes_by_common_patterns(id)
+    sparql_query += """
+                            OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+    return sparql_query
+
+
+# Get every tune sharing patterns with a tune, ranked by the complexity-weighted count of shared
+# patterns, for paging through the tune-tune network. Ties are ordered by id (and family), so that
+# pages taken with OFFSET neither skip nor repeat tunes.
+@query_builder
+def get_ranked_neighbour_tunes_by_common_patterns(id):
     sparql_query =       """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
                             PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
                             PREFIX core:<http://w3id.org/polifonia/ontology/core/>
@@ -293,12 +568,12 @@ def get_neighbour_tunes_by_common_patterns(id, click_num):
                                     ?patternURI xyz:pattern_complexity ?complexity.
                                 } GROUP BY ?title ?id ?family ?pattern ?complexity
                             } GROUP BY ?title ?id ?family
-                            ORDER BY DESC(SUM(?count_pattern_by_c))
-                            OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+                            ORDER BY DESC(SUM(?count_pattern_by_c)) ?id ?family"""
     return sparql_query
 
 
 # Return a list of all corpus values to populate the advanced search drop-down.
+@query_builder
 def get_corpus_list():
     sparql_query =   """PREFIX core:<http://w3id.org/polifonia/ontology/core/>
                         PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -315,6 +590,7 @@ def get_corpus_list():
 
 
 # Return a list of all key values to populate the advanced search drop-down.
+@query_builder
 def get_keys_list():
     sparql_query =   """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
                         PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
@@ -327,6 +603,7 @@ def get_keys_list():
 
 
 # Return a list of all time signature values to populate the advanced search drop-down.
+@query_builder
 def get_time_sig_list():
     sparql_query =   """PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
                         SELECT DISTINCT ?signature
@@ -338,6 +615,7 @@ def get_time_sig_list():
 
 
 # Return a list of all tune type values to populate the advanced search drop-down.
+@query_builder
 def get_tune_type_list():
     sparql_query =   """PREFIX core:  <http://w3id.org/polifonia/core/>
                         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -352,6 +630,7 @@ def get_tune_type_list():
 
 # Return the release version of the knowledge graph.
 # Is there a risk of multiple results?
+@query_builder
 def get_kg_version():
     sparql_query =   """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
                         SELECT DISTINCT ?version
@@ -0,0 +1,89 @@
+import json
+
+from query_factory import NUM_NODES, get_query_page
+from response_cache import LRUCache
+
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Longest ranked list fetched at once; pages past it fall back to a paged query.
+DEFAULT_MAX_LENGTH = 1000
+
+
+class PageCursorError(ValueError):
+    """Raised for a `cursor` or `click_num` page parameter that is not a valid number."""
+
+
+# Return the offset of the page asked for by a `cursor`, or else by `click_num`, parameter.
+def page_offset(query_params):
+    try:
+        if query_params.get('cursor'):
+            offset = int(query_params['cursor'])
+        else:
+            offset = NUM_NODES*int(query_params.get('click_num', 0))
+    except ValueError:
+        raise PageCursorError("cursor and click_num must be integers.") from None
+    if offset < 0:
+        raise PageCursorError("cursor and click_num must not be negative.")
+    return offset
+
+
+# Wrap a page of results with the `cursor` of the next page and `has_more`.
+def paged_results(head, page_bindings, offset, has_more, page_size=NUM_NODES):
+    return {
+        "head": head,
+        "results": {"bindings": page_bindings},
+        "cursor": str(offset + page_size) if has_more else None,
+        "has_more": has_more,
+    }
+
+
+# Cut the page of NUM_NODES results from `offset` out of complete ranked results.
+def page_results(results, offset):
+    bindings = results['results']['bindings']
+    return paged_results(results['head'], bindings[offset:offset + NUM_NODES], offset,
+                         offset + NUM_NODES < len(bindings))
+
+
+class RankedListCache(LRUCache):
+    """Caches complete ranked neighbour lists so that network pages are served as slices.
+
+    The neighbour queries rank every neighbour with a GROUP BY ... ORDER BY aggregation and
+    each "more" click used to re-run it with a new OFFSET. Here the ranked list is fetched
+    once per (query builder, arguments, KG version), up to `max_length` rows, and every page
+    is cut from it.
+    """
+
+    def __init__(self, sparql_client, version_provider, max_length=DEFAULT_MAX_LENGTH,
+                 max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, ttl=None):
+        super().__init__(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl,
+                         sizeof=lambda value: len(json.dumps(value)))
+        self.sparql_client = sparql_client
+        self.version_provider = version_provider
+        self.max_length = max_length
+
+    def invalidate(self, old_version=None, new_version=None):
+        self.clear()
+
+    def ranked_list(self, build_ranked_query, *args):
+        """Return the SPARQL JSON results of the ranked query, fetching them on a miss."""
+        key = (build_ranked_query.__name__, args, self.version_provider())
+        results = self.get(key)
+        if results is None:
+            sparql_query = build_ranked_query(*args) + " LIMIT " + str(self.max_length + 1)
+            results = self.sparql_client.query(sparql_query)
+            self.put(key, results)
+        return results
+
+    def page(self, build_ranked_query, args, offset):
+        """Return NUM_NODES results from `offset` with the `cursor` of the next page and `has_more`.
+
+        Pages beyond `max_length` are fetched with the ranked query restricted to them instead.
+        """
+        results = self.ranked_list(build_ranked_query, *args)
+        bindings = results['results']['bindings']
+        if offset + NUM_NODES > self.max_length and len(bindings) > self.max_length:
+            # One more row than the page, to know whether another page follows.
+            page = self.sparql_client.query(get_query_page(build_ranked_query(*args), NUM_NODES + 1, offset))
+            page_bindings = page['results']['bindings']
+            return paged_results(results['head'], page_bindings[:NUM_NODES], offset, len(page_bindings) > NUM_NODES)
+        return page_results(results, offset)
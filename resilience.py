@@ -0,0 +1,234 @@
+import contextvars
+import threading
+import time
+from collections import deque
+
+from metrics import current_query, current_route
+from sparql_client import SparqlQueryError
+
+DEFAULT_BUDGET = 15
+DEFAULT_HEDGE_QUANTILE = 0.95
+# Hedges are not sent sooner than this, however fast a query builder usually is.
+DEFAULT_HEDGE_MIN_DELAY = 0.05
+DEFAULT_TIMEOUT_FACTOR = 5
+DEFAULT_MIN_TIMEOUT = 5
+# Latencies kept per query builder, and needed before they are used to hedge or time out queries.
+DEFAULT_WINDOW = 200
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_SECONDS = 30
+
+# The time (time.monotonic) by which the upstream queries of the current request must have been
+# answered, or None for work outside requests.
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class UpstreamUnavailableError(SparqlQueryError):
+    """Raised instead of sending a query while the circuit breaker is open or once the request's
+    latency budget is spent. `retry_after` is the number of seconds the breaker stays open, if known."""
+
+    def __init__(self, message, sparql_query=None, retry_after=None):
+        super().__init__(message, sparql_query)
+        self.retry_after = retry_after
+
+
+# Whether a query status (an HTTP status code or 'error' when no response came) shows an unhealthy endpoint.
+def is_upstream_failure(status):
+    return status == 'error' or status >= 500
+
+
+class LatencyWindow:
+    """The latencies of the last `size` successful queries, with their quantiles.
+
+    Shared by the request threads, the hedges and the event loop of the ASGI app.
+    """
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+            self._sorted = None
+
+    def quantile(self, fraction):
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self.samples)
+            ordered = self._sorted
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures: queries are then refused for
+    `open_seconds`, after which a single trial query is let through (half open). Its success
+    closes the breaker, its failure opens it again. `opened` counts the times it opened."""
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, open_seconds=DEFAULT_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'half_open' if self.retry_after() == 0 else 'open'
+
+    def retry_after(self):
+        """Seconds until the open breaker lets a trial query through."""
+        if self._opened_at is None:
+            return 0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or self.retry_after() > 0:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self._opened_at is None and self.failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._trial = False
+                self.opened += 1
+
+
+class UpstreamGuard:
+    """Latency budgets, adaptive timeouts, hedging and a circuit breaker around the SPARQL endpoint.
+
+    `start_request` gives the current request the budget of its route (from `budgets`, else
+    `default_budget`): each of its queries may only take what is left of it, and none is sent once
+    it is spent. The clients ask `admit` for the timeout of every query; it also refuses queries
+    while the circuit `breaker` is open, raising UpstreamUnavailableError.
+
+    Latencies are kept per query_factory function: once there are `min_samples` of them, a query
+    still unanswered after their `hedge_quantile` is sent again (see `hedge_delay`) and its timeout
+    is `timeout_factor` times their p99, no less than `min_timeout`. None turns either off.
+    """
+
+    def __init__(self, budgets=None, default_budget=DEFAULT_BUDGET, hedge_quantile=DEFAULT_HEDGE_QUANTILE,
+                 hedge_min_delay=DEFAULT_HEDGE_MIN_DELAY, timeout_factor=DEFAULT_TIMEOUT_FACTOR,
+                 min_timeout=DEFAULT_MIN_TIMEOUT, window=DEFAULT_WINDOW, min_samples=DEFAULT_MIN_SAMPLES,
+                 breaker=None, metrics=None):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.window = window
+        self.min_samples = min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.rejections = 0
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def start_request(self, route):
+        budget = self.budgets.get(route, self.default_budget)
+        request_deadline.set(None if budget is None else time.monotonic() + budget)
+
+    def latencies(self, query):
+        with self._lock:
+            window = self._latencies.get(query)
+            if window is None:
+                window = self._latencies[query] = LatencyWindow(self.window)
+            return window
+
+    def admit(self, sparql_query, read_timeout):
+        """Return the timeout of a query about to be sent, or raise UpstreamUnavailableError."""
+        timeout = read_timeout
+        window = self.latencies(current_query.get())
+        if self.timeout_factor is not None and len(window) >= self.min_samples:
+            timeout = min(timeout, max(self.min_timeout, self.timeout_factor * window.quantile(0.99)))
+        timeout = self.within_budget(sparql_query, timeout)
+        # Last, as a half open breaker lets the first query it allows through as its trial.
+        if not self.breaker.allow():
+            self._reject('circuit_open')
+            raise UpstreamUnavailableError("The SPARQL endpoint is unavailable", sparql_query,
+                                           retry_after=self.breaker.retry_after())
+        return timeout
+
+    def within_budget(self, sparql_query, timeout):
+        """`timeout` cut to what is left of the current request's latency budget, or raise
+        UpstreamUnavailableError once it is spent. Also bounds the wait of a coalesced query."""
+        deadline = request_deadline.get()
+        if deadline is None:
+            return timeout
+        timeout = min(timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            self._reject('budget_spent')
+            raise UpstreamUnavailableError("The latency budget of the request is spent", sparql_query)
+        return timeout
+
+    def hedge_delay(self):
+        """Seconds after which a query of the current query builder is sent again, or None."""
+        if self.hedge_quantile is None:
+            return None
+        window = self.latencies(current_query.get())
+        if len(window) < self.min_samples:
+            return None
+        return max(self.hedge_min_delay, window.quantile(self.hedge_quantile))
+
+    def record(self, seconds, status):
+        """Record the outcome of a query sent (see metrics.Metrics.observe_query for `status`)."""
+        if is_upstream_failure(status):
+            opened = self.breaker.opened
+            self.breaker.record_failure()
+            if self.breaker.opened != opened and self.metrics is not None:
+                self.metrics.increment('upstream_circuit_opened_total')
+            return
+        if status == 200:
+            self.latencies(current_query.get()).add(seconds)
+        # Any answer, even rejecting the query, shows a responsive endpoint.
+        self.breaker.record_success()
+
+    def should_retry(self, error):
+        """Whether a failed query is sent again: the endpoint failed it rather than refused it."""
+        if not isinstance(error, SparqlQueryError) or isinstance(error, UpstreamUnavailableError):
+            return False
+        return error.status_code is None or is_upstream_failure(error.status_code)
+
+    def hedged(self):
+        self.hedges += 1
+        if self.metrics is not None:
+            self.metrics.increment('upstream_hedges_total', current_route.get(), current_query.get())
+
+    def hedge_won(self):
+        """Count a hedged query answered first by its second attempt."""
+        self.hedge_wins += 1
+        if self.metrics is not None:
+            self.metrics.increment('upstream_hedge_wins_total', current_route.get(), current_query.get())
+
+    def collect_metrics(self):
+        """The state of the circuit breaker, for metrics.Metrics.register_collector."""
+        state = self.breaker.state
+        return {('upstream_circuit_state', (name,)): int(name == state) for name in ('closed', 'open', 'half_open')}
+
+    def _reject(self, reason):
+        self.rejections += 1
+        if self.metrics is not None:
+            self.metrics.increment('upstream_rejections_total', current_route.get(), current_query.get(), reason)
@@ -0,0 +1,264 @@
+import functools
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+
+from sparql_client import SparqlQueryError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL = 24 * 60 * 60
+# Largest streamed response body kept while it is sent, to be cached once complete.
+DEFAULT_MAX_STREAMED_BYTES = 1024 * 1024
+DEFAULT_REFRESH_WORKERS = 2
+DEFAULT_MAX_PENDING_REFRESHES = 100
+
+
+class LRUCache:
+    """A thread-safe LRU cache with a time-to-live and a memory budget.
+
+    `sizeof` estimates the memory used by a value; entries are evicted, least recently
+    used first, until both the number of entries and their total size fit the limits.
+    A `ttl` of None keeps entries until they are evicted or the cache is cleared. Expired
+    entries are kept `stale_ttl` seconds longer for `get_stale`, though `get` misses them.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 ttl=DEFAULT_TTL, sizeof=sys.getsizeof, stale_ttl=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None or self._expired(entry):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key):
+        """Return the value of a key even if it expired less than `stale_ttl` seconds ago, else None."""
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return None
+            self.stale_hits += 1
+            return entry[0]
+
+    def _entry(self, key):
+        # The entry of a key, unless it is past its stale time (and then removed).
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl + self.stale_ttl:
+            self._remove(key)
+            return None
+        return entry
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.monotonic() - entry[2] > self.ttl
+
+    def put(self, key, value):
+        size = self.sizeof(key) + self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+
+class BackgroundRefresher:
+    """Runs the refreshes of cache entries on `workers` daemon threads, started on the first one.
+
+    At most `max_pending` refreshes wait for a thread; further ones are dropped, their entries
+    being refreshed by a later request. A key has one refresh at a time: submitting a key whose
+    refresh is waiting or running does nothing. `refreshed`, `failed` and `dropped` count them.
+    """
+
+    def __init__(self, workers=DEFAULT_REFRESH_WORKERS, max_pending=DEFAULT_MAX_PENDING_REFRESHES):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.refreshed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # A forked child has none of the threads of its parent, whose refreshes are left to it.
+        self._queue = queue.Queue(self.max_pending)
+        self._keys = set()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, key, function):
+        """Call `function` in the background unless `key` is being refreshed; return whether it will be."""
+        with self._lock:
+            if key in self._keys:
+                return False
+            try:
+                self._queue.put_nowait((key, function))
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._keys.add(key)
+            if not self._threads:
+                self._threads = [threading.Thread(target=self._run, name=f'cache-refresh-{n}', daemon=True)
+                                 for n in range(self.workers)]
+                for thread in self._threads:
+                    thread.start()
+        return True
+
+    def collect_metrics(self):
+        """The refresh counts, for metrics.Metrics.register_collector."""
+        return {('cache_refreshes_total', (outcome,)): getattr(self, outcome)
+                for outcome in ('refreshed', 'failed', 'dropped')}
+
+    def _run(self):
+        while True:
+            key, function = self._queue.get()
+            try:
+                function()
+                outcome = 'refreshed'
+            except SparqlQueryError:
+                # The client has already logged the failing query.
+                outcome = 'failed'
+            except Exception:
+                logger.exception("Refresh of cache entry %r failed", key)
+                outcome = 'failed'
+            with self._lock:
+                setattr(self, outcome, getattr(self, outcome) + 1)
+                self._keys.discard(key)
+
+
+class ResponseCache(LRUCache):
+    """Caches serialized JSON response bodies keyed on (endpoint, params, KG version).
+
+    `version_provider` returns the current knowledge graph release. Since every
+    endpoint is a pure function of its parameters and the release, a cached body stays
+    valid until the release changes, at which point `invalidate` drops every entry.
+    Streamed responses are cached when their body is no longer than `max_streamed_bytes`.
+    When a view fails with SparqlQueryError (such as while the endpoint is down), the body it
+    last returned is served instead if it is younger than `ttl + stale_ttl`. With a `refresher`
+    (a BackgroundRefresher), such an expired body is served at once and the view run again in the
+    background to replace it (stale-while-revalidate), so that no request waits for it.
+    """
+
+    def __init__(self, version_provider, max_streamed_bytes=DEFAULT_MAX_STREAMED_BYTES, refresher=None, **kwargs):
+        super().__init__(**kwargs)
+        self.version_provider = version_provider
+        self.max_streamed_bytes = max_streamed_bytes
+        self.refresher = refresher
+
+    def make_key(self, endpoint, params):
+        # Parameter order in the URL does not change the response, so sort it away.
+        normalized_params = tuple(sorted((name, tuple(values)) for name, values in params.lists()))
+        return endpoint, normalized_params, self.version_provider()
+
+    def invalidate(self, old_version=None, new_version=None):
+        self.clear()
+
+    def cached_view(self, view):
+        """Decorate a Flask view so that its successful JSON responses are cached."""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = self.make_key(request.path, request.args)
+            # Without a known KG release a cached body could outlive the data it came from.
+            if key[2] is None:
+                return view(*args, **kwargs)
+            body = self.get(key)
+            if body is None and self.refresher is not None:
+                body = self.get_stale(key)
+                if body is not None:
+                    self.refresher.submit(key, self.refresh_function(key, view, args, kwargs))
+            if body is not None:
+                return current_app.response_class(body, status=200, mimetype='application/json')
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except SparqlQueryError:
+                body = self.get_stale(key)
+                if body is None:
+                    raise
+                return current_app.response_class(body, status=200, mimetype='application/json')
+            if response.status_code == 200:
+                if response.is_streamed:
+                    response.response = self.caching_stream(key, response.response)
+                else:
+                    self.put(key, response.get_data())
+            return response
+        return wrapper
+
+    def refresh_function(self, key, view, args, kwargs):
+        """A function caching the response of the view to the current request again, in a request
+        context of its own."""
+        app = current_app._get_current_object()
+        path, params = request.path, request.args.copy()
+
+        def refresh():
+            with app.test_request_context(path, query_string=params):
+                # The release changed since: the entry was dropped with every other.
+                if self.make_key(path, request.args) != key:
+                    return
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return
+                if response.is_streamed:
+                    for _ in self.caching_stream(key, response.response):
+                        pass
+                else:
+                    self.put(key, response.get_data())
+        return refresh
+
+    def caching_stream(self, key, chunks):
+        """Pass on the chunks of a streamed body and cache it once it has been sent in full."""
+        body = []
+        size = 0
+        try:
+            for chunk in chunks:
+                yield chunk
+                if body is not None:
+                    chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                    size += len(chunk)
+                    if size > self.max_streamed_bytes:
+                        body = None
+                    else:
+                        body.append(chunk)
+            if body is not None:
+                self.put(key, b''.join(body))
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
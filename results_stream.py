@@ -0,0 +1,144 @@
+import codecs
+import json
+import re
+
+from json_codecs import StdlibCodec
+
+HEAD_KEY = re.compile(r'"head"\s*:\s*')
+BINDINGS_START = re.compile(r'"bindings"\s*:\s*\[')
+# Whitespace and the commas between bindings.
+SEPARATORS = re.compile(r'[\s,]*')
+
+
+class ResultsStreamError(ValueError):
+    """Raised when a streamed body is not a complete SPARQL JSON results document."""
+
+
+class BindingsReader:
+    """An incremental parser of SPARQL JSON results.
+
+    `feed` takes the body in chunks of bytes and returns the bindings completed by each, so
+    only the current chunk and one partial binding are held in memory. `head` is set once it
+    has been read. Endpoints write the head before the results; when one does not, the whole
+    body is buffered and its bindings are returned by `close`.
+    """
+
+    def __init__(self):
+        self.head = None
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._in_bindings = False
+        self._done = False
+        self._buffering = False
+
+    def feed(self, chunk):
+        self._buffer += self._text.decode(chunk)
+        if self._buffering or self._done:
+            return []
+        if not self._in_bindings:
+            start = BINDINGS_START.search(self._buffer)
+            if start is None:
+                return []
+            head = HEAD_KEY.search(self._buffer, 0, start.start())
+            if head is None:
+                self._buffering = True
+                return []
+            self.head = self._decoder.raw_decode(self._buffer, head.end())[0]
+            self._buffer = self._buffer[start.end():]
+            self._in_bindings = True
+        bindings = []
+        position = 0
+        while True:
+            position = SEPARATORS.match(self._buffer, position).end()
+            if position == len(self._buffer):
+                break
+            if self._buffer[position] == ']':
+                self._done = True
+                break
+            try:
+                binding, position = self._decoder.raw_decode(self._buffer, position)
+            except json.JSONDecodeError:
+                # The binding continues in the next chunk.
+                break
+            bindings.append(binding)
+        self._buffer = '' if self._done else self._buffer[position:]
+        return bindings
+
+    def close(self):
+        """Check that the body was complete and return the bindings not returned yet."""
+        self._buffer += self._text.decode(b'', final=True)
+        if self._buffering:
+            try:
+                results = json.loads(self._buffer)
+                self.head = results['head']
+                return results['results']['bindings']
+            except (ValueError, KeyError, TypeError) as e:
+                raise ResultsStreamError(f"Invalid SPARQL JSON results: {e}") from e
+        if not self._done:
+            raise ResultsStreamError("The SPARQL JSON results end before their bindings do")
+        return []
+
+
+class ResultsReshaper:
+    """Re-serializes streamed SPARQL JSON results binding by binding.
+
+    The output pieces join into the bytes jsonify gives for the decoded results when `codec`
+    is the one jsonify uses. `transform` maps each binding to the binding to write, or to
+    None to leave it out.
+    """
+
+    def __init__(self, transform=None, codec=StdlibCodec()):
+        self.reader = BindingsReader()
+        self.transform = transform
+        self.dumps = codec.dumps
+        self._opened = False
+        self._written = 0
+
+    def feed(self, chunk):
+        return self._write(self.reader.feed(chunk))
+
+    def close(self):
+        return self._write(self.reader.close()) + b']}}\n'
+
+    def _write(self, bindings):
+        pieces = []
+        if not self._opened and self.reader.head is not None:
+            pieces.append(b'{"head":' + self.dumps(self.reader.head) + b',"results":{"bindings":[')
+            self._opened = True
+        for binding in bindings:
+            if self.transform is not None:
+                binding = self.transform(binding)
+                if binding is None:
+                    continue
+            pieces.append(b',' + self.dumps(binding) if self._written else self.dumps(binding))
+            self._written += 1
+        return b''.join(pieces)
+
+
+def reshaped_results(chunks, transform=None, codec=StdlibCodec()):
+    """Yield the re-serialized results of a streamed body (see ResultsReshaper)."""
+    reshaper = ResultsReshaper(transform, codec)
+    for chunk in chunks:
+        piece = reshaper.feed(chunk)
+        if piece:
+            yield piece
+    yield reshaper.close()
+
+
+def primed(chunks):
+    """Start a generator of chunks, so that errors raised before its first chunk (a failing
+    query) surface in the caller rather than in the middle of a response."""
+    try:
+        first = next(chunks)
+    except StopIteration:
+        return iter(())
+    return _resumed(first, chunks)
+
+
+def _resumed(first, chunks):
+    try:
+        yield first
+        yield from chunks
+    finally:
+        chunks.close()
@@ -0,0 +1,72 @@
+from query_factory import get_query_page, get_result_count
+from ranked_lists import paged_results
+from response_cache import LRUCache
+
+DEFAULT_MAX_LIMIT = 1000
+DEFAULT_MAX_COUNTS = 10000
+
+
+class SearchPageError(ValueError):
+    """Raised for a `limit` or `cursor` search parameter that is not a valid number."""
+
+
+# Return the page size asked for by the `limit` parameter (None for the whole results) and the
+# offset asked for by `cursor`; limits above `max_limit` are lowered to it.
+def search_page_params(limit, cursor, max_limit=DEFAULT_MAX_LIMIT):
+    try:
+        limit = None if limit is None else int(limit)
+        offset = int(cursor) if cursor else 0
+    except ValueError:
+        raise SearchPageError("limit and cursor must be integers.") from None
+    if (limit is not None and limit < 1) or offset < 0:
+        raise SearchPageError("limit must be positive and cursor not negative.")
+    return (None if limit is None else min(limit, max_limit)), offset
+
+
+# Return the page of `limit` results from `offset` of results computed locally, with its `cursor`,
+# `has_more` and, `with_count`, the `count` of every result.
+def results_page(results, limit, offset, with_count=False):
+    bindings = results['results']['bindings']
+    page = paged_results(results['head'], bindings[offset:offset + limit], offset,
+                         len(bindings) > offset + limit, page_size=limit)
+    if with_count:
+        page['count'] = len(bindings)
+    return page
+
+
+class SearchPager:
+    """Fetches a page of search results at a time, with LIMIT and OFFSET in the SPARQL query.
+
+    Each page asks for one more row than it returns, to know whether another page follows.
+    The total number of results of a search is counted with one COUNT query per search and
+    KG release, and kept (up to `max_counts` of them) until the release changes.
+    """
+
+    def __init__(self, sparql_client, version_provider, max_counts=DEFAULT_MAX_COUNTS):
+        self.sparql_client = sparql_client
+        self.version_provider = version_provider
+        self.counts = LRUCache(max_entries=max_counts, ttl=None)
+
+    def invalidate(self, old_version=None, new_version=None):
+        self.counts.clear()
+
+    def page(self, sparql_query, limit, offset, with_count=False):
+        """Return the page of `limit` results from `offset`, with its `cursor`, `has_more` and,
+        `with_count`, the `count` of every result."""
+        results = self.sparql_client.query(get_query_page(sparql_query, limit + 1, offset))
+        bindings = results['results']['bindings']
+        page = paged_results(results['head'], bindings[:limit], offset, len(bindings) > limit, page_size=limit)
+        if with_count:
+            page['count'] = self.count(sparql_query)
+        return page
+
+    def count(self, sparql_query):
+        key = (sparql_query, self.version_provider())
+        count = self.counts.get(key)
+        if count is None:
+            bindings = self.sparql_client.query(get_result_count(sparql_query))['results']['bindings']
+            count = int(bindings[0]['count']['value']) if bindings else 0
+            # Without a known KG release the count could outlive the data it came from.
+            if key[1] is not None:
+                self.counts.put(key, count)
+        return count
@@ -0,0 +1,297 @@
+import json
+import logging
+import os
+import threading
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import current_query, current_route
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+# Bytes read from the endpoint at a time when streaming a response.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+try:
+    import brotli  # noqa: F401 (urllib3 decodes br bodies when brotli is installed)
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class SparqlQueryError(Exception):
+    """Raised when a query cannot be executed against the SPARQL endpoint."""
+
+    def __init__(self, message, sparql_query=None, status_code=None, response_text=None):
+        super().__init__(message)
+        self.sparql_query = sparql_query
+        self.status_code = status_code
+        self.response_text = response_text
+
+
+# Raise SparqlQueryError unless a response declares a JSON body (application/json or
+# application/sparql-results+json).
+def check_json_content_type(response, sparql_query):
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    if not content_type.endswith('json'):
+        logger.error("Content type %r returned for SPARQL query = %s", content_type, sparql_query)
+        raise SparqlQueryError(f"SPARQL endpoint returned {content_type or 'no content type'} instead of JSON",
+                               sparql_query, response.status_code, response.text)
+
+
+class SingleFlight:
+    """Runs one call per key at a time: callers arriving while it runs wait for it and share its outcome.
+
+    A caller given a `timeout` waits no longer for the call in flight, and then gets a
+    concurrent.futures.TimeoutError; the call goes on for the others.
+
+    `calls` counts every call and `coalesced` those answered by a call already in flight; with
+    `metrics` (a metrics.Metrics), both are also counted per route and query builder.
+    """
+
+    def __init__(self, metrics=None):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.metrics = metrics
+        self.calls = 0
+        self.coalesced = 0
+
+    @property
+    def coalescing_ratio(self):
+        """The fraction of calls that did not run their function."""
+        return self.coalesced / self.calls if self.calls else 0.0
+
+    def do(self, key, function, timeout=None):
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self._in_flight[key] = Future()
+                leader = True
+        if self.metrics is not None:
+            self.metrics.observe_coalescing(not leader)
+        if not leader:
+            return future.result(timeout)
+        try:
+            future.set_result(function())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+
+class SparqlClient:
+    """A SPARQL endpoint client backed by a pool of keep-alive connections.
+
+    One instance is meant to be shared by every request handler so that TCP and TLS
+    handshakes are paid once per pooled connection rather than once per API call.
+    With `coalesce`, concurrent calls of `query` with the same query text share a single
+    upstream request and the same decoded results, which callers must not modify.
+    Results are decoded with `json_loads`. A forked child process starts with a pool of its
+    own, so that it never writes to the connections of its parent. With `metrics` (a
+    metrics.Metrics), round trips, status codes and decoding times are recorded.
+
+    With `guard` (a resilience.UpstreamGuard), every query is admitted by it, which sets its
+    timeout and fails it fast while the endpoint is down, and a query still unanswered (or failed
+    for want of an answer) after the guard's hedge delay is sent once more, on a thread of its own;
+    the first answer wins. Only queries, which are idempotent reads, are sent through the client.
+    """
+
+    def __init__(self, endpoint_url, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 coalesce=True, json_loads=json.loads, metrics=None, guard=None):
+        self.endpoint_url = endpoint_url
+        self.json_loads = json_loads
+        self.metrics = metrics
+        self.guard = guard
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.coalesce = coalesce
+        self.session = requests.Session()
+        self._mount_pool()
+        self.session.headers.update({
+            'Accept': 'application/sparql-results+json, application/json',
+            'Accept-Encoding': ACCEPT_ENCODING,
+        })
+        self.single_flight = SingleFlight(metrics) if coalesce else None
+        self._hedge_executor = self._new_hedge_executor()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _mount_pool(self):
+        # A single host is queried, so one pool holding up to pool_size connections is enough.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _after_fork(self):
+        # Drop the inherited connections (without closing them, as the parent still uses them)
+        # and the queries in flight in the parent.
+        self._mount_pool()
+        self.single_flight = SingleFlight(self.metrics) if self.coalesce else None
+        self._hedge_executor = self._new_hedge_executor()
+
+    def _new_hedge_executor(self):
+        # Made up front rather than on the first hedge, which concurrent queries could race to
+        # make; its threads only start with the hedges.
+        if self.guard is None:
+            return None
+        # Room for a hedge beside every query of a full pool: a hedge queued behind others is no hedge.
+        return ThreadPoolExecutor(2 * self.pool_size, thread_name_prefix='sparql-hedge')
+
+    def query(self, sparql_query, timeout=None):
+        """Execute a query and return the decoded SPARQL JSON results.
+
+        `timeout` overrides the read timeout (in seconds) for this query only.
+        """
+        if self.single_flight is None:
+            return self._query(sparql_query, timeout)
+        return self._coalesced(sparql_query, sparql_query, lambda: self._query(sparql_query, timeout), timeout)
+
+    def _coalesced(self, key, sparql_query, function, timeout):
+        # A caller finding the query in flight waits no longer than its own timeouts would let it,
+        # nor past the latency budget of its request.
+        wait_timeout = self.connect_timeout + (self.read_timeout if timeout is None else timeout)
+        if self.guard is not None:
+            wait_timeout = self.guard.within_budget(sparql_query, wait_timeout)
+        try:
+            return self.single_flight.do(key, function, wait_timeout)
+        except FutureTimeoutError as e:
+            raise SparqlQueryError("Timed out waiting for the same query in flight", sparql_query) from e
+
+    def _query(self, sparql_query, timeout):
+        response = self.post(sparql_query, timeout=timeout)
+        start = time.perf_counter()
+        try:
+            results = self.json_loads(response.content)
+        except ValueError as e:
+            logger.error("Invalid JSON returned for SPARQL query = %s", sparql_query)
+            raise SparqlQueryError("SPARQL endpoint returned invalid JSON", sparql_query,
+                                   response.status_code, response.text) from e
+        if self.metrics is not None:
+            self.metrics.observe_phase('decode', time.perf_counter() - start, current_query.get())
+        return results
+
+    def query_raw(self, sparql_query, timeout=None):
+        """Execute a query and return the undecoded (but decompressed) JSON body of its results.
+
+        For results forwarded unchanged: the body is not parsed, only checked to be JSON by its
+        content type.
+        """
+        if self.single_flight is None:
+            return self._query_raw(sparql_query, timeout)
+        return self._coalesced(('raw', sparql_query), sparql_query, lambda: self._query_raw(sparql_query, timeout),
+                               timeout)
+
+    def _query_raw(self, sparql_query, timeout):
+        response = self.post(sparql_query, timeout=timeout)
+        check_json_content_type(response, sparql_query)
+        return response.content
+
+    def stream(self, sparql_query, timeout=None, chunk_size=STREAM_CHUNK_SIZE):
+        """Execute a query and yield the body of its results as it arrives, in decompressed chunks.
+
+        The query is sent when the first chunk is asked for, and the connection is returned to
+        the pool when the generator finishes or is closed. Streamed queries are not coalesced.
+        """
+        response = self.post(sparql_query, timeout=timeout, stream=True)
+        try:
+            yield from response.iter_content(chunk_size)
+        except requests.RequestException as e:
+            logger.error("Error reading from SPARQL endpoint %s: %s\nQuery = %s",
+                         self.endpoint_url, e, sparql_query)
+            raise SparqlQueryError(f"Unable to read the SPARQL results: {e}", sparql_query) from e
+        finally:
+            response.close()
+
+    def post(self, sparql_query, timeout=None, stream=False):
+        """Send a query to the endpoint and return the successful `requests.Response`.
+
+        With `stream`, the body is left unread for the caller, who must close the response
+        (and the round trip recorded ends with the headers). Streamed queries are not hedged.
+        """
+        read_timeout = self.read_timeout if timeout is None else timeout
+        if self.guard is None:
+            return self._post(sparql_query, read_timeout, stream)
+        read_timeout = self.guard.admit(sparql_query, read_timeout)
+        delay = None if stream else self.guard.hedge_delay()
+        if delay is None or delay >= read_timeout:
+            return self._post(sparql_query, read_timeout, stream)
+        return self._hedged_post(sparql_query, read_timeout, delay)
+
+    def _hedged_post(self, sparql_query, read_timeout, delay):
+        start = time.monotonic()
+        first = self._submit(sparql_query, read_timeout)
+        done, pending = wait([first], timeout=delay)
+        if done and (first.exception() is None or not self.guard.should_retry(first.exception())):
+            return first.result()
+        remaining = read_timeout - (time.monotonic() - start)
+        if remaining <= 0:
+            # No time is left for a hedge: the first attempt is all there is.
+            return first.result()
+        self.guard.hedged()
+        pending.add(self._submit(sparql_query, remaining))
+        error = first.exception() if done else None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self.guard.hedge_won()
+                    # The other attempt, if still running, returns its connection to the pool once answered.
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _submit(self, sparql_query, read_timeout):
+        # Each attempt runs in a copy of the caller's context, which labels its metrics.
+        return self._hedge_executor.submit(contextvars.copy_context().run, self._post, sparql_query, read_timeout)
+
+    def _post(self, sparql_query, read_timeout, stream=False):
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.endpoint_url,
+                data={
+                    'query': sparql_query,
+                    'format': 'json'
+                },
+                timeout=(self.connect_timeout, read_timeout),
+                stream=stream
+            )
+        except requests.RequestException as e:
+            self._observe(sparql_query, start, 'error')
+            logger.error("Error contacting SPARQL endpoint %s: %s\nQuery = %s",
+                         self.endpoint_url, e, sparql_query)
+            raise SparqlQueryError(f"Unable to reach SPARQL endpoint: {e}", sparql_query) from e
+        self._observe(sparql_query, start, response.status_code)
+        if response.status_code != 200:
+            logger.error("Error executing SPARQL query (status %s) = %s\n%s",
+                         response.status_code, sparql_query, response.text)
+            raise SparqlQueryError("Failed to execute SPARQL query", sparql_query,
+                                   response.status_code, response.text)
+        return response
+
+    def _observe(self, sparql_query, start, status):
+        seconds = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics.observe_query(sparql_query, seconds, status)
+        if self.guard is not None:
+            self.guard.record(seconds, status)
+
+    def close(self):
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,352 @@
+# Tests of the upstream resilience layer (resilience.py) against the stub SPARQL endpoint with
+# injected faults: circuit breaker transitions, latency budgets and hedged queries, in the clients
+# and through the Flask app.
+#
+# Run from the repository root with:
+#     python -m pytest tests
+
+import asyncio
+import contextvars
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from async_sparql_client import AsyncSparqlClient
+from load_test.sparql_stub import StubSparqlServer
+from load_test.synthetic_kg import SyntheticKG
+from resilience import CircuitBreaker, LatencyWindow, UpstreamGuard, UpstreamUnavailableError
+from sparql_client import SparqlClient, SparqlQueryError
+
+QUERY = "SELECT ?id WHERE { ?tune ?p ?id }"
+
+
+@pytest.fixture
+def stub():
+    server = StubSparqlServer().start()
+    yield server
+    server.stop()
+
+
+def in_context(function, *args):
+    """Run `function` in a copy of the context, so that a request deadline set by it stays there."""
+    return contextvars.copy_context().run(function, *args)
+
+
+def wait_for_requests(stub, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while stub.requests < count and time.monotonic() < deadline:
+        time.sleep(0.002)
+
+
+def test_latency_window_is_safe_to_share_between_threads():
+    window = LatencyWindow(50)
+    window.add(0.1)
+    errors = []
+    stop = threading.Event()
+
+    def add():
+        while not stop.is_set():
+            window.add(0.1)
+
+    def read():
+        try:
+            while not stop.is_set():
+                window.quantile(0.95)
+        except Exception as e:
+            errors.append(e)
+
+    # Switch threads as often as possible, so that they interleave inside the methods.
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    threads = [threading.Thread(target=target) for target in (add, add, read, read)]
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(1)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+
+
+def test_breaker_opens_after_consecutive_failures_and_refuses_queries(stub):
+    guard = UpstreamGuard(default_budget=None, hedge_quantile=None,
+                          breaker=CircuitBreaker(failure_threshold=3, open_seconds=30))
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    stub.error_rate = 1.0
+    for _ in range(3):
+        assert guard.breaker.state == 'closed'
+        with pytest.raises(SparqlQueryError) as failure:
+            client.query(QUERY)
+        assert not isinstance(failure.value, UpstreamUnavailableError)
+    assert guard.breaker.state == 'open'
+    assert guard.breaker.opened == 1
+
+    with pytest.raises(UpstreamUnavailableError) as refusal:
+        client.query(QUERY)
+    assert stub.requests == 3
+    assert 0 < refusal.value.retry_after <= 30
+    assert guard.rejections == 1
+
+
+def test_breaker_success_resets_the_failure_count(stub):
+    guard = UpstreamGuard(default_budget=None, hedge_quantile=None,
+                          breaker=CircuitBreaker(failure_threshold=2, open_seconds=30))
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    for error_rate in (1.0, 0.0, 1.0):
+        stub.error_rate = error_rate
+        try:
+            client.query(QUERY)
+        except SparqlQueryError:
+            pass
+    assert guard.breaker.state == 'closed'
+
+
+def test_half_open_breaker_lets_one_trial_through_and_reopens_on_its_failure(stub):
+    guard = UpstreamGuard(default_budget=None, hedge_quantile=None,
+                          breaker=CircuitBreaker(failure_threshold=1, open_seconds=0.2))
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    stub.error_rate = 1.0
+    with pytest.raises(SparqlQueryError):
+        client.query(QUERY)
+    assert guard.breaker.state == 'open'
+    time.sleep(0.25)
+    assert guard.breaker.state == 'half_open'
+
+    # While the trial is in flight, other queries are refused.
+    stub.latency = 0.3
+    outcomes = []
+
+    def trial_query():
+        try:
+            client.query(QUERY)
+        except SparqlQueryError as e:
+            outcomes.append(e)
+
+    trial = threading.Thread(target=trial_query)
+    trial.start()
+    wait_for_requests(stub, 2)
+    with pytest.raises(UpstreamUnavailableError):
+        client.query(QUERY)
+    trial.join()
+    assert len(outcomes) == 1 and not isinstance(outcomes[0], UpstreamUnavailableError)
+    assert stub.requests == 2
+    assert guard.breaker.state == 'open'
+    assert guard.breaker.opened == 2
+
+
+def test_half_open_breaker_closes_on_a_successful_trial(stub):
+    guard = UpstreamGuard(default_budget=None, hedge_quantile=None,
+                          breaker=CircuitBreaker(failure_threshold=1, open_seconds=0.2))
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    stub.error_rate = 1.0
+    with pytest.raises(SparqlQueryError):
+        client.query(QUERY)
+    stub.error_rate = 0.0
+    with pytest.raises(UpstreamUnavailableError):
+        client.query(QUERY)
+    time.sleep(0.25)
+    client.query(QUERY)
+    assert guard.breaker.state == 'closed'
+    client.query(QUERY)
+    assert stub.requests == 3
+
+
+def test_latency_budget_times_out_queries_and_then_refuses_them(stub):
+    guard = UpstreamGuard(budgets={'/slow': 0.2}, default_budget=None, hedge_quantile=None)
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    stub.latency = 1.0
+
+    def request():
+        guard.start_request('/slow')
+        start = time.monotonic()
+        with pytest.raises(SparqlQueryError) as timeout:
+            client.query(QUERY)
+        assert not isinstance(timeout.value, UpstreamUnavailableError)
+        assert time.monotonic() - start < 0.6
+        with pytest.raises(UpstreamUnavailableError):
+            client.query(QUERY)
+
+    in_context(request)
+    assert stub.requests == 1
+    assert guard.rejections == 1
+
+
+def test_queries_outside_a_budget_are_not_limited(stub):
+    guard = UpstreamGuard(budgets={'/slow': 0.05}, default_budget=None, hedge_quantile=None)
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    stub.latency = 0.1
+    in_context(client.query, QUERY)
+    assert guard.rejections == 0
+
+
+def test_coalesced_query_waits_no_longer_than_its_budget(stub):
+    guard = UpstreamGuard(budgets={'/slow': 0.2}, default_budget=None, hedge_quantile=None)
+    client = SparqlClient(stub.url, guard=guard)
+    stub.latency = 1.0
+    leader = threading.Thread(target=client.query, args=(QUERY,))
+    leader.start()
+    wait_for_requests(stub, 1)
+
+    def request():
+        guard.start_request('/slow')
+        start = time.monotonic()
+        with pytest.raises(SparqlQueryError) as timeout:
+            client.query(QUERY)
+        assert not isinstance(timeout.value, UpstreamUnavailableError)
+        assert time.monotonic() - start < 0.6
+
+    in_context(request)
+    leader.join()
+    assert client.single_flight.coalesced == 1
+    assert stub.requests == 1
+
+
+def test_async_coalesced_query_waits_no_longer_than_its_timeout(stub):
+    stub.latency = 1.0
+
+    async def scenario():
+        client = AsyncSparqlClient(stub.url, connect_timeout=0.1)
+        try:
+            leader = asyncio.ensure_future(client.query(QUERY))
+            await asyncio.sleep(0.05)
+            start = time.monotonic()
+            with pytest.raises(SparqlQueryError):
+                await client.query(QUERY, timeout=0.1)
+            elapsed = time.monotonic() - start
+            await leader
+            return elapsed, client.single_flight.coalesced
+        finally:
+            await client.aclose()
+
+    elapsed, coalesced = asyncio.run(scenario())
+    assert elapsed < 0.6
+    assert coalesced == 1
+    assert stub.requests == 1
+
+
+def hedging_guard(min_samples=3):
+    return UpstreamGuard(default_budget=None, hedge_quantile=0.95, hedge_min_delay=0.2, timeout_factor=None,
+                         min_samples=min_samples)
+
+
+def slow_first_attempt(stub, attempts_before):
+    """Slow the next query down, and answer the ones after it at once."""
+    stub.slow_rate, stub.slow_latency = 1.0, 2.0
+
+    def speed_up():
+        # The stub counts a query before it decides to slow it down; the hedge is not sent before
+        # hedge_min_delay.
+        wait_for_requests(stub, attempts_before + 1)
+        time.sleep(0.05)
+        stub.slow_rate = 0.0
+
+    threading.Thread(target=speed_up, daemon=True).start()
+
+
+def test_hedge_answers_a_query_whose_first_attempt_is_slow(stub):
+    guard = hedging_guard()
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    for _ in range(guard.min_samples):
+        client.query(QUERY)
+    slow_first_attempt(stub, stub.requests)
+    start = time.monotonic()
+    client.query(QUERY)
+    assert time.monotonic() - start < 1.0
+    assert guard.hedges == 1
+    assert guard.hedge_wins == 1
+
+
+def test_no_hedge_when_the_first_attempt_answers_in_time(stub):
+    guard = hedging_guard()
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    for _ in range(guard.min_samples + 5):
+        client.query(QUERY)
+    assert guard.hedges == 0
+    assert stub.requests == guard.min_samples + 5
+
+
+def test_no_hedge_once_the_query_has_no_time_left(stub):
+    guard = hedging_guard()
+    client = SparqlClient(stub.url, coalesce=False, guard=guard)
+    stub.latency = 1.0
+    # A hedge delay past the read timeout, as when the first attempt is scheduled late.
+    with pytest.raises(SparqlQueryError):
+        client._hedged_post(QUERY, 0.1, 0.15)
+    assert guard.hedges == 0
+    assert stub.requests == 1
+
+
+def test_async_hedge_cancels_the_losing_attempt(stub):
+    guard = hedging_guard()
+
+    async def scenario():
+        client = AsyncSparqlClient(stub.url, max_concurrency=4, coalesce=False, guard=guard)
+        try:
+            for _ in range(guard.min_samples):
+                await client.query(QUERY)
+            slow_first_attempt(stub, stub.requests)
+            start = time.monotonic()
+            await client.query(QUERY)
+            elapsed = time.monotonic() - start
+            # The cancelled attempt gives its connection slot back.
+            await asyncio.sleep(0.05)
+            return elapsed, client._slots.qsize()
+        finally:
+            await client.aclose()
+
+    elapsed, free_slots = asyncio.run(scenario())
+    assert elapsed < 1.0
+    assert free_slots == 4
+    assert guard.hedges == 1
+    assert guard.hedge_wins == 1
+
+
+@pytest.fixture(scope='module')
+def served_app():
+    """app.py against the stub serving a synthetic knowledge graph."""
+    kg = SyntheticKG(tunes=500)
+    server = StubSparqlServer(responder=kg).start()
+    directory = tempfile.mkdtemp()
+    os.environ.update(BLAZEGRAPH_URL=server.url,
+                      TITLE_SNAPSHOT_PATH=os.path.join(directory, 'titles.snapshot'),
+                      TUNE_SIMILARITY_PATH=os.path.join(directory, 'tune_similarity.snapshot'),
+                      ACCESS_STATS_PATH=os.path.join(directory, 'access_stats.json'))
+    import app
+    app.kg_version_monitor.wait_for_refreshes()
+    yield app, server, iter(kg.tune_ids)
+    server.stop()
+
+
+def test_spent_budget_is_answered_503_without_querying(served_app):
+    app, server, tune_ids = served_app
+    app.upstream_guard.budgets['/api/tune_by_id'] = 0
+    try:
+        requests = server.requests
+        response = app.app.test_client().get(f'/api/tune_by_id?id={next(tune_ids)}')
+    finally:
+        del app.upstream_guard.budgets['/api/tune_by_id']
+    assert response.status_code == 503
+    assert server.requests == requests
+
+
+def test_open_breaker_is_answered_503_with_retry_after(served_app):
+    app, server, tune_ids = served_app
+    breaker = app.upstream_guard.breaker
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    try:
+        requests = server.requests
+        response = app.app.test_client().get(f'/api/tune_by_id?id={next(tune_ids)}')
+    finally:
+        breaker.record_success()
+    assert response.status_code == 503
+    assert 0 < int(response.headers['Retry-After']) <= app.UPSTREAM_OPEN_SECONDS
+    assert server.requests == requests
+    assert app.app.test_client().get(f'/api/tune_by_id?id={next(tune_ids)}').status_code == 200
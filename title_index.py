@@ -0,0 +1,317 @@
+import heapq
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Mapping
+from operator import itemgetter
+
+from fuzzywuzzy import utils as fuzzy_utils
+
+from title_scorers import make_scorer, matching_cutoff
+
+NGRAM_SIZE = 3
+# Number of titles, ranked by shared n-grams, that are scored for each query. None scores every
+# title, which reproduces the linear extractBests scan exactly; a number trades exactness for speed.
+DEFAULT_MAX_CANDIDATES = None
+NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+# Folded titles are compared as UTF-8 bytes, in which 0xFF never occurs, so that prefix + LAST_BYTE
+# ends the run of keys beginning with prefix.
+LAST_BYTE = b'\xff'
+SPACE = ord(' ')
+
+
+# Process a title the way fuzzywuzzy.process.extractBests does before WRatio scoring.
+def normalize_title(title):
+    return fuzzy_utils.full_process(fuzzy_utils.full_process(title), force_ascii=True)
+
+
+# Fold a title for prefix matching: accents removed, case folded, and every run of other characters
+# than letters and digits turned into a single space.
+def fold_title(title):
+    decomposed = unicodedata.normalize('NFKD', title)
+    unaccented = ''.join(character for character in decomposed if not unicodedata.combining(character))
+    return ' '.join(NON_ALPHANUMERIC.sub(' ', unaccented.casefold()).split())
+
+
+# The character n-grams of a normalized title, with every word padded by spaces.
+def title_ngrams(normalized_title):
+    ngrams = set()
+    for token in normalized_title.split():
+        padded = f" {token} "
+        ngrams.update(padded[i:i + NGRAM_SIZE] for i in range(max(len(padded) - NGRAM_SIZE + 1, 1)))
+    return ngrams
+
+
+# The distinct characters of a normalized title, used when no n-gram is shared.
+def title_characters(normalized_title):
+    return set(normalized_title.replace(" ", ""))
+
+
+# The score cutoffs tried, in order, by the retry loop of FuzzySearch.get_title_best_match.
+def score_cutoffs(score_cutoff, retry_till_match, max_retries):
+    cutoffs = [score_cutoff]
+    if retry_till_match:
+        for _ in range(max_retries):
+            score_cutoff /= 2
+            cutoffs.append(score_cutoff)
+    return cutoffs
+
+
+class TitleIndex:
+    """An n-gram inverted index over tune titles for fuzzy title search.
+
+    Titles are kept in array-backed tables (`ids`, `titles`, `normalized`) in the order
+    they were given, and each n-gram (and each single character) maps to a slice of
+    `postings` (a CSR layout with `ngram_offsets`). A query scores the titles with fuzzywuzzy's
+    WRatio and answers every retry cutoff from that single pass; with `max_candidates`, only
+    the titles sharing the most n-grams with it are scored. Without it every title is scored,
+    and the n-gram postings are not built.
+
+    `scorer` names the backend from `title_scorers` that computes the scores ('fuzzywuzzy'
+    or 'rapidfuzz'); `scorer_options` are passed on to it.
+    """
+
+    def __init__(self, ids, titles, normalized, ngram_slots, ngram_offsets, postings,
+                 max_candidates=DEFAULT_MAX_CANDIDATES, scorer='fuzzywuzzy', **scorer_options):
+        self.ids = ids
+        self.titles = titles
+        self.normalized = normalized
+        self.ngram_slots = ngram_slots
+        self.ngram_offsets = ngram_offsets
+        self.postings = postings
+        self.max_candidates = max_candidates
+        self.scorer = make_scorer(scorer, normalized, **scorer_options)
+
+    @classmethod
+    def build(cls, names, **options):
+        """Build the index from a {id: title} dict."""
+        ids = list(names.keys())
+        titles = list(names.values())
+        normalized = [normalize_title(title) for title in titles]
+        ngram_lists = {}
+        # Without max_candidates every title is scored, and the postings would never be read.
+        if options.get('max_candidates', DEFAULT_MAX_CANDIDATES) is not None:
+            for position, normalized_title in enumerate(normalized):
+                for ngram in title_ngrams(normalized_title) | title_characters(normalized_title):
+                    ngram_lists.setdefault(ngram, []).append(position)
+        ngram_slots = {}
+        ngram_offsets = array('I', [0])
+        postings = array('I')
+        for slot, (ngram, positions) in enumerate(sorted(ngram_lists.items())):
+            ngram_slots[ngram] = slot
+            postings.extend(positions)
+            ngram_offsets.append(len(postings))
+        return cls(ids, titles, normalized, ngram_slots, ngram_offsets, postings, **options)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def candidates(self, ngrams):
+        """Positions of the titles sharing the most of `ngrams`, in title order."""
+        shared = Counter()
+        for ngram in ngrams:
+            slot = self.ngram_slots.get(ngram)
+            if slot is not None:
+                shared.update(self.postings[self.ngram_offsets[slot]:self.ngram_offsets[slot + 1]])
+        if len(shared) > self.max_candidates:
+            shared = dict(heapq.nlargest(self.max_candidates, shared.items(), key=itemgetter(1)))
+        return sorted(shared)
+
+    def search(self, title, score_cutoff=60, limit=50, retry_till_match=True, max_retries=3):
+        """Return (title, score, id) tuples as FuzzySearch.get_title_best_match always has.
+
+        With `max_candidates` None (the default) every title is scored, and the results are
+        exactly those of `fuzzywuzzy.process.extractBests` retried with halved cutoffs. With a
+        number, only that many titles, those sharing the most n-grams with the query, are
+        scored (or, when none of them matches at any cutoff, those sharing the most characters):
+        WRatio's partial ratios do not follow shared n-grams, so titles the scan would return,
+        even its best match, can be missed, and the results are approximate.
+        """
+        normalized_query = normalize_title(title)
+        if not normalized_query:
+            return []
+        cutoffs = score_cutoffs(score_cutoff, retry_till_match, max_retries)
+        if self.max_candidates is None:
+            positions, scores = self.scorer.score(normalized_query, range(len(self)), cutoffs, limit)
+            return self.best_matches(positions, scores, cutoffs, limit)
+        positions = self.candidates(title_ngrams(normalized_query))
+        positions, scores = self.scorer.score(normalized_query, positions, cutoffs, limit)
+        if max(scores, default=0) < cutoffs[-1]:
+            positions = self.candidates(title_characters(normalized_query))
+            positions, scores = self.scorer.score(normalized_query, positions, cutoffs, limit)
+        return self.best_matches(positions, scores, cutoffs, limit)
+
+    def best_matches(self, positions, scores, cutoffs, limit):
+        best_score = max(scores, default=0)
+        cutoff = matching_cutoff(best_score, cutoffs)
+        if best_score < cutoff:
+            return []
+        matched = [(score, position) for position, score in zip(positions, scores) if score >= cutoff]
+        # Highest scores first; equal scores keep title order, as heapq.nlargest does.
+        matched.sort(key=lambda match: (-match[0], match[1]))
+        return [(self.titles[position], score, self.ids[position]) for score, position in matched[:limit]]
+
+
+class TitleNames(Mapping):
+    """A read-only {id: title} mapping over the `ids` and `titles` tables of an index.
+
+    It stands in for the names dict when the index comes from a snapshot, so the titles
+    are only decoded when they are used.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self._positions = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index.ids)
+
+    def __getitem__(self, tune_id):
+        if self._positions is None:
+            self._positions = {tune_id: position for position, tune_id in enumerate(self.index.ids)}
+        return self.index.titles[self._positions[tune_id]]
+
+
+class SortedKeys:
+    """The sorted keys of a TitlePrefixIndex as a read-only sequence for bisect: key `i` is the
+    UTF-8 bytes of the folded title `positions[i]` from byte `starts[i]` (or from its start)."""
+
+    def __init__(self, blob, offsets, positions, starts=None):
+        self.blob = blob
+        self.offsets = offsets
+        self.positions = positions
+        self.starts = starts
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        position = self.positions[index]
+        start = self.offsets[position] if self.starts is None else self.starts[index]
+        return bytes(self.blob[start:self.offsets[position + 1]])
+
+
+class TitlePrefixIndex:
+    """A sorted-array prefix index over tune titles for typeahead suggestions.
+
+    Titles are folded with `fold_title` and stored as UTF-8 in one `folded` blob delimited by
+    `folded_offsets`. `title_positions` lists the titles sorted by folded title, and
+    `word_positions`/`word_starts` every later word of a title (its title and byte offset),
+    sorted by the folded title from that word on, so that the titles beginning with a prefix,
+    then those with a word beginning with it, are contiguous runs found by binary search.
+    Everything is held in flat arrays, which a snapshot maps and forked processes share.
+    """
+
+    def __init__(self, ids, titles, folded, folded_offsets, title_positions, word_positions, word_starts):
+        self.ids = ids
+        self.titles = titles
+        self.folded = folded
+        self.folded_offsets = folded_offsets
+        self.title_positions = title_positions
+        self.word_positions = word_positions
+        self.word_starts = word_starts
+        self.title_keys = SortedKeys(folded, folded_offsets, title_positions)
+        self.word_keys = SortedKeys(folded, folded_offsets, word_positions, word_starts)
+
+    @classmethod
+    def build(cls, ids, titles):
+        """Build the index from the `ids` and `titles` tables of a TitleIndex."""
+        folded = [fold_title(title).encode('utf-8') for title in titles]
+        offsets = array('I', [0])
+        for key in folded:
+            offsets.append(offsets[-1] + len(key))
+        title_positions = array('I', sorted(range(len(folded)), key=folded.__getitem__))
+        words = sorted((key[offset + 1:], position, offsets[position] + offset + 1)
+                       for position, key in enumerate(folded) for offset in range(len(key)) if key[offset] == SPACE)
+        return cls(ids, titles, b''.join(folded), offsets, title_positions,
+                   array('I', (position for _, position, _ in words)), array('I', (start for _, _, start in words)))
+
+    def __len__(self):
+        return len(self.title_positions)
+
+    @staticmethod
+    def _matches(keys, prefix, start=0, end=None):
+        """The run of sorted `keys` (between `start` and `end`) beginning with `prefix`."""
+        end = len(keys) if end is None else end
+        start = bisect_left(keys, prefix, start, end)
+        return start, bisect_left(keys, prefix + LAST_BYTE, start, end)
+
+    @classmethod
+    def _fuzzy_matches(cls, keys, prefix, max_edits, exact_length=0):
+        """Yield (edits, start, end) for the runs of sorted `keys` beginning with a string at most
+        `max_edits` edits from `prefix` and with the same first `exact_length` bytes.
+
+        The sorted keys are walked as a trie, one byte at a time, carrying the row of
+        edit distances from the walked string to each prefix of `prefix`; a branch is left as
+        soon as every distance in its row exceeds `max_edits`, and once no edit is left the
+        rest of the prefix is looked up directly. Only the distances within `max_edits` of the
+        diagonal can be small enough, so the others are capped at `max_edits + 1` rather than
+        computed.
+        """
+        path = prefix[:exact_length]
+        start, end = cls._matches(keys, path)
+        too_far = max_edits + 1
+        branches = [(path, start, end, [min(abs(len(path) - column), too_far) for column in range(len(prefix) + 1)])]
+        while branches:
+            path, start, end, row = branches.pop()
+            if row[-1] <= max_edits:
+                yield row[-1], start, end
+                continue
+            if min(row) == max_edits:
+                # No edit is left: the keys must go on with the rest of the prefix after a column
+                # reached with exactly max_edits edits.
+                for column, edits in enumerate(row):
+                    if edits == max_edits:
+                        rest_start, rest_end = cls._matches(keys, path + prefix[column:], start, end)
+                        if rest_start < rest_end:
+                            yield max_edits, rest_start, rest_end
+                continue
+            depth = len(path)
+            # Keys equal to the walked string sort first and have no next byte.
+            index = bisect_left(keys, path + b'\0', start, end)
+            while index < end:
+                entry = keys[index]
+                child = entry[:depth + 1]
+                child_end = bisect_left(keys, child + LAST_BYTE, index, end)
+                character = entry[depth]
+                child_row = [too_far] * len(row)
+                child_row[0] = min(row[0] + 1, too_far)
+                first, last = max(1, depth + 1 - max_edits), min(len(prefix), depth + 1 + max_edits)
+                for column in range(first, last + 1):
+                    child_row[column] = min(child_row[column - 1] + 1, row[column] + 1,
+                                            row[column - 1] + (prefix[column - 1] != character), too_far)
+                if min(child_row[first - 1:last + 1]) <= max_edits:
+                    branches.append((child, index, child_end, child_row))
+                index = child_end
+
+    def suggest(self, query, limit=10, max_edits=0, fuzzy_min_length=3, fuzzy_exact_length=1):
+        """Return up to `limit` (title, id) pairs of the titles beginning with `query`, then of
+        those with a word beginning with it, each in folded title order.
+
+        With `max_edits`, queries of at least `fuzzy_min_length` characters with fewer matches
+        than `limit` are topped up with the titles (then words) beginning with a string at most
+        that many edits away, fewest edits first, so that a typo still finds the title. Typos are
+        only looked for after the first `fuzzy_exact_length` characters, which keeps the search
+        to a small part of the index. Edits are counted in UTF-8 bytes, one per character for
+        the unaccented Latin letters most folded titles are made of.
+        """
+        prefix = fold_title(query).encode('utf-8')
+        if not prefix:
+            return []
+        sources = ((self.title_keys, self.title_positions), (self.word_keys, self.word_positions))
+        matches = {}
+        for keys, positions in sources:
+            start, end = self._matches(keys, prefix)
+            for index in range(start, min(end, start + limit)):
+                matches.setdefault(positions[index], None)
+        if max_edits and len(matches) < limit and len(prefix) >= fuzzy_min_length:
+            for keys, positions in sources:
+                for _, start, end in sorted(self._fuzzy_matches(keys, prefix, max_edits, fuzzy_exact_length)):
+                    for index in range(start, min(end, start + limit)):
+                        matches.setdefault(positions[index], None)
+        return [(self.titles[position], self.ids[position]) for position in list(matches)[:limit]]
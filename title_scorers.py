@@ -0,0 +1,112 @@
+import heapq
+
+from fuzzywuzzy import fuzz
+
+try:
+    from rapidfuzz import fuzz as rapid_fuzz, process as rapid_process
+except ImportError:
+    rapid_process = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# fuzzywuzzy rounds each partial score before combining them, while rapidfuzz keeps floats and
+# finds the optimal partial alignment, so a fuzzywuzzy WRatio never exceeds rapidfuzz's by a point.
+# The slack leaves a margin on top of that.
+RAPIDFUZZ_SCORE_SLACK = 2
+
+
+# The first of the retry cutoffs reached by the best score, or the last cutoff if none is.
+def matching_cutoff(best_score, cutoffs):
+    for cutoff in cutoffs:
+        if best_score >= cutoff:
+            return cutoff
+    return cutoffs[-1]
+
+
+class FuzzywuzzyScorer:
+    """Scores titles with one fuzzywuzzy WRatio call per title."""
+
+    def __init__(self, normalized):
+        self.normalized = normalized
+
+    def score(self, normalized_query, positions, cutoffs, limit):
+        """Return (positions, scores) for every title that may appear in the best matches."""
+        return positions, [fuzz.WRatio(normalized_query, self.normalized[position], full_process=False)
+                           for position in positions]
+
+
+class RapidfuzzScorer(FuzzywuzzyScorer):
+    """Scores a whole table of titles in one rapidfuzz call, then rescores the contenders.
+
+    rapidfuzz's WRatio bounds fuzzywuzzy's from above (within `RAPIDFUZZ_SCORE_SLACK`), so
+    titles are rescored with fuzzywuzzy in decreasing rapidfuzz order only until no remaining
+    title could reach the cutoff or the `limit` best exact scores. The returned scores, and so
+    the result order, are exactly those of fuzzywuzzy. With NumPy installed the batch is scored
+    by `rapidfuzz.process.cdist` on `workers` threads (-1 uses every core).
+    """
+
+    def __init__(self, normalized, workers=1):
+        if rapid_process is None:
+            raise ValueError("The rapidfuzz title scorer needs the rapidfuzz package")
+        super().__init__(normalized)
+        self.workers = workers
+
+    def score(self, normalized_query, positions, cutoffs, limit):
+        if len(positions) == len(self.normalized):
+            choices = self.normalized
+        else:
+            choices = [self.normalized[position] for position in positions]
+        bounds = self.upper_bounds(normalized_query, choices, cutoffs[-1] - RAPIDFUZZ_SCORE_SLACK)
+        exact_positions, exact_scores = [], []
+        # Min-heap of the `limit` best exact scores reaching the cutoff of the best score so far.
+        best_scores = []
+        best_score = 0
+        for choice_index, bound in bounds:
+            bound += RAPIDFUZZ_SCORE_SLACK
+            cutoff = matching_cutoff(best_score, cutoffs)
+            while best_scores and best_scores[0] < cutoff:
+                heapq.heappop(best_scores)
+            # Titles are visited by decreasing bound, so no later title can do better either.
+            if bound < cutoff or (len(best_scores) == limit and bound < best_scores[0]):
+                break
+            position = positions[choice_index]
+            score = fuzz.WRatio(normalized_query, self.normalized[position], full_process=False)
+            exact_positions.append(position)
+            exact_scores.append(score)
+            best_score = max(best_score, score)
+            if score >= matching_cutoff(best_score, cutoffs):
+                if len(best_scores) < limit:
+                    heapq.heappush(best_scores, score)
+                else:
+                    heapq.heappushpop(best_scores, score)
+        return exact_positions, exact_scores
+
+    def upper_bounds(self, normalized_query, choices, score_cutoff):
+        """(choice index, rapidfuzz score) pairs above `score_cutoff`, best first."""
+        score_cutoff = max(score_cutoff, 0)
+        if numpy is not None:
+            scores = rapid_process.cdist([normalized_query], choices, scorer=rapid_fuzz.WRatio,
+                                         processor=None, score_cutoff=score_cutoff,
+                                         workers=self.workers)[0]
+            order = numpy.argsort(-scores, kind='stable')
+            return ((int(i), float(scores[i])) for i in order if scores[i] >= score_cutoff)
+        matches = rapid_process.extract(normalized_query, choices, scorer=rapid_fuzz.WRatio,
+                                        processor=None, score_cutoff=score_cutoff, limit=None)
+        return ((choice_index, score) for _, score, choice_index in matches)
+
+
+SCORERS = {
+    'fuzzywuzzy': FuzzywuzzyScorer,
+    'rapidfuzz': RapidfuzzScorer,
+}
+
+
+def make_scorer(name, normalized, **options):
+    try:
+        scorer_class = SCORERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown title scorer {name!r}; expected one of {', '.join(SCORERS)}") from None
+    return scorer_class(normalized, **options)
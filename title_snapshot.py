@@ -0,0 +1,171 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from title_index import TitleIndex, TitlePrefixIndex
+
+# A snapshot file is MAGIC, a little-endian u32 header length, a JSON header, then the
+# sections it lists, each aligned to SECTION_ALIGNMENT bytes. Integer sections hold native
+# unsigned 32-bit values so they can be used in place from the memory map.
+MAGIC = b'HARMORY-TITLES\0\0'
+FORMAT_VERSION = 2
+SECTION_ALIGNMENT = 8
+STRING_TABLES = ('ids', 'titles', 'normalized', 'ngrams')
+INTEGER_SECTIONS = ('ngram_offsets', 'postings', 'folded_offsets', 'title_positions', 'word_positions', 'word_starts')
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot file is missing, corrupt or written in another format."""
+
+
+class StringTable:
+    """A read-only sequence of strings stored as UTF-8 in a buffer, decoded on access."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("string table index out of range")
+        return str(self.blob[self.offsets[position]:self.offsets[position + 1]], 'utf-8')
+
+    def __iter__(self):
+        blob, offsets = self.blob, self.offsets
+        for position in range(len(self)):
+            yield str(blob[offsets[position]:offsets[position + 1]], 'utf-8')
+
+
+# Encode strings as an array of end offsets (starting with 0) and the concatenated UTF-8 bytes.
+def pack_strings(strings):
+    offsets = array('I', [0])
+    chunks = []
+    size = 0
+    for string in strings:
+        encoded = string.encode('utf-8')
+        chunks.append(encoded)
+        size += len(encoded)
+        offsets.append(size)
+    return offsets, b''.join(chunks)
+
+
+def save_snapshot(index, prefix_index, path, kg_version):
+    """Write the title tables, n-gram index and prefix index to `path`, tagged with the KG release.
+
+    The n-gram index is empty when the index was built without `max_candidates`; the header
+    says so, and such a snapshot is not loaded with `max_candidates`.
+    """
+    ngrams = sorted(index.ngram_slots, key=index.ngram_slots.get)
+    buffers = {}
+    for name, strings in (('ids', index.ids), ('titles', index.titles),
+                          ('normalized', index.normalized), ('ngrams', ngrams)):
+        buffers.update(string_sections(name, strings))
+    buffers['ngram_offsets'] = array('I', index.ngram_offsets).tobytes()
+    buffers['postings'] = array('I', index.postings).tobytes()
+    buffers['folded'] = bytes(prefix_index.folded)
+    for name in ('folded_offsets', 'title_positions', 'word_positions', 'word_starts'):
+        buffers[name] = array('I', getattr(prefix_index, name)).tobytes()
+    write_sections(path, MAGIC, FORMAT_VERSION, {'kg_version': kg_version, 'count': len(index),
+                                                 'ngram_postings': index.max_candidates is not None}, buffers)
+
+
+# Return the two sections of a string table, `name`.offsets and `name`.blob.
+def string_sections(name, strings):
+    offsets, blob = pack_strings(strings)
+    return {f'{name}.offsets': offsets.tobytes(), f'{name}.blob': blob}
+
+
+def write_sections(path, magic, format_version, fields, buffers):
+    """Write `buffers` (section name -> bytes) to `path` with a header holding `fields`.
+
+    The file is written next to `path` and then renamed over it, so processes that have
+    the previous file mapped keep reading a consistent one.
+    """
+    sections = {}
+    position = 0
+    for name, data in buffers.items():
+        sections[name] = [position, len(data)]
+        position += len(data) + (-len(data) % SECTION_ALIGNMENT)
+    header = json.dumps(dict(fields, **{
+        'format': format_version,
+        'byteorder': sys.byteorder,
+        'itemsize': array('I').itemsize,
+        'sections': sections,
+    })).encode('utf-8')
+    preamble = magic + struct.pack('<I', len(header)) + header
+    preamble += b'\0' * (-len(preamble) % SECTION_ALIGNMENT)
+
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as snapshot:
+        snapshot.write(preamble)
+        for name, data in buffers.items():
+            snapshot.write(data)
+            snapshot.write(b'\0' * (-len(data) % SECTION_ALIGNMENT))
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_header(path, magic=MAGIC, format_version=FORMAT_VERSION):
+    """Return the JSON header of a snapshot and the offset at which its sections start."""
+    try:
+        with open(path, 'rb') as snapshot:
+            if snapshot.read(len(magic)) != magic:
+                raise SnapshotError(f"{path} does not start with {magic!r}")
+            header_length, = struct.unpack('<I', snapshot.read(4))
+            header = json.loads(snapshot.read(header_length))
+    except (OSError, ValueError, struct.error) as e:
+        raise SnapshotError(f"Unable to read snapshot {path}: {e}") from e
+    if (header.get('format') != format_version or header.get('byteorder') != sys.byteorder
+            or header.get('itemsize') != array('I').itemsize):
+        raise SnapshotError(f"{path} was written in an incompatible format")
+    preamble_length = len(magic) + 4 + header_length
+    return header, preamble_length + (-preamble_length % SECTION_ALIGNMENT)
+
+
+def map_sections(path, magic=MAGIC, format_version=FORMAT_VERSION):
+    """Memory-map a snapshot and return its header and a function returning a section's memoryview."""
+    header, data_start = read_header(path, magic, format_version)
+    with open(path, 'rb') as snapshot:
+        mapping = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapping)
+    if any(data_start + offset + length > len(view) for offset, length in header['sections'].values()):
+        raise SnapshotError(f"{path} is truncated")
+
+    def section(name):
+        offset, length = header['sections'][name]
+        return view[data_start + offset:data_start + offset + length]
+
+    return header, section
+
+
+# Return the string table stored in the sections `name`.offsets and `name`.blob.
+def string_table(section, name):
+    return StringTable(section(f'{name}.offsets').cast('I'), section(f'{name}.blob'))
+
+
+def load_snapshot(path, **index_options):
+    """Memory-map a snapshot and return (TitleIndex, TitlePrefixIndex, KG release it was built from).
+
+    The tables and postings are read straight from the shared, read-only mapping, so
+    loading takes milliseconds and every process mapping the file shares its pages.
+    """
+    header, section = map_sections(path)
+    if index_options.get('max_candidates') is not None and not header.get('ngram_postings', True):
+        raise SnapshotError(f"{path} was saved without the n-gram postings needed by max_candidates")
+    tables = {name: string_table(section, name) for name in STRING_TABLES}
+    integers = {name: section(name).cast('I') for name in INTEGER_SECTIONS}
+    ngram_slots = {ngram: slot for slot, ngram in enumerate(tables['ngrams'])}
+    index = TitleIndex(tables['ids'], tables['titles'], tables['normalized'], ngram_slots,
+                       integers['ngram_offsets'], integers['postings'], **index_options)
+    prefix_index = TitlePrefixIndex(tables['ids'], tables['titles'], section('folded'), integers['folded_offsets'],
+                                    integers['title_positions'], integers['word_positions'], integers['word_starts'])
+    return index, prefix_index, header['kg_version']
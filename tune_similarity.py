@@ -0,0 +1,485 @@
+import argparse
+import bisect
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from query_factory import NUM_NODES, get_tune_pattern_observations, get_tune_titles_and_families
+from ranked_lists import page_results
+from sparql_client import SparqlClient, SparqlQueryError
+from title_snapshot import SnapshotError, map_sections, string_sections, string_table, write_sections
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HARMORY-TUNESIM\0'
+FORMAT_VERSION = 1
+# Neighbours kept per tune; pages past them fall back to the SPARQL query.
+DEFAULT_TOP_K = 250
+RESULT_VARS = ['title', 'id', 'family']
+# Scores are rounded to this many decimals, so that summing in another order cannot break ties.
+SCORE_DECIMALS = 9
+
+
+class TuneIncidence:
+    """Observation counts of every pattern in every tune, with the pattern complexities.
+
+    Tunes are sorted by id and patterns by IRI; `offsets`, `patterns` and `counts` are the
+    tune -> pattern rows in CSR form. `rows[tune]` is the JSON list of the tune's result rows
+    (title, id, family), or '' for a tune without a title, which is never listed as a neighbour.
+    """
+
+    def __init__(self, ids, pattern_iris, complexities, offsets, patterns, counts, rows):
+        self.ids = ids
+        self.pattern_iris = pattern_iris
+        self.complexities = complexities
+        self.offsets = offsets
+        self.patterns = patterns
+        self.counts = counts
+        self.rows = rows
+
+    @classmethod
+    def from_results(cls, observationsJSON, titlesJSON):
+        observations = {}
+        complexities = {}
+        for item in observationsJSON['results']['bindings']:
+            pattern_iri = item['patternURI']['value']
+            observations.setdefault(item['id']['value'], {})[pattern_iri] = int(item['count']['value'])
+            complexities[pattern_iri] = float(item['complexity']['value'])
+        rows = {}
+        for item in titlesJSON['results']['bindings']:
+            rows.setdefault(item['id']['value'], []).append({var: item[var] for var in RESULT_VARS if var in item})
+
+        ids = sorted(observations)
+        pattern_iris = sorted(complexities)
+        pattern_slots = {iri: slot for slot, iri in enumerate(pattern_iris)}
+        offsets, patterns, counts = array('I', [0]), array('I'), array('I')
+        for tune_id in ids:
+            for pattern_iri, count in sorted(observations[tune_id].items()):
+                patterns.append(pattern_slots[pattern_iri])
+                counts.append(count)
+            offsets.append(len(patterns))
+        return cls(ids, pattern_iris, array('d', (complexities[iri] for iri in pattern_iris)),
+                   offsets, patterns, counts,
+                   [json.dumps(rows[tune_id]) if tune_id in rows else '' for tune_id in ids])
+
+    @classmethod
+    def fetch(cls, sparql_client):
+        return cls.from_results(sparql_client.query(get_tune_pattern_observations()),
+                                sparql_client.query(get_tune_titles_and_families()))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, tune):
+        """(pattern, count) pairs of a tune."""
+        start, end = self.offsets[tune], self.offsets[tune + 1]
+        return list(zip(self.patterns[start:end], self.counts[start:end]))
+
+    def changed_tunes(self, other):
+        """Ids of the tunes whose observations or result rows differ in `other`, or that only one has."""
+        slots = {tune_id: slot for slot, tune_id in enumerate(other.ids)}
+        pattern_map = None
+        if list(self.pattern_iris) != list(other.pattern_iris):
+            other_patterns = {iri: slot for slot, iri in enumerate(other.pattern_iris)}
+            pattern_map = [other_patterns.get(iri) for iri in self.pattern_iris]
+        changed = set(slots)
+        for tune, tune_id in enumerate(self.ids):
+            slot = slots.get(tune_id)
+            if slot is None:
+                changed.add(tune_id)
+                continue
+            start, end = self.offsets[tune], self.offsets[tune + 1]
+            other_start, other_end = other.offsets[slot], other.offsets[slot + 1]
+            patterns = self.patterns[start:end]
+            if pattern_map is not None:
+                patterns = [pattern_map[pattern] for pattern in patterns]
+            # Patterns are sorted by IRI in both, so equal rows list them in the same order.
+            if (list(patterns) == list(other.patterns[other_start:other_end])
+                    and list(self.counts[start:end]) == list(other.counts[other_start:other_end])
+                    and self.rows[tune] == other.rows[slot]):
+                changed.discard(tune_id)
+        return changed
+
+    def postings(self, listed_only=True):
+        """pattern -> (tune, count) rows in CSR form: offsets, tunes and counts.
+
+        With `listed_only`, tunes without a title are left out.
+        """
+        if numpy is not None:
+            return self.postings_numpy(listed_only)
+        rows = {}
+        for tune in range(len(self)):
+            if self.rows[tune] or not listed_only:
+                for pattern, count in self.row(tune):
+                    rows.setdefault(pattern, []).append((tune, count))
+        offsets, tunes, counts = array('I', [0]), array('I'), array('I')
+        for pattern in range(len(self.pattern_iris)):
+            for tune, count in rows.get(pattern, ()):
+                tunes.append(tune)
+                counts.append(count)
+            offsets.append(len(tunes))
+        return offsets, tunes, counts
+
+    # postings with numpy: the tune -> pattern rows sorted by pattern, keeping tune order.
+    def postings_numpy(self, listed_only):
+        offsets = numpy.frombuffer(self.offsets, dtype=numpy.uint32)
+        tunes = numpy.repeat(numpy.arange(len(self), dtype=numpy.uint32), numpy.diff(offsets))
+        patterns = numpy.frombuffer(self.patterns, dtype=numpy.uint32)
+        counts = numpy.frombuffer(self.counts, dtype=numpy.uint32)
+        if listed_only:
+            listed = numpy.fromiter((bool(row) for row in self.rows), dtype=bool, count=len(self))[tunes]
+            tunes, patterns, counts = tunes[listed], patterns[listed], counts[listed]
+        order = numpy.argsort(patterns, kind='stable')
+        posting_offsets = numpy.zeros(len(self.pattern_iris) + 1, dtype=numpy.uint32)
+        posting_offsets[1:] = numpy.cumsum(numpy.bincount(patterns, minlength=len(self.pattern_iris)))
+        return posting_offsets, tunes[order], counts[order]
+
+
+class TuneSimilarity:
+    """Top-K neighbours of every tune by complexity-weighted shared patterns.
+
+    The score of a pair is sum(count in tune * count in neighbour * complexity) over their shared
+    patterns, as in get_ranked_neighbour_tunes_by_common_patterns. `neighbours[offsets[t]:offsets[t + 1]]`
+    are the best `top_k` neighbours of tune t, best first (ties by id), with their `scores`;
+    `totals[t]` is the number of tunes it shares a pattern with.
+    """
+
+    def __init__(self, incidence, offsets, neighbours, scores, totals, top_k, kg_version=None):
+        self.incidence = incidence
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.scores = scores
+        self.totals = totals
+        self.top_k = top_k
+        self.kg_version = kg_version
+        self.slots = {tune_id: slot for slot, tune_id in enumerate(incidence.ids)}
+
+    @classmethod
+    def build(cls, incidence, top_k=DEFAULT_TOP_K, kg_version=None, previous=None):
+        """Score every tune pair sharing a pattern and keep the `top_k` best neighbours of each tune.
+
+        With the similarity of a `previous` release, the lists that can be are copied or updated
+        from it (see `updated_neighbours`) and only the others are scored from scratch.
+        Returns (TuneSimilarity, build statistics).
+        """
+        start = time.perf_counter()
+        kept, reused, moved = {}, {}, None
+        if previous is not None and previous.top_k == top_k:
+            kept, reused = previous.updated_neighbours(incidence)
+            if list(previous.incidence.ids) != list(incidence.ids):
+                slots = {tune_id: slot for slot, tune_id in enumerate(incidence.ids)}
+                moved = [slots.get(tune_id) for tune_id in previous.incidence.ids]
+        postings = incidence.postings()
+        offsets, neighbours, scores, totals = array('I', [0]), array('I'), array('d'), array('I')
+        recomputed = 0
+        for tune, tune_id in enumerate(incidence.ids):
+            if tune_id in kept:
+                old_slot, total = kept[tune_id]
+                old_start, old_end = previous.offsets[old_slot], previous.offsets[old_slot + 1]
+                if moved is None:
+                    neighbours.frombytes(memoryview(previous.neighbours)[old_start:old_end].cast('B'))
+                else:
+                    neighbours.extend(moved[neighbour] for neighbour in previous.neighbours[old_start:old_end])
+                scores.frombytes(memoryview(previous.scores)[old_start:old_end].cast('B'))
+                totals.append(total)
+                offsets.append(len(neighbours))
+                continue
+            if tune_id in reused:
+                ranked, total = reused[tune_id]
+            else:
+                ranked, total = rank_neighbours(incidence, postings, tune, top_k)
+                recomputed += 1
+            neighbours.extend(neighbour for neighbour, _ in ranked)
+            scores.extend(score for _, score in ranked)
+            totals.append(total)
+            offsets.append(len(neighbours))
+        similarity = cls(incidence, offsets, neighbours, scores, totals, top_k, kg_version)
+        stats = {
+            'tunes': len(incidence),
+            'recomputed': recomputed,
+            'kept': len(kept),
+            'neighbours': len(neighbours),
+            'seconds': time.perf_counter() - start,
+            'bytes': sum(len(values) * values.itemsize for values in (offsets, neighbours, scores, totals)),
+        }
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux.
+            stats['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return similarity, stats
+
+    def updated_neighbours(self, incidence):
+        """The lists that can be carried over to `incidence`: ({id: (slot, total)} of the lists
+        kept as they are, {id: (ranked neighbours, total)} of the lists updated).
+
+        A pair's score only changes if one of the tunes had its observations or title changed,
+        or a shared pattern its complexity. So the lists holding no changed tune, and that no
+        changed tune enters, are kept as they are; only the number of tunes sharing a pattern
+        with them is updated. The lists of the tunes sharing a pattern with a changed tune are
+        kept minus the changed tunes, which are scored again from their side. Tunes that changed,
+        tunes with a reweighted pattern and truncated lists that may now need a tune past the top
+        K are left out, to be scored from scratch. Updated neighbours are given as slots of
+        `incidence`.
+        """
+        previous = self.incidence
+        changed = previous.changed_tunes(incidence)
+        slots = {tune_id: slot for slot, tune_id in enumerate(incidence.ids)}
+        # Old slots -> new slots, with None for the changed tunes.
+        new_slots = [None if tune_id in changed else slots[tune_id] for tune_id in previous.ids]
+        new_postings, old_postings = incidence.postings(listed_only=False), previous.postings(listed_only=False)
+        old_complexities = dict(zip(previous.pattern_iris, previous.complexities))
+        reweighted = set()
+        for pattern, (iri, complexity) in enumerate(zip(incidence.pattern_iris, incidence.complexities)):
+            if old_complexities.get(iri, complexity) != complexity:
+                reweighted.update(new_postings[1][new_postings[0][pattern]:new_postings[0][pattern + 1]])
+
+        # A tune ranking after the last entry of a truncated list cannot enter it: keep that entry's
+        # score and the slot its id would take (ids and slots sort alike) to leave such tunes out.
+        cutoff_scores = [float('-inf')] * len(incidence)
+        cutoff_slots = [len(incidence)] * len(incidence)
+        for tune_id, slot in slots.items():
+            old_slot = self.slots.get(tune_id)
+            if old_slot is not None and self.totals[old_slot] > self.top_k:
+                last = self.offsets[old_slot + 1] - 1
+                cutoff_scores[slot] = self.scores[last]
+                cutoff_slots[slot] = bisect.bisect_left(incidence.ids, previous.ids[self.neighbours[last]])
+
+        # The changed, listed tunes scored against every tune, and the number of changed tunes each
+        # tune shares, and used to share, a pattern with.
+        added, added_counts, removed_counts = {}, [0] * len(incidence), {}
+        for tune_id in changed:
+            slot, old_slot = slots.get(tune_id), self.slots.get(tune_id)
+            if slot is not None and incidence.rows[slot]:
+                for other, score in zip(*shared_pattern_scores(incidence, new_postings, slot)):
+                    added_counts[other] += 1
+                    if score > cutoff_scores[other] or (score == cutoff_scores[other] and slot <= cutoff_slots[other]):
+                        added.setdefault(other, []).append((slot, score))
+            if old_slot is not None and previous.rows[old_slot]:
+                for other in shared_pattern_scores(previous, old_postings, old_slot)[0]:
+                    removed_counts[other] = removed_counts.get(other, 0) + 1
+
+        changed_slots = {self.slots[tune_id] for tune_id in changed if tune_id in self.slots}
+        kept, updated = {}, {}
+        for tune_id, slot in slots.items():
+            if tune_id in changed or slot in reweighted:
+                continue
+            old_slot = self.slots[tune_id]
+            total = self.totals[old_slot] - removed_counts.get(old_slot, 0) + added_counts[slot]
+            start, end = self.offsets[old_slot], self.offsets[old_slot + 1]
+            if slot not in added and changed_slots.isdisjoint(self.neighbours[start:end]):
+                kept[tune_id] = (old_slot, total)
+                continue
+            # (-score, slot) pairs sort best first.
+            ranked = [(-score, new_slots[neighbour])
+                      for neighbour, score in zip(self.neighbours[start:end], self.scores[start:end])
+                      if new_slots[neighbour] is not None]
+            if slot in added:
+                ranked += [(-score, other) for other, score in added[slot]]
+                ranked.sort()
+            if self.totals[old_slot] > self.top_k and len(ranked) < self.top_k:
+                continue
+            updated[tune_id] = ([(neighbour, -score) for score, neighbour in ranked[:self.top_k]], total)
+        return kept, updated
+
+    def neighbours_of(self, tune_id, limit=None):
+        """Results of get_ranked_neighbour_tunes_by_common_patterns for the `top_k` best neighbours.
+
+        Only the result rows of the first neighbours are decoded if `limit` rows are enough.
+        """
+        bindings = []
+        tune = self.slots.get(tune_id)
+        if tune is not None:
+            for neighbour in self.neighbours[self.offsets[tune]:self.offsets[tune + 1]]:
+                if limit is not None and len(bindings) >= limit:
+                    break
+                bindings.extend(json.loads(self.incidence.rows[neighbour]))
+        return {"head": {"vars": RESULT_VARS}, "results": {"bindings": bindings}}
+
+    def page(self, tune_id, offset):
+        """The page of neighbours from `offset`, or None if it lies past the `top_k` kept."""
+        # One row past the page tells whether there is a next one.
+        results = self.neighbours_of(tune_id, limit=offset + NUM_NODES + 1)
+        tune = self.slots.get(tune_id)
+        if (tune is not None and self.totals[tune] > self.top_k
+                and offset + NUM_NODES >= len(results['results']['bindings'])):
+            return None
+        return page_results(results, offset)
+
+
+# Return the tunes of the pattern `postings` sharing a pattern with `tune`, and their scores.
+def shared_pattern_scores(incidence, postings, tune):
+    if numpy is not None:
+        others, scores = shared_pattern_scores_numpy(incidence, postings, tune)
+        return others.tolist(), scores[others].tolist()
+    posting_offsets, posting_tunes, posting_counts = postings
+    scores = {}
+    for pattern, count in incidence.row(tune):
+        weight = count * incidence.complexities[pattern]
+        for position in range(posting_offsets[pattern], posting_offsets[pattern + 1]):
+            other = posting_tunes[position]
+            scores[other] = scores.get(other, 0.0) + weight * posting_counts[position]
+    scores.pop(tune, None)
+    return list(scores), [round(score, SCORE_DECIMALS) for score in scores.values()]
+
+
+# shared_pattern_scores accumulating the scores of all tunes at once with numpy.bincount:
+# returns the other tunes and the scores of every tune.
+def shared_pattern_scores_numpy(incidence, postings, tune):
+    posting_offsets, posting_tunes, posting_counts = (numpy.frombuffer(values, dtype=numpy.uint32)
+                                                      for values in postings)
+    start, end = incidence.offsets[tune], incidence.offsets[tune + 1]
+    patterns = numpy.frombuffer(incidence.patterns, dtype=numpy.uint32)[start:end]
+    counts = numpy.frombuffer(incidence.counts, dtype=numpy.uint32)[start:end]
+    weights = counts * numpy.frombuffer(incidence.complexities, dtype=numpy.float64)[patterns]
+    lengths = (posting_offsets[patterns + 1] - posting_offsets[patterns]).astype(numpy.int64)
+    if not lengths.sum():
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(len(incidence))
+    positions = numpy.concatenate([numpy.arange(posting_offsets[pattern], posting_offsets[pattern + 1])
+                                   for pattern in patterns.tolist()])
+    others = posting_tunes[positions]
+    scores = numpy.round(numpy.bincount(others, numpy.repeat(weights, lengths) * posting_counts[positions],
+                                        minlength=len(incidence)), SCORE_DECIMALS)
+    shared = numpy.bincount(others, minlength=len(incidence)) > 0
+    shared[tune] = False
+    return numpy.flatnonzero(shared), scores
+
+
+# Rank the tunes of the pattern `postings` sharing a pattern with `tune`:
+# ((neighbour, score) best first, number of them).
+def rank_neighbours(incidence, postings, tune, top_k):
+    if numpy is None:
+        others, scores = shared_pattern_scores(incidence, postings, tune)
+        return heapq.nsmallest(top_k, zip(others, scores), key=lambda entry: (-entry[1], entry[0])), len(others)
+    candidates, scores = shared_pattern_scores_numpy(incidence, postings, tune)
+    total = len(candidates)
+    if total > top_k:
+        # Keep every tune scoring above the k-th best score, then the lowest slots among ties.
+        threshold = numpy.partition(scores[candidates], total - top_k)[total - top_k]
+        above = candidates[scores[candidates] > threshold]
+        tied = candidates[scores[candidates] == threshold][:top_k - len(above)]
+        candidates = numpy.concatenate([above, tied])
+    order = numpy.lexsort((candidates, -scores[candidates]))
+    return [(int(neighbour), float(scores[neighbour])) for neighbour in candidates[order]], total
+
+
+def save_similarity(similarity, path):
+    incidence = similarity.incidence
+    buffers = {}
+    for name, strings in (('ids', incidence.ids), ('pattern_iris', incidence.pattern_iris),
+                          ('rows', incidence.rows)):
+        buffers.update(string_sections(name, strings))
+    for name, values, typecode in (('complexities', incidence.complexities, 'd'),
+                                   ('tune_offsets', incidence.offsets, 'I'),
+                                   ('tune_patterns', incidence.patterns, 'I'),
+                                   ('tune_counts', incidence.counts, 'I'),
+                                   ('offsets', similarity.offsets, 'I'),
+                                   ('neighbours', similarity.neighbours, 'I'),
+                                   ('scores', similarity.scores, 'd'),
+                                   ('totals', similarity.totals, 'I')):
+        buffers[name] = array(typecode, values).tobytes()
+    write_sections(path, MAGIC, FORMAT_VERSION,
+                   {'kg_version': similarity.kg_version, 'top_k': similarity.top_k}, buffers)
+
+
+def load_similarity(path):
+    """Memory-map a similarity file written by save_similarity."""
+    header, section = map_sections(path, MAGIC, FORMAT_VERSION)
+    incidence = TuneIncidence(string_table(section, 'ids'), string_table(section, 'pattern_iris'),
+                              section('complexities').cast('d'), section('tune_offsets').cast('I'),
+                              section('tune_patterns').cast('I'), section('tune_counts').cast('I'),
+                              string_table(section, 'rows'))
+    return TuneSimilarity(incidence, section('offsets').cast('I'), section('neighbours').cast('I'),
+                          section('scores').cast('d'), section('totals').cast('I'),
+                          header['top_k'], header['kg_version'])
+
+
+def format_build_stats(stats):
+    text = (f"{stats['tunes']} tunes ({stats['recomputed']} scored from scratch, {stats['kept']} kept, the others updated) "
+            f"in {stats['seconds']:.2f}s, {stats['neighbours']} neighbours in {stats['bytes'] / 2**20:.1f} MB")
+    if 'peak_rss' in stats:
+        text += f", peak RSS {stats['peak_rss'] / 2**20:.0f} MB"
+    return text
+
+
+class TuneSimilarityStore:
+    """Keeps the tune similarity file on the current KG release and serves pages from it.
+
+    The file is mapped at startup if it exists, and rebuilt in the background (incrementally
+    from the previous release) when the KG release changes. `page` returns None while no
+    similarity is available, and for pages past the `top_k` neighbours kept.
+    """
+
+    def __init__(self, sparql_client, path, top_k=DEFAULT_TOP_K):
+        self.sparql_client = sparql_client
+        self.path = path
+        self.top_k = top_k
+        self.similarity = None
+        self._rebuild_lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                self.similarity = load_similarity(path)
+            except SnapshotError as e:
+                logger.warning("Ignoring tune similarity file: %s", e)
+
+    def page(self, tune_id, offset):
+        similarity = self.similarity
+        return similarity.page(tune_id, offset) if similarity is not None else None
+
+    def refresh_in_background(self, old_version, new_version):
+        if self.similarity is not None and self.similarity.kg_version == new_version:
+            return None
+        thread = threading.Thread(target=self.rebuild, args=(new_version,), name='tune-similarity-refresh',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def rebuild(self, kg_version):
+        with self._rebuild_lock:
+            try:
+                incidence = TuneIncidence.fetch(self.sparql_client)
+            except SparqlQueryError:
+                logger.warning("Unable to rebuild the tune similarities; keeping the current ones")
+                return
+            similarity, stats = TuneSimilarity.build(incidence, self.top_k, kg_version, previous=self.similarity)
+            logger.info("Built tune similarities for KG version %s: %s", kg_version, format_build_stats(stats))
+            try:
+                save_similarity(similarity, self.path)
+                # Serve from the mapped file, so worker processes share its pages.
+                similarity = load_similarity(self.path)
+            except (OSError, SnapshotError) as e:
+                logger.warning("Unable to save the tune similarities to %s: %s", self.path, e)
+            self.similarity = similarity
+
+
+# Offline build: python tune_similarity.py --output tune_similarity.snapshot
+def main():
+    parser = argparse.ArgumentParser(description="Build the tune similarity file from a SPARQL endpoint.")
+    parser.add_argument('--endpoint', default=os.environ.get('BLAZEGRAPH_URL',
+                                                             'https://polifonia.disi.unibo.it/harmory/sparql'))
+    parser.add_argument('--output', required=True, help="Similarity file, updated incrementally if it exists.")
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K)
+    parser.add_argument('--kg-version', help="KG release to tag the file with.")
+    args = parser.parse_args()
+
+    previous = load_similarity(args.output) if os.path.exists(args.output) else None
+    incidence = TuneIncidence.fetch(SparqlClient(args.endpoint))
+    similarity, stats = TuneSimilarity.build(incidence, args.top_k, args.kg_version, previous=previous)
+    save_similarity(similarity, args.output)
+    print(f"Built {args.output}: {format_build_stats(stats)}")
+
+
+if __name__ == "__main__":
+    main()